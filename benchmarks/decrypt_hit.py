@@ -0,0 +1,89 @@
+"""
+Benchmark the KMSTokenValidator.decrypt_token cache-hit path, and token
+timestamp parsing and formatting.
+
+Usage: python benchmarks/decrypt_hit.py [--calls N]
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kmsauth  # noqa: E402
+from kmsauth.utils import timestamp  # noqa: E402
+
+TOKEN = 'AQICAHh' + 'A' * 300 + '='
+
+
+def rate(func, calls):
+    start = time.perf_counter()
+    for _ in range(calls):
+        func()
+    elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+def report(name, calls_per_second):
+    print('{0:<36} {1:>12,.0f} ops/s'.format(name, calls_per_second))
+
+
+def make_validator():
+    now = time.time()
+    payload = json.dumps({
+        'not_before': timestamp.format_timestamp(now - 60),
+        'not_after': timestamp.format_timestamp(now + 600),
+    })
+    kms_client = MagicMock()
+    kms_client.decrypt.return_value = {
+        'Plaintext': payload,
+        'KeyId': 'arn:aws:kms:us-east-1:123456789012:key/benchmark'
+    }
+    validator = kmsauth.KMSTokenValidator(
+        'arn:aws:kms:us-east-1:123456789012:key/benchmark',
+        None,
+        'benchmark',
+        'us-east-1',
+        kms_transport=kms_client
+    )
+    # Populate the cache, so that only the hit path is measured.
+    validator.decrypt_token('2/service/benchmark', TOKEN)
+    return validator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=200000)
+    args = parser.parse_args()
+    value = '20240615T081530Z'
+    epoch = timestamp.parse_timestamp(value)
+    dt = datetime.datetime.utcfromtimestamp(epoch)
+    report('datetime.strptime', rate(
+        lambda: datetime.datetime.strptime(value, timestamp.TIME_FORMAT),
+        args.calls
+    ))
+    report('parse_timestamp', rate(
+        lambda: timestamp.parse_timestamp(value),
+        args.calls
+    ))
+    report('datetime.strftime', rate(
+        lambda: dt.strftime(timestamp.TIME_FORMAT),
+        args.calls
+    ))
+    report('format_timestamp', rate(
+        lambda: timestamp.format_timestamp(epoch),
+        args.calls
+    ))
+    validator = make_validator()
+    report('decrypt_token (cache hit)', rate(
+        lambda: validator.decrypt_token('2/service/benchmark', TOKEN),
+        args.calls
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark kmsauth startup: importing kmsauth, building a generator and getting
+a token from token_cache_file, as a short-lived CLI or Lambda handler would.
+
+Each sample runs in a fresh interpreter, so imports aren't cached.
+
+Usage: python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = '''
+import time
+start = time.perf_counter()
+import kmsauth
+imported = time.perf_counter()
+generator = kmsauth.KMSTokenGenerator(
+    'alias/authnz-benchmark',
+    {{'from': 'benchmark', 'to': 'benchmark', 'user_type': 'service'}},
+    'us-east-1',
+    token_cache_file={cache_file!r}
+)
+generator.get_token()
+done = time.perf_counter()
+import sys
+print(imported - start, done - imported, 'boto3' in sys.modules)
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_file = os.path.join(tmpdir, 'token')
+        with open(cache_file, 'w') as f:
+            json.dump({
+                'token': 'dG9rZW4=',
+                'not_after': time.strftime(
+                    '%Y%m%dT%H%M%SZ',
+                    time.gmtime(time.time() + 3600)
+                ),
+                'auth_context': {
+                    'from': 'benchmark',
+                    'to': 'benchmark',
+                    'user_type': 'service'
+                }
+            }, f)
+        script = SCRIPT.format(cache_file=cache_file)
+        imports = []
+        tokens = []
+        for _ in range(args.runs):
+            out = subprocess.check_output(
+                [sys.executable, '-c', script],
+                cwd=root
+            ).decode('utf-8').split()
+            imports.append(float(out[0]))
+            tokens.append(float(out[1]))
+            boto3_loaded = out[2]
+    print('import kmsauth:        {0:8.2f} ms (median of {1})'.format(
+        statistics.median(imports) * 1000, args.runs))
+    print('construct + get_token: {0:8.2f} ms (median of {1})'.format(
+        statistics.median(tokens) * 1000, args.runs))
+    print('boto3 imported:        {0}'.format(boto3_loaded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Benchmark KMSTokenValidator.decrypt_token cache hits from many threads.
+
+On free-threaded CPython, throughput should scale close to linearly with the
+number of threads, up to the number of CPUs. With the GIL, it can't scale.
+
+Usage: python benchmarks/threads.py [--threads 1,2,4,8] [--duration S]
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from unittest.mock import MagicMock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kmsauth  # noqa: E402
+from kmsauth.utils import sharded, timestamp  # noqa: E402
+
+TOKENS = [
+    base64.b64encode(
+        b'\x01\x02\x02\x00' + i.to_bytes(4, 'big') * 64
+    ).decode('ascii')
+    for i in range(256)
+]
+
+
+def make_validator():
+    now = time.time()
+    payload = json.dumps({
+        'not_before': timestamp.format_timestamp(now - 60),
+        'not_after': timestamp.format_timestamp(now + 600),
+    })
+    kms_client = MagicMock()
+    kms_client.decrypt.return_value = {
+        'Plaintext': payload,
+        'KeyId': 'arn:aws:kms:us-east-1:123456789012:key/benchmark'
+    }
+    validator = kmsauth.KMSTokenValidator(
+        'arn:aws:kms:us-east-1:123456789012:key/benchmark',
+        None,
+        'benchmark',
+        'us-east-1',
+        kms_transport=kms_client
+    )
+    # Populate the cache, so that only the hit path is measured.
+    for token in TOKENS:
+        validator.decrypt_token('2/service/benchmark', token)
+    return validator
+
+
+def run(validator, threads, duration):
+    """Return the total decrypt_token calls per second across threads."""
+    counts = [0] * threads
+    start = threading.Barrier(threads + 1)
+    stop = threading.Event()
+
+    def worker(index):
+        tokens = TOKENS[index::threads] or TOKENS
+        start.wait()
+        calls = 0
+        while not stop.is_set():
+            for token in tokens:
+                validator.decrypt_token('2/service/benchmark', token)
+            calls += len(tokens)
+        counts[index] = calls
+
+    workers = [
+        threading.Thread(target=worker, args=(i,)) for i in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - began)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--threads', default='1,2,4,8')
+    parser.add_argument('--duration', type=float, default=2.0)
+    args = parser.parse_args()
+    validator = make_validator()
+    print('GIL enabled: {0}, CPUs: {1}, token cache shards: {2}'.format(
+        sharded.gil_enabled(),
+        os.cpu_count(),
+        len(validator.TOKENS.shards)
+    ))
+    baseline = None
+    for threads in [int(n) for n in args.threads.split(',')]:
+        ops = run(validator, threads, args.duration)
+        if baseline is None:
+            baseline = ops / threads
+        print('{0:>3} threads {1:>12,.0f} ops/s {2:>6.2f}x'.format(
+            threads,
+            ops,
+            ops / baseline
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Benchmark per-call client CPU cost of KMS decrypts, for the boto3 client and
+kmsauth.transport.HTTPKMSTransport, against a local stand-in KMS endpoint.
+
+The stand-in endpoint runs in a separate process, so that only the client's
+CPU time is measured.
+
+Usage: python benchmarks/transport.py [--calls N]
+"""
+import argparse
+import base64
+import http.server
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kmsauth import services, transport  # noqa: E402
+
+CREDS = {
+    'AccessKeyId': 'AKIDEXAMPLE',
+    'SecretAccessKey': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+    'SessionToken': 'session-token',
+}
+PLAINTEXT = base64.b64encode(json.dumps({
+    'not_before': '20200101T000000Z',
+    'not_after': '20200101T001000Z'
+}).encode('utf-8')).decode('ascii')
+
+
+class StandInKMSHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        data = json.dumps({
+            'KeyId': 'arn:aws:kms:us-east-1:123456789012:key/benchmark',
+            'Plaintext': PLAINTEXT,
+            'EncryptionAlgorithm': 'SYMMETRIC_DEFAULT',
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', transport.KMS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve():
+    server = http.server.ThreadingHTTPServer(
+        ('127.0.0.1', 0),
+        StandInKMSHandler
+    )
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+def measure(client, calls):
+    blob = b'\x01\x02\x02\x00' + os.urandom(180)
+    context = {'from': 'benchmark', 'to': 'benchmark', 'user_type': 'service'}
+    # Warm up connections and any lazily built state.
+    for _ in range(10):
+        client.decrypt(CiphertextBlob=blob, EncryptionContext=context)
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    for _ in range(calls):
+        client.decrypt(CiphertextBlob=blob, EncryptionContext=context)
+    return (
+        (time.process_time() - cpu) / calls * 1e6,
+        (time.perf_counter() - wall) / calls * 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve:
+        return serve()
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve'],
+        stdout=subprocess.PIPE
+    )
+    try:
+        endpoint_url = 'http://127.0.0.1:{0}'.format(
+            int(server.stdout.readline())
+        )
+        boto_client = services.get_boto_client(
+            'kms',
+            region='us-east-1',
+            aws_access_key_id=CREDS['AccessKeyId'],
+            aws_secret_access_key=CREDS['SecretAccessKey'],
+            aws_session_token=CREDS['SessionToken'],
+            endpoint_url=endpoint_url
+        )
+        http_transport = transport.HTTPKMSTransport(
+            'us-east-1',
+            endpoint_url=endpoint_url,
+            aws_creds=CREDS
+        )
+        print('{0:<20} {1:>14} {2:>14}'.format(
+            'transport', 'cpu us/call', 'wall us/call'))
+        for name, client in [
+                ('boto3', boto_client),
+                ('HTTPKMSTransport', http_transport)]:
+            cpu, wall = measure(client, args.calls)
+            print('{0:<20} {1:>14.1f} {2:>14.1f}'.format(name, cpu, wall))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
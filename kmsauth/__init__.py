@@ -1,31 +1,66 @@
 import logging
 import hashlib
 import json
-import datetime
 import base64
 import os
 import copy
-
-from botocore.vendored import six
-from botocore.exceptions import (ConnectionError,
-                                 EndpointConnectionError)
+import re
+import struct
+import tempfile
+import time
 
 import kmsauth.services
+from kmsauth.aliases import get_alias_resolver, is_alias
 # Try to import the more efficient lru-dict, and fallback to slower pure-python
 # lru dict implementation if it's not available.
 try:
     from lru import LRU
 except ImportError:
     from kmsauth.utils.lru import LRUCache as LRU
+from kmsauth.utils.concurrency import ConcurrencyLimiter
+from kmsauth.utils import forksafe
+from kmsauth.utils.deadline import from_timeout
+from kmsauth.utils.ratelimit import KeyedRateLimiter, TokenBucket
+from kmsauth.utils.sharded import ShardedCache
+from kmsauth.utils.tinylfu import WTinyLFUCache
+from kmsauth.utils.tracing import span
+from kmsauth.utils.timestamp import (  # noqa: F401
+    TIME_FORMAT,
+    format_timestamp,
+    parse_timestamp,
+)
 
 TOKEN_SKEW = 3
-TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+# Bounds on the size of a token's KMS ciphertext, in bytes. KMS ciphertexts
+# are at most 6144 bytes; anything much smaller than a KMS ciphertext header
+# can't be a token.
+MIN_CIPHERTEXT_SIZE = 64
+MAX_CIPHERTEXT_SIZE = 6144
+# Tokens are standard base64, with padding. KMS ciphertexts start with a 0x01
+# version byte, so tokens start with 'A' followed by one of 'Q'-'f'.
+_TOKEN_RE = re.compile(r'A[Q-Za-f][A-Za-z0-9+/]*={0,2}\Z', re.ASCII)
+# Usernames are either version/user_type/from, or (v1) just from.
+_USERNAME_RE = re.compile(
+    r'(?:([1-9][0-9]{0,2})/([a-z_]{1,32})/)?([A-Za-z0-9_.@+=,:~-]{1,256})\Z',
+    re.ASCII
+)
+# Version 3 tokens have a binary payload: a format byte, flags, and not_before
+# and not_after as epoch seconds.
+_BINARY_PAYLOAD = struct.Struct('>BBII')
+BINARY_PAYLOAD_FORMAT = 1
+# No flags are defined yet; tokens with flags a validator doesn't know are
+# rejected.
+BINARY_PAYLOAD_FLAGS = 0
+# Version 3 usernames abbreviate these user_types, e.g. 3/s/my-service.
+_USER_TYPE_CODES = {'service': 's', 'user': 'u'}
+_USER_TYPES = {code: user_type for user_type, code in _USER_TYPE_CODES.items()}
+MAX_TOKEN_VERSION = 3
 
 
 def ensure_text(str_or_bytes, encoding='utf-8'):
     """Ensures an input is a string, decoding if it is bytes.
     """
-    if not isinstance(str_or_bytes, six.text_type):
+    if not isinstance(str_or_bytes, str):
         return str_or_bytes.decode(encoding)
     return str_or_bytes
 
@@ -33,11 +68,61 @@ def ensure_text(str_or_bytes, encoding='utf-8'):
 def ensure_bytes(str_or_bytes, encoding='utf-8', errors='strict'):
     """Ensures an input is bytes, encoding if it is a string.
     """
-    if isinstance(str_or_bytes, six.text_type):
+    if isinstance(str_or_bytes, str):
         return str_or_bytes.encode(encoding, errors)
     return str_or_bytes
 
 
+def _check_token_format(token):
+    """
+    Return token as text if it could be a base64 encoded KMS ciphertext (by
+    its length, base64 alphabet and padding, and the ciphertext's version
+    byte), otherwise None.
+    """
+    try:
+        token = ensure_text(token, 'ascii')
+    except (UnicodeDecodeError, AttributeError):
+        return None
+    if not isinstance(token, str) or len(token) % 4:
+        return None
+    size = len(token) // 4 * 3 - token[-2:].count('=')
+    if (size < MIN_CIPHERTEXT_SIZE or
+            size > MAX_CIPHERTEXT_SIZE or
+            _TOKEN_RE.match(token) is None):
+        return None
+    return token
+
+
+def _get_kms_client(region, aws_creds, **kwargs):
+    """Get a KMS client for the given region and credentials.
+
+    aws_creds may be a dict of AccessKeyId, SecretAccessKey and SessionToken,
+    a callable returning such a dict (optionally with an Expiration), or None
+    to use the default credential chain.
+    """
+    if callable(aws_creds):
+        return kmsauth.services.get_boto_client(
+            'kms',
+            region=region,
+            refresh_credentials=aws_creds,
+            **kwargs
+        )
+    elif aws_creds:
+        return kmsauth.services.get_boto_client(
+            'kms',
+            region=region,
+            aws_access_key_id=aws_creds['AccessKeyId'],
+            aws_secret_access_key=aws_creds['SecretAccessKey'],
+            aws_session_token=aws_creds['SessionToken'],
+            **kwargs
+        )
+    return kmsauth.services.get_boto_client(
+        'kms',
+        region=region,
+        **kwargs
+    )
+
+
 class KMSTokenValidator(object):
 
     """A class that represents a token validator for KMS auth."""
@@ -60,6 +145,19 @@ class KMSTokenValidator(object):
             max_pool_connections=None,
             connect_timeout=None,
             read_timeout=None,
+            stale_token_cache_size=0,
+            kms_transport=None,
+            decrypt_rate_limit=None,
+            decrypt_rate_burst=None,
+            global_decrypt_rate_limit=None,
+            global_decrypt_rate_burst=None,
+            max_concurrent_decrypts=None,
+            decrypt_queue_timeout=0.1,
+            tracer=None,
+            cache_trace=None,
+            token_cache_policy='lru',
+            token_cache_sizes=None,
+            token_cache_shards=None,
             ):
         """Create a KMSTokenValidator object.
 
@@ -69,7 +167,10 @@ class KMSTokenValidator(object):
             user_auth_key: A list of KMS key ARNs or aliases to use for user
                 authentication. Required.
             to_auth_context: The KMS encryption context to use for the to
-                context for authentication. Required.
+                context for authentication. Required. This may be None, if
+                to_auth_context is passed to decrypt_token instead, which lets
+                a single validator (and its caches and KMS client) serve many
+                audiences.
             region: AWS region to connect to. Required.
             scoped_auth_keys: A dict of KMS key to account mappings. These keys
             are for the 'service' role to support multiple AWS accounts. If
@@ -79,17 +180,67 @@ class KMSTokenValidator(object):
             minimum_token_version: The minimum version of the authentication
             token accepted.
             maximum_token_version: The maximum version of the authentication
-            token accepted.
+            token accepted. Version 3 tokens, with a binary payload, are
+            only accepted if this is set to 3.
             auth_token_max_lifetime: The maximum lifetime of an authentication
             token in minutes.
             token_cache_size: Size of the in-memory LRU cache for auth tokens.
             aws_creds: A dict of AccessKeyId, SecretAccessKey, SessionToken.
                 Useful if you wish to pass in assumed role credentials or MFA
-                credentials. Default: None
+                credentials. This can also be a callable returning such a
+                dict, with an optional Expiration, in which case the
+                credentials are refreshed as they expire, reusing the same
+                KMS client. Default: None
             endpoint_url: A URL to override the default endpoint used to access
                 the KMS service. Default: None
             stats: A statsd client instance, to be used to track stats.
                 Default: None
+            stale_token_cache_size: Size of a secondary in-memory cache of
+                previously validated tokens, used only when KMS can not be
+                reached. Tokens in this cache are still checked against their
+                own not_before and not_after. 0 disables it. Default: 0
+            kms_transport: The object used to make KMS calls, see
+                kmsauth.transport. If set, aws_creds, endpoint_url,
+                max_pool_connections, connect_timeout and read_timeout are
+                ignored. Default: None, which uses a boto3 KMS client.
+            decrypt_rate_limit: The maximum rate of KMS decrypts (token cache
+                misses) per second, for each from and user_type. Tokens over
+                the limit are rejected with RateLimitExceededError.
+                Default: None (no limit)
+            decrypt_rate_burst: The number of KMS decrypts, for each from and
+                user_type, allowed in a burst above decrypt_rate_limit.
+                Default: decrypt_rate_limit, or 1 if that's smaller.
+            global_decrypt_rate_limit: The maximum rate of KMS decrypts per
+                second, across all users. Default: None (no limit)
+            global_decrypt_rate_burst: The number of KMS decrypts allowed in a
+                burst above global_decrypt_rate_limit. Default:
+                global_decrypt_rate_limit, or 1 if that's smaller.
+            max_concurrent_decrypts: The maximum number of concurrent KMS
+                decrypts. Other decrypts wait for one to finish.
+                Default: None (no limit)
+            decrypt_queue_timeout: The maximum time, in seconds, to wait to
+                start a KMS decrypt, when max_concurrent_decrypts are already
+                running. Tokens that would wait longer are rejected with
+                ServiceOverloadedError. If None, decrypts wait for a slot
+                for as long as decrypt_token's timeout allows, or forever
+                without one. Default: 0.1
+            tracer: An OpenTelemetry-compatible tracer, used to trace each
+                phase of token validation; see kmsauth.utils.tracing.
+                Default: None
+            cache_trace: A kmsauth.utils.cachetrace.CacheTraceRecorder, which
+                records every token cache access, for replaying with the
+                kmsauth-cachesim tool. Default: None
+            token_cache_policy: The token cache's eviction policy: 'lru', or
+                'tinylfu' (W-TinyLFU), which keeps frequently used tokens
+                cached through bursts of one-off tokens. Default: 'lru'
+            token_cache_sizes: A dict of user_type to the size of a separate
+                token cache for that user_type, so that, for instance, many
+                user tokens can't evict service tokens. Other user_types share
+                a cache of token_cache_size. Default: None
+            token_cache_shards: The number of separately locked shards each
+                token cache is split into, rounded down to a power of two.
+                Default: None, which uses 1 shard if the GIL is enabled, or
+                several per CPU if it isn't.
         """
         self.auth_key = auth_key
         self.user_auth_key = user_auth_key
@@ -103,47 +254,103 @@ class KMSTokenValidator(object):
         self.maximum_token_version = maximum_token_version
         self.auth_token_max_lifetime = auth_token_max_lifetime
         self.aws_creds = aws_creds
-        if aws_creds:
-            self.kms_client = kmsauth.services.get_boto_client(
-                'kms',
-                region=self.region,
-                aws_access_key_id=self.aws_creds['AccessKeyId'],
-                aws_secret_access_key=self.aws_creds['SecretAccessKey'],
-                aws_session_token=self.aws_creds['SessionToken'],
-                endpoint_url=endpoint_url,
-                max_pool_connections=max_pool_connections,
-                connect_timeout=connect_timeout,
-                read_timeout=read_timeout,
-            )
-        else:
-            self.kms_client = kmsauth.services.get_boto_client(
-                'kms',
-                region=self.region,
-                endpoint_url=endpoint_url,
-                max_pool_connections=max_pool_connections,
-                connect_timeout=connect_timeout,
-                read_timeout=read_timeout,
-            )
+        # The KMS client is created on first use; see kms_client.
+        self._kms_client = kms_transport
+        self._kms_client_generation = None
+        self._kms_client_kwargs = dict(
+            endpoint_url=endpoint_url,
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
         if extra_context is None:
             self.extra_context = {}
         else:
             self.extra_context = extra_context
-        self.TOKENS = LRU(token_cache_size)
+        self.token_cache_policy = token_cache_policy
+        if token_cache_shards is not None and token_cache_shards < 1:
+            raise ConfigurationError('token_cache_shards must be at least 1.')
+        self.token_cache_shards = token_cache_shards
+        self.TOKENS = self._build_token_cache(token_cache_size)
+        # Token caches for user_types with their own partition; tokens of
+        # other user_types are cached in TOKENS.
+        self.TOKEN_PARTITIONS = {
+            user_type: self._build_token_cache(size)
+            for user_type, size in (token_cache_sizes or {}).items()
+        }
+        if stale_token_cache_size:
+            self.STALE_TOKENS = ShardedCache(
+                LRU,
+                stale_token_cache_size,
+                shards=token_cache_shards
+            )
+        else:
+            self.STALE_TOKENS = None
         self.KEY_METADATA = {}
         self.stats = stats
+        if decrypt_rate_limit is not None:
+            self.decrypt_rate_limiter = KeyedRateLimiter(
+                decrypt_rate_limit,
+                decrypt_rate_burst or max(decrypt_rate_limit, 1)
+            )
+        else:
+            self.decrypt_rate_limiter = None
+        if global_decrypt_rate_limit is not None:
+            self.global_decrypt_rate_limiter = TokenBucket(
+                global_decrypt_rate_limit,
+                global_decrypt_rate_burst or max(global_decrypt_rate_limit, 1)
+            )
+        else:
+            self.global_decrypt_rate_limiter = None
+        if max_concurrent_decrypts is not None:
+            self.decrypt_concurrency_limiter = ConcurrencyLimiter(
+                max_concurrent_decrypts
+            )
+        else:
+            self.decrypt_concurrency_limiter = None
+        self.decrypt_queue_timeout = decrypt_queue_timeout
+        self.tracer = tracer
+        self.cache_trace = cache_trace
         self._validate()
 
+    @property
+    def kms_client(self):
+        """
+        The KMS client, created when it's first needed, and again in a forked
+        child, since its connections can't be shared with the parent.
+        """
+        if (self._kms_client is None or
+                self._kms_client_generation not in (
+                    None,
+                    forksafe.generation()
+                )):
+            self._kms_client = _get_kms_client(
+                self.region,
+                self.aws_creds,
+                **self._kms_client_kwargs
+            )
+            self._kms_client_generation = forksafe.generation()
+        return self._kms_client
+
+    @kms_client.setter
+    def kms_client(self, kms_client):
+        self._kms_client = kms_client
+        # Clients set explicitly are responsible for their own fork safety.
+        self._kms_client_generation = None
+
     def _validate(self):
         for key in ['from', 'to', 'user_type']:
             if key in self.extra_context:
                 logging.warning(
                     '{0} in extra_context will be ignored.'.format(key)
                 )
-        if self.minimum_token_version < 1 or self.minimum_token_version > 2:
+        if (self.minimum_token_version < 1 or
+                self.minimum_token_version > MAX_TOKEN_VERSION):
             raise ConfigurationError(
                 'Invalid minimum_token_version provided.'
             )
-        if self.maximum_token_version < 1 or self.maximum_token_version > 2:
+        if (self.maximum_token_version < 1 or
+                self.maximum_token_version > MAX_TOKEN_VERSION):
             raise ConfigurationError(
                 'Invalid maximum_token_version provided.'
             )
@@ -155,8 +362,26 @@ class KMSTokenValidator(object):
         self.auth_key = self._format_auth_key(self.auth_key)
         self.user_auth_key = self._format_auth_key(self.user_auth_key)
 
+    def _build_token_cache(self, size):
+        if self.token_cache_policy == 'lru':
+            factory = LRU
+        elif self.token_cache_policy == 'tinylfu':
+            factory = WTinyLFUCache
+        else:
+            raise ConfigurationError(
+                'token_cache_policy must be lru or tinylfu.'
+            )
+        return ShardedCache(factory, size, shards=self.token_cache_shards)
+
+    def _token_cache(self, user_type):
+        """The token cache partition for a user_type."""
+        cache = self.TOKEN_PARTITIONS.get(user_type)
+        if cache is None:
+            return self.TOKENS
+        return cache
+
     def _format_auth_key(self, keys):
-        if isinstance(keys, six.string_types):
+        if isinstance(keys, str):
             logging.debug(
                 'Passing auth key as string is deprecated, and will be removed'
                 ' in 1.0.0'
@@ -168,16 +393,44 @@ class KMSTokenValidator(object):
             'auth_key and user_auth_key must be a string, list, or None'
         )
 
-    def _get_key_arn(self, key):
-        if key.startswith('arn:aws:kms:'):
+    def _get_key_arn(self, key, deadline=None):
+        if key.startswith('arn:aws:kms:') and not is_alias(key):
             self.KEY_METADATA[key] = {
                 'KeyMetadata': {'Arn': key}
             }
-        if key not in self.KEY_METADATA:
-            self.KEY_METADATA[key] = self.kms_client.describe_key(
-                KeyId='{0}'.format(key)
-            )
-        return self.KEY_METADATA[key]['KeyMetadata']['Arn']
+        metadata = self.KEY_METADATA.get(key)
+        if metadata is None and is_alias(key):
+            metadata = self._resolve_alias(key, deadline)
+        if metadata is None:
+            self._check_deadline(deadline)
+            with span(self.tracer, 'kmsauth.describe_key'):
+                metadata = self.kms_client.describe_key(
+                    KeyId='{0}'.format(key)
+                )
+            self.KEY_METADATA[key] = metadata
+        return metadata['KeyMetadata']['Arn']
+
+    def _resolve_alias(self, alias, deadline=None):
+        """
+        Look up an alias in the ARNs of all aliases, listed once per KMS
+        client. Returns None if it's not found there.
+        """
+        kms_client = self.kms_client
+        resolver = get_alias_resolver(kms_client)
+        if not resolver.loaded:
+            self._check_deadline(deadline)
+            with span(self.tracer, 'kmsauth.list_aliases'):
+                # Don't wait past the deadline for another thread's sweep.
+                resolver.load(
+                    kms_client,
+                    timeout=None if deadline is None else deadline.remaining()
+                )
+        key_arn = resolver.resolve(alias)
+        if key_arn is None:
+            return None
+        metadata = {'KeyMetadata': {'Arn': key_arn}}
+        self.KEY_METADATA[alias] = metadata
+        return metadata
 
     def _get_key_alias_from_cache(self, key_arn):
         '''
@@ -186,45 +439,194 @@ class KMSTokenValidator(object):
         its alias and is meant as a convenience function for turning an ARN
         that's already been looked up back into its alias.
         '''
-        for alias in self.KEY_METADATA:
-            if self.KEY_METADATA[alias]['KeyMetadata']['Arn'] == key_arn:
+        # Copied, since other threads may be adding keys.
+        for alias, metadata in list(self.KEY_METADATA.items()):
+            if metadata['KeyMetadata']['Arn'] == key_arn:
                 return alias
         return None
 
-    def _valid_service_auth_key(self, key_arn):
+    def _valid_service_auth_key(self, key_arn, deadline=None):
         if self.auth_key is None:
             return False
         for key in self.auth_key:
-            if key_arn == self._get_key_arn(key):
+            if key_arn == self._get_key_arn(key, deadline=deadline):
                 return True
         for key in self.scoped_auth_keys:
-            if key_arn == self._get_key_arn(key):
+            if key_arn == self._get_key_arn(key, deadline=deadline):
                 return True
         return False
 
-    def _valid_user_auth_key(self, key_arn):
+    def _valid_user_auth_key(self, key_arn, deadline=None):
         if self.user_auth_key is None:
             return False
         for key in self.user_auth_key:
-            if key_arn == self._get_key_arn(key):
+            if key_arn == self._get_key_arn(key, deadline=deadline):
                 return True
         return False
 
+    def _check_deadline(self, deadline):
+        if deadline is not None and deadline.expired():
+            logging.warning('Deadline exceeded validating token.')
+            if self.stats:
+                self.stats.incr('token_validation_deadline_exceeded')
+            raise DeadlineExceededError(
+                'Authentication error. Deadline exceeded.'
+            )
+
     def _parse_username(self, username):
-        username_arr = username.split('/')
-        if len(username_arr) == 3:
-            # V2 token format: version/service/myservice or version/user/myuser
-            version = int(username_arr[0])
-            user_type = username_arr[1]
-            _from = username_arr[2]
-        elif len(username_arr) == 1:
-            # Old format, specific to services: myservice
-            version = 1
-            _from = username_arr[0]
-            user_type = 'service'
-        else:
+        match = None
+        if isinstance(username, str):
+            match = _USERNAME_RE.match(username)
+        if match is None:
             raise TokenValidationError('Unsupported username format.')
-        return version, user_type, _from
+        version, user_type, _from = match.groups()
+        if version is not None:
+            # V2 token format: version/service/myservice or version/user/myuser
+            version = int(version)
+            if version >= 3:
+                # V3 token format: 3/s/myservice or 3/u/myuser
+                user_type = _USER_TYPES.get(user_type, user_type)
+            return version, user_type, _from
+        # Old format, specific to services: myservice
+        return 1, 'service', _from
+
+    def _precheck_token(self, token):
+        '''
+        Cheaply reject tokens that can't be KMS ciphertexts, before hashing
+        them or sending them to KMS: check their length, base64 alphabet and
+        padding, and the ciphertext's version byte.
+        '''
+        if _check_token_format(token) is None:
+            if self.stats:
+                self.stats.incr('token_precheck_rejected')
+            raise TokenValidationError(
+                'Authentication error. Invalid token format.'
+            )
+
+    def _get_stale_token(self, token_key):
+        '''
+        Find a previously validated token's cache entry in the stale token
+        cache. This is only used when KMS is unavailable; the caller is still
+        responsible for checking the token's time validity.
+        '''
+        if self.STALE_TOKENS is None:
+            return None
+        entry = self.STALE_TOKENS.get(token_key)
+        if entry is None:
+            return None
+        logging.warning('Using stale token cache, KMS is unavailable.')
+        if self.stats:
+            self.stats.incr('token_cache_stale_hit')
+        return entry
+
+    def _check_decrypt_rate_limit(self, user_type, _from):
+        '''
+        Admit a KMS decrypt for the given user, or raise
+        RateLimitExceededError if the user, or all users, are over their limit.
+        '''
+        if (self.decrypt_rate_limiter is not None and
+                not self.decrypt_rate_limiter.try_acquire((user_type, _from))):
+            logging.warning(
+                'KMS decrypt rate limit exceeded for {0} {1}.'.format(
+                    user_type,
+                    _from
+                )
+            )
+            if self.stats:
+                self.stats.incr('kms_decrypt_rate_limited')
+            raise RateLimitExceededError(
+                'Authentication error. Rate limit exceeded.'
+            )
+        if (self.global_decrypt_rate_limiter is not None and
+                not self.global_decrypt_rate_limiter.try_acquire()):
+            logging.warning('Global KMS decrypt rate limit exceeded.')
+            if self.stats:
+                self.stats.incr('kms_decrypt_rate_limited_global')
+            raise RateLimitExceededError(
+                'Authentication error. Rate limit exceeded.'
+            )
+
+    def _acquire_decrypt_slot(self, deadline=None):
+        '''
+        Wait for a KMS decrypt slot, or raise ServiceOverloadedError if one
+        doesn't free up within decrypt_queue_timeout.
+        '''
+        limiter = self.decrypt_concurrency_limiter
+        timeout = self.decrypt_queue_timeout
+        if deadline is not None:
+            if timeout is None:
+                timeout = deadline.remaining()
+            else:
+                timeout = min(timeout, deadline.remaining())
+        if self.stats:
+            self.stats.gauge('kms_decrypt_queue_depth', limiter.waiting)
+        start = time.monotonic()
+        acquired = limiter.acquire(timeout)
+        if self.stats:
+            self.stats.timing(
+                'kms_decrypt_queue_wait',
+                (time.monotonic() - start) * 1000
+            )
+        if not acquired:
+            self._check_deadline(deadline)
+            logging.warning('Too many concurrent KMS decrypts.')
+            if self.stats:
+                self.stats.incr('kms_decrypt_shed')
+            raise ServiceOverloadedError(
+                'Authentication error. Service overloaded.'
+            )
+
+    def _kms_decrypt(self, ciphertext, context, deadline=None):
+        self._check_deadline(deadline)
+        limiter = self.decrypt_concurrency_limiter
+        if limiter is not None:
+            with span(self.tracer, 'kmsauth.kms_decrypt_queue'):
+                self._acquire_decrypt_slot(deadline)
+        try:
+            with span(self.tracer, 'kmsauth.kms_decrypt'):
+                if self.stats:
+                    with self.stats.timer('kms_decrypt_token'):
+                        return self.kms_client.decrypt(
+                            CiphertextBlob=ciphertext,
+                            EncryptionContext=context
+                        )
+                return self.kms_client.decrypt(
+                    CiphertextBlob=ciphertext,
+                    EncryptionContext=context
+                )
+        finally:
+            if limiter is not None:
+                limiter.release()
+
+    def warm_up(self, tokens=None):
+        '''
+        Prepare the validator before forking worker processes, so that they
+        inherit its caches: look up the ARNs of all of its auth keys, and
+        validate (and cache) tokens, an iterable of (username, token) or
+        (username, token, to_auth_context) tuples. The KMS client is rebuilt
+        in each worker. Failures are logged, and anything that couldn't be
+        warmed up is looked up on demand instead. Returns the number of tokens
+        validated.
+        '''
+        keys = (
+            list(self.auth_key or []) +
+            list(self.user_auth_key or []) +
+            list(self.scoped_auth_keys or {})
+        )
+        for key in keys:
+            try:
+                self._get_key_arn(key)
+            except Exception:
+                logging.exception('Failed to look up KMS key {0}.'.format(key))
+        validated = 0
+        for token_args in tokens or []:
+            try:
+                self.decrypt_token(*token_args)
+            except (TokenValidationError, ConfigurationError):
+                logging.exception('Failed to validate token during warm up.')
+            else:
+                validated += 1
+        return validated
 
     def extract_username_field(self, username, field):
         version, user_type, _from = self._parse_username(username)
@@ -236,57 +638,132 @@ class KMSTokenValidator(object):
             return version
         return None
 
-    def decrypt_token(self, username, token):
+    def decrypt_token(self, username, token, to_auth_context=None,
+                      timeout=None):
         '''
         Decrypt a token.
+
+        to_auth_context overrides the validator's to_auth_context for this
+        call, for validators that serve more than one audience.
+
+        timeout is the maximum time to spend on this call, in seconds. If it
+        runs out before a KMS call is made, DeadlineExceededError is raised
+        instead. KMS calls already in progress aren't interrupted; they're
+        bounded by the client's connect_timeout and read_timeout.
         '''
-        version, user_type, _from = self._parse_username(username)
-        if (version > self.maximum_token_version or
-                version < self.minimum_token_version):
-            raise TokenValidationError('Unacceptable token version.')
-        if self.stats:
-            self.stats.incr('token_version_{0}'.format(version))
+        deadline = from_timeout(timeout)
+        if self.tracer is None:
+            return self._decrypt_token(
+                username,
+                token,
+                to_auth_context,
+                deadline
+            )
+        with self.tracer.start_as_current_span('kmsauth.decrypt_token') as root:
+            return self._decrypt_token(
+                username,
+                token,
+                to_auth_context,
+                deadline,
+                root
+            )
+
+    def _token_key(self, token, _from, to_auth_context, user_type):
         try:
-            token_key = '{0}{1}{2}{3}'.format(
+            # The fields are kept separate, rather than concatenated, so that
+            # different from and to values can't produce the same key.
+            return (
                 hashlib.sha256(ensure_bytes(token)).hexdigest(),
                 _from,
-                self.to_auth_context,
+                to_auth_context,
                 user_type
             )
         except Exception:
             raise TokenValidationError('Authentication error.')
-        if token_key not in self.TOKENS:
+
+    def _lookup_token(self, token_key):
+        entry = self._token_cache(token_key[3]).get(token_key)
+        if self.stats:
+            if token_key[3] in self.TOKEN_PARTITIONS:
+                partition = token_key[3]
+            else:
+                partition = 'default'
+            self.stats.incr('token_cache_{0}.{1}'.format(
+                'miss' if entry is None else 'hit',
+                partition
+            ))
+        return entry
+
+    def _check_validity(self, not_before, not_after):
+        if not_after - not_before > self.auth_token_max_lifetime * 60:
+            logging.warning('Token used which exceeds max token lifetime.')
+            raise TokenValidationError(
+                'Authentication error. Token lifetime exceeded.'
+            )
+        now = time.time()
+        if (now < not_before) or (now > not_after):
+            logging.warning('Invalid time validity for token.')
+            raise TokenValidationError(
+                'Authentication error. Invalid time validity for token.'
+            )
+
+    def _decrypt_token(self, username, token, to_auth_context, deadline,
+                       root=None):
+        # The cache hit path is the hot path, so when tracing is disabled its
+        # phases are called directly, rather than in no-op spans.
+        tracer = self.tracer
+        if to_auth_context is None:
+            to_auth_context = self.to_auth_context
+            if to_auth_context is None:
+                raise ConfigurationError(
+                    'to_auth_context must be set on the validator or passed'
+                    ' to decrypt_token.'
+                )
+        version, user_type, _from = self._parse_username(username)
+        if (version > self.maximum_token_version or
+                version < self.minimum_token_version):
+            raise TokenValidationError('Unacceptable token version.')
+        if self.stats:
+            self.stats.incr('token_version_{0}'.format(version))
+        self._precheck_token(token)
+        if tracer is None:
+            token_key = self._token_key(token, _from, to_auth_context,
+                                        user_type)
+            entry = self._lookup_token(token_key)
+        else:
+            root.set_attribute('kmsauth.token_version', version)
+            root.set_attribute('kmsauth.user_type', user_type)
+            with tracer.start_as_current_span('kmsauth.hash_token'):
+                token_key = self._token_key(token, _from, to_auth_context,
+                                            user_type)
+            with tracer.start_as_current_span('kmsauth.token_cache_lookup'):
+                entry = self._lookup_token(token_key)
+            root.set_attribute('kmsauth.cache_hit', entry is not None)
+        cached = entry is not None
+        from_kms = False
+        if not cached:
+            self._check_decrypt_rate_limit(user_type, _from)
             try:
                 token = base64.b64decode(token)
                 # Ensure normal context fields override whatever is in
                 # extra_context.
                 context = copy.deepcopy(self.extra_context)
-                context['to'] = self.to_auth_context
+                context['to'] = to_auth_context
                 context['from'] = _from
                 if version > 1:
                     context['user_type'] = user_type
-                if self.stats:
-                    with self.stats.timer('kms_decrypt_token'):
-                        data = self.kms_client.decrypt(
-                            CiphertextBlob=token,
-                            EncryptionContext=context
-                        )
-                else:
-                    data = self.kms_client.decrypt(
-                        CiphertextBlob=token,
-                        EncryptionContext=context
-                    )
+                data = self._kms_decrypt(token, context, deadline)
                 # Decrypt doesn't take KeyId as an argument. We need to verify
                 # the correct key was used to do the decryption.
                 # Annoyingly, the KeyId from the data is actually an arn.
                 key_arn = data['KeyId']
                 if user_type == 'service':
-                    if not self._valid_service_auth_key(key_arn):
+                    if not self._valid_service_auth_key(key_arn, deadline):
                         raise TokenValidationError(
                             'Authentication error (wrong KMS key).'
                         )
                 elif user_type == 'user':
-                    if not self._valid_user_auth_key(key_arn):
+                    if not self._valid_user_auth_key(key_arn, deadline):
                         raise TokenValidationError(
                             'Authentication error (wrong KMS key).'
                         )
@@ -294,17 +771,29 @@ class KMSTokenValidator(object):
                     raise TokenValidationError(
                         'Authentication error. Unsupported user_type.'
                     )
-                plaintext = data['Plaintext']
-                payload = json.loads(plaintext)
-                key_alias = self._get_key_alias_from_cache(key_arn)
-                ret = {'payload': payload, 'key_alias': key_alias}
+                with span(self.tracer, 'kmsauth.parse_payload'):
+                    plaintext = data['Plaintext']
+                    key_alias = self._get_key_alias_from_cache(key_arn)
+                    if version >= 3:
+                        entry = self._make_binary_cache_entry(
+                            plaintext,
+                            key_alias
+                        )
+                    else:
+                        payload = json.loads(plaintext)
+                        ret = {'payload': payload, 'key_alias': key_alias}
+                        entry = self._make_cache_entry(ret)
+                from_kms = True
             except TokenValidationError:
                 raise
-            except (ConnectionError, EndpointConnectionError):
+            except kmsauth.services.connection_errors():
                 logging.exception('Failure connecting to AWS endpoint.')
-                raise TokenValidationError(
-                    'Authentication error. Failure connecting to AWS endpoint.'
-                )
+                entry = self._get_stale_token(token_key)
+                if entry is None:
+                    raise TokenValidationError(
+                        'Authentication error. Failure connecting to AWS'
+                        ' endpoint.'
+                    )
             # We don't care what exception is thrown. For paranoia's sake, fail
             # here.
             except Exception:
@@ -312,18 +801,31 @@ class KMSTokenValidator(object):
                 raise TokenValidationError(
                     'Authentication error. General error.'
                 )
+        ret, not_before, not_after = entry
+        if self.cache_trace is not None:
+            self.cache_trace.record(token_key, not_after)
+        if tracer is None:
+            self._check_validity(not_before, not_after)
         else:
-            ret = self.TOKENS[token_key]
-        now = datetime.datetime.utcnow()
+            with tracer.start_as_current_span('kmsauth.validate_time'):
+                self._check_validity(not_before, not_after)
+        if not cached:
+            # Cache hits were already moved to the front of the cache by the
+            # lookup.
+            self._token_cache(user_type)[token_key] = entry
+        if from_kms and self.STALE_TOKENS is not None:
+            self.STALE_TOKENS[token_key] = entry
+        return ret
+
+    def _make_cache_entry(self, ret):
+        """
+        Build a token cache entry: the decrypted token, along with its
+        not_before and not_after as epoch seconds, so that cache hits don't
+        need to parse timestamps.
+        """
         try:
-            not_before = datetime.datetime.strptime(
-                ret['payload']['not_before'],
-                TIME_FORMAT
-            )
-            not_after = datetime.datetime.strptime(
-                ret['payload']['not_after'],
-                TIME_FORMAT
-            )
+            not_before = parse_timestamp(ret['payload']['not_before'])
+            not_after = parse_timestamp(ret['payload']['not_after'])
         except Exception:
             logging.exception(
                 'Failed to get not_before and not_after from token payload.'
@@ -331,19 +833,34 @@ class KMSTokenValidator(object):
             raise TokenValidationError(
                 'Authentication error. Missing validity.'
             )
-        delta = (not_after - not_before).seconds / 60
-        if delta > self.auth_token_max_lifetime:
-            logging.warning('Token used which exceeds max token lifetime.')
-            raise TokenValidationError(
-                'Authentication error. Token lifetime exceeded.'
+        return (ret, not_before, not_after)
+
+    def _make_binary_cache_entry(self, plaintext, key_alias):
+        """
+        Build a token cache entry from a version 3 token's binary payload.
+        The returned payload has the same formatted not_before and not_after
+        as older tokens' JSON payloads.
+        """
+        try:
+            _format, flags, not_before, not_after = _BINARY_PAYLOAD.unpack(
+                ensure_bytes(plaintext)
             )
-        if (now < not_before) or (now > not_after):
-            logging.warning('Invalid time validity for token.')
+        except struct.error:
+            _format = None
+        if (_format != BINARY_PAYLOAD_FORMAT or
+                flags & ~BINARY_PAYLOAD_FLAGS):
+            logging.warning('Unsupported binary token payload.')
             raise TokenValidationError(
-                'Authentication error. Invalid time validity for token.'
+                'Authentication error. Invalid payload.'
             )
-        self.TOKENS[token_key] = ret
-        return self.TOKENS[token_key]
+        ret = {
+            'payload': {
+                'not_before': format_timestamp(not_before),
+                'not_after': format_timestamp(not_after),
+            },
+            'key_alias': key_alias
+        }
+        return (ret, not_before, not_after)
 
 
 class KMSTokenGenerator(object):
@@ -359,7 +876,9 @@ class KMSTokenGenerator(object):
             token_cache_file=None,
             token_lifetime=10,
             aws_creds=None,
-            endpoint_url=None
+            endpoint_url=None,
+            kms_transport=None,
+            tracer=None,
             ):
         """Create a KMSTokenGenerator object.
 
@@ -369,16 +888,28 @@ class KMSTokenGenerator(object):
             auth_context: The KMS encryption context to use for authentication.
                 Required.
             region: AWS region to connect to. Required.
-            token_version: The version of the authentication token. Default: 2
+            token_version: The version of the authentication token. Version 3
+                tokens have a compact binary payload and shorter usernames,
+                but are only accepted by validators with a
+                maximum_token_version of 3. Default: 2
             token_cache_file: he location to use for caching the auth token.
                 If set to empty string, no cache will be used. Default: None
             token_lifetime: Lifetime of the authentication token generated.
                 Default: 10
             aws_creds: A dict of AccessKeyId, SecretAccessKey, SessionToken.
                 Useful if you wish to pass in assumed role credentials or MFA
-                credentials. Default: None
+                credentials. This can also be a callable returning such a
+                dict, with an optional Expiration, in which case the
+                credentials are refreshed as they expire, reusing the same
+                KMS client. Default: None
             endpoint_url: A URL to override the default endpoint used to access
                 the KMS service. Default: None
+            kms_transport: The object used to make KMS calls, see
+                kmsauth.transport. If set, aws_creds and endpoint_url are
+                ignored. Default: None, which uses a boto3 KMS client.
+            tracer: An OpenTelemetry-compatible tracer, used to trace each
+                phase of token generation; see kmsauth.utils.tracing.
+                Default: None
         """
         self.auth_key = auth_key
         if auth_context is None:
@@ -390,23 +921,38 @@ class KMSTokenGenerator(object):
         self.region = region
         self.token_version = token_version
         self.aws_creds = aws_creds
-        if aws_creds:
-            self.kms_client = kmsauth.services.get_boto_client(
-                'kms',
-                region=self.region,
-                aws_access_key_id=self.aws_creds['AccessKeyId'],
-                aws_secret_access_key=self.aws_creds['SecretAccessKey'],
-                aws_session_token=self.aws_creds['SessionToken'],
-                endpoint_url=endpoint_url
-            )
-        else:
-            self.kms_client = kmsauth.services.get_boto_client(
-                'kms',
-                region=self.region,
-                endpoint_url=endpoint_url
-            )
+        # The KMS client is created on first use; see kms_client.
+        self._kms_client = kms_transport
+        self._kms_client_generation = None
+        self._kms_client_kwargs = dict(endpoint_url=endpoint_url)
+        self.tracer = tracer
         self._validate()
 
+    @property
+    def kms_client(self):
+        """
+        The KMS client, created when it's first needed, and again in a forked
+        child, since its connections can't be shared with the parent.
+        """
+        if (self._kms_client is None or
+                self._kms_client_generation not in (
+                    None,
+                    forksafe.generation()
+                )):
+            self._kms_client = _get_kms_client(
+                self.region,
+                self.aws_creds,
+                **self._kms_client_kwargs
+            )
+            self._kms_client_generation = forksafe.generation()
+        return self._kms_client
+
+    @kms_client.setter
+    def kms_client(self, kms_client):
+        self._kms_client = kms_client
+        # Clients set explicitly are responsible for their own fork safety.
+        self._kms_client_generation = None
+
     def _validate(self):
         for key in ['from', 'to']:
             if key not in self.auth_context:
@@ -418,57 +964,74 @@ class KMSTokenGenerator(object):
                 raise ConfigurationError(
                     'user_type missing from auth_context.'
                 )
-        if self.token_version > 2:
+        if self.token_version > MAX_TOKEN_VERSION:
             raise ConfigurationError(
                 'Invalid token_version provided.'
             )
 
     def _get_cached_token(self):
-        token = None
+        return self._read_token_cache()[0]
+
+    def _read_token_cache(self):
+        """
+        Get a usable token from the token cache file, along with the epoch
+        time until which it's usable, or (None, None).
+        """
         if not self.token_cache_file:
-            return token
+            return None, None
         try:
             with open(self.token_cache_file, 'r') as f:
                 token_data = json.load(f)
             _not_after = token_data['not_after']
             _auth_context = token_data['auth_context']
             _token = token_data['token']
-            _not_after_cache = datetime.datetime.strptime(
-                _not_after,
-                TIME_FORMAT
-            )
+            _not_after_cache = parse_timestamp(_not_after)
         except IOError as e:
             logging.debug(
                 'Failed to read confidant auth token cache: {0}'.format(e)
             )
-            return token
+            return None, None
         except Exception:
             logging.exception('Failed to read confidant auth token cache.')
-            return token
-        skew_delta = datetime.timedelta(minutes=TOKEN_SKEW)
-        _not_after_cache = _not_after_cache - skew_delta
-        now = datetime.datetime.utcnow()
+            return None, None
+        _not_after_cache = _not_after_cache - TOKEN_SKEW * 60
+        now = time.time()
         if (now <= _not_after_cache and
                 _auth_context == self.auth_context):
             logging.debug('Using confidant auth token cache.')
-            token = _token
-        return token
+            return _token, _not_after_cache
+        return None, None
 
     def _cache_token(self, token, not_after):
         if not self.token_cache_file:
             return
+        tmp_path = None
         try:
             cachedir = os.path.dirname(self.token_cache_file)
-            if not os.path.exists(cachedir):
-                os.makedirs(cachedir)
-            with open(self.token_cache_file, 'w') as f:
+            if cachedir:
+                os.makedirs(cachedir, exist_ok=True)
+            # Write to a temporary file and rename it into place, so that
+            # concurrent readers never see a partially written cache.
+            fd, tmp_path = tempfile.mkstemp(
+                dir=cachedir or '.',
+                prefix='.kmsauth-token-'
+            )
+            with os.fdopen(fd, 'w') as f:
                 json.dump({
                     'token': ensure_text(token),
                     'not_after': not_after,
                     'auth_context': self.auth_context
                 }, f)
+            os.replace(tmp_path, self.token_cache_file)
+            tmp_path = None
         except Exception:
             logging.exception('Failed to write confidant auth token cache.')
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
 
     def get_username(self):
         """Get a username formatted for a specific token version."""
@@ -482,48 +1045,81 @@ class KMSTokenGenerator(object):
                 _user_type,
                 _from
             )
+        elif self.token_version == 3:
+            _user_type = self.auth_context['user_type']
+            return '{0}/{1}/{2}'.format(
+                self.token_version,
+                _USER_TYPE_CODES.get(_user_type, _user_type),
+                _from
+            )
 
-    def get_token(self):
-        """Get an authentication token."""
-        # Generate string formatted timestamps for not_before and not_after,
-        # for the lifetime specified in minutes.
-        now = datetime.datetime.utcnow()
+    def _mint_token(self, deadline=None):
+        """
+        Generate a new authentication token with KMS, bypassing the token
+        cache. Returns the token and its not_after, in epoch seconds.
+        """
+        if deadline is not None and deadline.expired():
+            raise DeadlineExceededError('Deadline exceeded generating token.')
+        # Generate not_before and not_after epoch timestamps, for the lifetime
+        # specified in minutes.
+        now = time.time()
         # Start the not_before time x minutes in the past, to avoid clock skew
         # issues.
-        _not_before = now - datetime.timedelta(minutes=TOKEN_SKEW)
-        not_before = _not_before.strftime(TIME_FORMAT)
+        not_before = int(now - TOKEN_SKEW * 60)
         # Set the not_after time in the future, by the lifetime, but ensure the
         # skew we applied to not_before is taken into account.
-        _not_after = now + datetime.timedelta(
-            minutes=self.token_lifetime - TOKEN_SKEW
-        )
-        not_after = _not_after.strftime(TIME_FORMAT)
-        # Generate a json string for the encryption payload contents.
-        payload = json.dumps({
-            'not_before': not_before,
-            'not_after': not_after
-        })
-        token = self._get_cached_token()
-        if token:
-            return token
+        not_after = int(now + (self.token_lifetime - TOKEN_SKEW) * 60)
+        if self.token_version >= 3:
+            payload = _BINARY_PAYLOAD.pack(
+                BINARY_PAYLOAD_FORMAT,
+                BINARY_PAYLOAD_FLAGS,
+                not_before,
+                not_after
+            )
+        else:
+            # Generate a json string for the encryption payload contents.
+            payload = json.dumps({
+                'not_before': format_timestamp(not_before),
+                'not_after': format_timestamp(not_after)
+            })
         # Generate a base64 encoded KMS encrypted token to use for
         # authentication. We encrypt the token lifetime information as the
         # payload for verification in Confidant.
         try:
-            token = self.kms_client.encrypt(
-                KeyId=self.auth_key,
-                Plaintext=payload,
-                EncryptionContext=self.auth_context
-            )['CiphertextBlob']
+            with span(self.tracer, 'kmsauth.kms_encrypt'):
+                token = self.kms_client.encrypt(
+                    KeyId=self.auth_key,
+                    Plaintext=payload,
+                    EncryptionContext=self.auth_context
+                )['CiphertextBlob']
             token = base64.b64encode(ensure_bytes(token))
-        except (ConnectionError, EndpointConnectionError) as e:
+        except kmsauth.services.connection_errors() as e:
             logging.exception('Failure connecting to AWS: {}'.format(str(e)))
             raise ServiceConnectionError()
         except Exception:
             logging.exception('Failed to create auth token.')
             raise TokenGenerationError()
-        self._cache_token(token, not_after)
-        return token
+        return token, not_after
+
+    def get_token(self, timeout=None):
+        """
+        Get an authentication token.
+
+        timeout is the maximum time to spend on this call, in seconds. If it
+        runs out before KMS is called, DeadlineExceededError is raised
+        instead.
+        """
+        deadline = from_timeout(timeout)
+        with span(self.tracer, 'kmsauth.get_token') as root:
+            with span(self.tracer, 'kmsauth.token_cache_read'):
+                token = self._get_cached_token()
+            root.set_attribute('kmsauth.cache_hit', bool(token))
+            if token:
+                return token
+            token, not_after = self._mint_token(deadline)
+            with span(self.tracer, 'kmsauth.token_cache_write'):
+                self._cache_token(token, format_timestamp(not_after))
+            return token
 
 
 class ServiceConnectionError(Exception):
@@ -543,8 +1139,32 @@ class TokenValidationError(Exception):
     pass
 
 
+class RateLimitExceededError(TokenValidationError):
+    """
+    An exception raised when a token wasn't validated, because KMS decrypts
+    for its user are over their rate limit.
+    """
+    pass
+
+
+class ServiceOverloadedError(TokenValidationError):
+    """
+    An exception raised when a token wasn't validated, because too many KMS
+    decrypts were already in progress.
+    """
+    pass
+
+
 class TokenGenerationError(Exception):
 
     """An exception raised when a token was unsuccessfully generated."""
 
     pass
+
+
+class DeadlineExceededError(TokenValidationError, TokenGenerationError):
+    """
+    An exception raised when a call's timeout ran out before it could finish
+    validating or generating a token.
+    """
+    pass
@@ -0,0 +1,244 @@
+"""
+A host-local token agent.
+
+The agent keeps a KMSTokenBroker warm for a configured identity and set of
+"to" contexts, and hands out ready tokens over a Unix socket, so that
+short-lived processes don't need to load boto3 or call KMS to get a token.
+AgentTokenGenerator is a drop-in replacement for KMSTokenGenerator, which gets
+its tokens from the agent, and mints them itself if the agent can't provide
+one.
+
+Run the agent with the ``kmsauth-agent`` command; see
+``kmsauth-agent --help``.
+"""
+import argparse
+import copy
+import logging
+import threading
+
+import kmsauth
+from kmsauth.broker import KMSTokenBroker
+from kmsauth.daemon import error_response, run
+from kmsauth.utils.framing import (
+    DaemonUnavailableError,
+    FrameClient,
+    UnixFrameServer,
+)
+
+DEFAULT_SOCKET_PATH = '/var/run/kmsauth/agent.sock'
+
+
+class TokenAgent(object):
+
+    """A Unix socket server for a KMSTokenBroker."""
+
+    def __init__(
+            self,
+            broker,
+            socket_path=DEFAULT_SOCKET_PATH,
+            socket_mode=0o600,
+            refresh_interval=10,
+            allow_unlisted=False,
+            ):
+        """Create a TokenAgent object.
+
+        Args:
+            broker: The KMSTokenBroker to hand out tokens from. Required.
+            socket_path: The path of the Unix socket to listen on.
+            socket_mode: Permissions of the Unix socket. Anyone who can
+                connect to it can get tokens for the broker's identity.
+                Default: 0o600
+            refresh_interval: How often to check for tokens that are due to be
+                refreshed, in seconds. Default: 10
+            allow_unlisted: Whether to mint tokens for to contexts that the
+                broker wasn't configured with. Default: False
+        """
+        self.broker = broker
+        self.refresh_interval = refresh_interval
+        self.allow_unlisted = allow_unlisted
+        self.server = UnixFrameServer(
+            socket_path,
+            self.dispatch,
+            socket_mode=socket_mode
+        )
+        self._stopped = threading.Event()
+        self._refresher = None
+
+    def _matches(self, request):
+        """Check that a request is for the broker's identity."""
+        context = copy.deepcopy(request.get('auth_context') or {})
+        to = context.pop('to', None)
+        if (context != self.broker.auth_context or
+                request.get('token_version') != self.broker.token_version):
+            return None
+        if not self.allow_unlisted and to not in self.broker.to_auth_contexts:
+            return None
+        return to
+
+    def dispatch(self, request):
+        if request.get('op') != 'get_token':
+            return {
+                'ok': False,
+                'error': 'ConfigurationError',
+                'message': 'Unsupported operation.',
+            }
+        to = self._matches(request)
+        if to is None:
+            return {
+                'ok': False,
+                'error': 'ConfigurationError',
+                'message': 'auth_context is not served by this agent.',
+            }
+        try:
+            token = self.broker.get_token(to)
+        except (kmsauth.TokenGenerationError,
+                kmsauth.ServiceConnectionError) as e:
+            return error_response(e)
+        return {
+            'ok': True,
+            'token': kmsauth.ensure_text(token),
+            'username': self.broker.get_username(),
+        }
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.broker.refresh_due()
+            except Exception:
+                logging.exception('Failed to refresh tokens.')
+
+    def serve_forever(self):
+        self.broker.prefetch()
+        self._refresher = threading.Thread(target=self._refresh_loop)
+        self._refresher.daemon = True
+        self._refresher.start()
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self._stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+        self.broker.close()
+
+
+class AgentTokenGenerator(kmsauth.KMSTokenGenerator):
+
+    """
+    A KMSTokenGenerator that gets its tokens from the token agent, when it
+    can, and mints them itself otherwise.
+    """
+
+    def __init__(
+            self,
+            auth_key,
+            auth_context,
+            region,
+            socket_path=DEFAULT_SOCKET_PATH,
+            timeout=1.0,
+            retry_interval=5.0,
+            **kwargs
+            ):
+        """Create an AgentTokenGenerator object.
+
+        Args:
+            socket_path: The path of the agent's Unix socket.
+            timeout: Timeout for agent requests, in seconds. Default: 1.0
+            retry_interval: After failing to reach the agent, how long to mint
+                tokens in-process before trying it again, in seconds.
+                Default: 5.0
+
+        All other arguments are the same as KMSTokenGenerator's, and are used
+        when minting tokens in-process.
+        """
+        super(AgentTokenGenerator, self).__init__(
+            auth_key,
+            auth_context,
+            region,
+            **kwargs
+        )
+        self.client = FrameClient(
+            socket_path,
+            timeout=timeout,
+            retry_interval=retry_interval
+        )
+
+    def get_token(self, timeout=None):
+        """
+        Get an authentication token. timeout only applies to tokens minted
+        in-process; see KMSTokenGenerator.get_token.
+        """
+        try:
+            response = self.client.request({
+                'op': 'get_token',
+                'auth_context': self.auth_context,
+                'token_version': self.token_version,
+            })
+        except DaemonUnavailableError as e:
+            logging.debug('Minting token in-process: {0}'.format(e))
+            return super(AgentTokenGenerator, self).get_token(timeout)
+        if not response.get('ok'):
+            logging.debug('Minting token in-process: {0}'.format(
+                response.get('message')
+            ))
+            return super(AgentTokenGenerator, self).get_token(timeout)
+        return kmsauth.ensure_bytes(response['token'])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Serve kmsauth tokens over a Unix socket.'
+    )
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help='Path of the Unix socket to listen on.')
+    parser.add_argument('--socket-mode', default='600',
+                        type=lambda mode: int(mode, 8),
+                        help='Permissions of the Unix socket, in octal.')
+    parser.add_argument('--region', required=True,
+                        help='AWS region to connect to.')
+    parser.add_argument('--auth-key', required=True,
+                        help='KMS key used for authentication.')
+    parser.add_argument('--from', dest='from_context', required=True,
+                        help='The from context of the tokens.')
+    parser.add_argument('--user-type', default='service',
+                        help='The user_type context of the tokens.')
+    parser.add_argument('--to', action='append', default=[],
+                        help='A to context to serve tokens for. May be'
+                             ' repeated.')
+    parser.add_argument('--allow-unlisted', action='store_true',
+                        help='Mint tokens for to contexts not given by --to.')
+    parser.add_argument('--token-version', type=int, default=2)
+    parser.add_argument('--token-lifetime', type=int, default=10)
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--refresh-interval', type=float, default=10)
+    parser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    auth_context = {'from': args.from_context}
+    if args.token_version > 1:
+        auth_context['user_type'] = args.user_type
+    broker = KMSTokenBroker(
+        args.auth_key,
+        auth_context,
+        args.region,
+        to_auth_contexts=args.to,
+        token_version=args.token_version,
+        token_lifetime=args.token_lifetime,
+        endpoint_url=args.endpoint_url
+    )
+    agent = TokenAgent(
+        broker,
+        socket_path=args.socket,
+        socket_mode=args.socket_mode,
+        refresh_interval=args.refresh_interval,
+        allow_unlisted=args.allow_unlisted
+    )
+    logging.info('Listening on {0}'.format(args.socket))
+    run(agent)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+asyncio support.
+
+AsyncKMSTokenGenerator has the same tokens and usernames as KMSTokenGenerator,
+but its get_token is a coroutine: the token cache file and KMS are only
+accessed from an executor, never on the event loop, and concurrent calls that
+need a new token share a single mint.
+"""
+import asyncio
+import time
+
+import kmsauth
+
+
+class AsyncKMSTokenGenerator(object):
+
+    """An asyncio token generator for KMS auth."""
+
+    def __init__(
+            self,
+            auth_key,
+            auth_context,
+            region,
+            executor=None,
+            **kwargs
+            ):
+        """Create an AsyncKMSTokenGenerator object.
+
+        Args:
+            executor: The concurrent.futures executor used for file and KMS
+                I/O. Default: None, which uses the event loop's default
+                executor.
+
+        All other arguments are the same as KMSTokenGenerator's.
+        """
+        self.generator = kmsauth.KMSTokenGenerator(
+            auth_key,
+            auth_context,
+            region,
+            **kwargs
+        )
+        self.executor = executor
+        # The current token, and the epoch time after which it's no longer
+        # used.
+        self._token = None
+        self._expires_at = 0
+        self._mint = None
+
+    @property
+    def auth_context(self):
+        return self.generator.auth_context
+
+    @property
+    def token_version(self):
+        return self.generator.token_version
+
+    def get_username(self):
+        """Get a username formatted for a specific token version."""
+        return self.generator.get_username()
+
+    def _load_or_mint(self):
+        """Get a token from the file cache, or mint and cache one. Blocking."""
+        token, usable_until = self.generator._read_token_cache()
+        if token:
+            return kmsauth.ensure_bytes(token), usable_until
+        token, not_after = self.generator._mint_token()
+        self.generator._cache_token(
+            token,
+            kmsauth.format_timestamp(not_after)
+        )
+        # Like the file cache, stop using tokens TOKEN_SKEW minutes before
+        # they expire.
+        return token, not_after - kmsauth.TOKEN_SKEW * 60
+
+    async def _refresh(self):
+        loop = asyncio.get_running_loop()
+        token, expires_at = await loop.run_in_executor(
+            self.executor,
+            self._load_or_mint
+        )
+        self._token = token
+        self._expires_at = expires_at
+        return token
+
+    async def get_token(self, timeout=None):
+        """
+        Get an authentication token. If a token has to be minted, wait for at
+        most timeout seconds for it, then raise DeadlineExceededError; the
+        token is still cached once it's minted.
+        """
+        if self._token is not None and time.time() < self._expires_at:
+            return self._token
+        if self._mint is None or self._mint.done():
+            self._mint = asyncio.ensure_future(self._refresh())
+        try:
+            # Shielded, so that a caller that's cancelled or times out doesn't
+            # cancel the mint for other callers.
+            return await asyncio.wait_for(asyncio.shield(self._mint), timeout)
+        except asyncio.TimeoutError:
+            raise kmsauth.DeadlineExceededError(
+                'Deadline exceeded generating token.'
+            )
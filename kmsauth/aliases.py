@@ -0,0 +1,143 @@
+"""
+KMS key alias resolution.
+
+Validators need the ARN of every auth key they're configured with. Looking up
+each alias with describe_key costs a KMS call per alias, per validator.
+AliasResolver instead lists all of the account's aliases with ListAliases, a
+page of up to 100 at a time, and resolves every alias from that. Resolvers
+are shared by all validators in the process that use the same KMS client,
+and dropped along with it.
+"""
+import logging
+import threading
+import weakref
+
+from kmsauth.utils import forksafe
+
+# The maximum page size ListAliases allows.
+LIST_ALIASES_LIMIT = 100
+# Errors listing aliases that retrying won't fix.
+PERMANENT_ERROR_CODES = frozenset(['AccessDeniedException'])
+
+_resolvers = weakref.WeakKeyDictionary()
+
+
+def _error_code(e):
+    """The AWS error code of a boto3 ClientError or transport KMSError."""
+    code = getattr(e, 'code', None)
+    if code is None:
+        response = getattr(e, 'response', None)
+        if isinstance(response, dict):
+            code = response.get('Error', {}).get('Code')
+    return code
+
+
+def is_alias(key):
+    """Whether key is an alias name (alias/...) or alias ARN."""
+    return key.startswith('alias/') or (
+        key.startswith('arn:') and ':alias/' in key
+    )
+
+
+class AliasResolver(object):
+    """
+    Resolves KMS key aliases to key ARNs, from a single sweep of ListAliases.
+
+    Aliases are listed once, the first time one is resolved; aliases created
+    or updated afterwards aren't seen, and resolve returns None for them,
+    like for aliases in other accounts, so that callers can fall back to
+    describe_key.
+    """
+
+    def __init__(self):
+        # alias name and alias ARN -> key ARN, or None until aliases have been
+        # listed.
+        self.aliases = None
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Another thread may have held the lock at the time of the fork.
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self.aliases is not None
+
+    def load(self, kms_client, timeout=None):
+        """
+        List all aliases with kms_client, unless they've already been listed.
+        The client isn't kept, so that resolvers, which are keyed by their
+        client, don't keep it alive.
+
+        If another thread is already listing them, wait for at most timeout
+        seconds (forever, if it's None) for it to finish. If listing them
+        fails, no aliases are resolved; the next load tries again, unless
+        kms:ListAliases isn't allowed.
+        """
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            return
+        try:
+            if self.aliases is not None:
+                return
+            aliases = {}
+            try:
+                self._list_aliases(kms_client, aliases)
+            except Exception as e:
+                if _error_code(e) in PERMANENT_ERROR_CODES:
+                    logging.warning(
+                        'Not allowed to list KMS aliases; falling back to'
+                        ' describe_key: {0}'.format(e)
+                    )
+                    self.aliases = {}
+                else:
+                    logging.exception(
+                        'Failed to list KMS aliases; falling back to'
+                        ' describe_key until they can be listed.'
+                    )
+                return
+            self.aliases = aliases
+        finally:
+            self._lock.release()
+
+    def _list_aliases(self, kms_client, aliases):
+        marker = None
+        while True:
+            kwargs = {'Limit': LIST_ALIASES_LIMIT}
+            if marker is not None:
+                kwargs['Marker'] = marker
+            response = kms_client.list_aliases(**kwargs)
+            for alias in response.get('Aliases', []):
+                target = alias.get('TargetKeyId')
+                alias_arn = alias.get('AliasArn')
+                if not target or not alias_arn:
+                    # Not associated with a key.
+                    continue
+                # arn:aws:kms:<region>:<account>:alias/<name> ->
+                # arn:aws:kms:<region>:<account>:key/<target>
+                key_arn = '{0}:key/{1}'.format(
+                    alias_arn.rsplit(':', 1)[0],
+                    target
+                )
+                aliases[alias['AliasName']] = key_arn
+                aliases[alias_arn] = key_arn
+            next_marker = response.get('NextMarker')
+            if not response.get('Truncated') or next_marker in (None, marker):
+                return
+            marker = next_marker
+
+    def resolve(self, alias):
+        """
+        Return the key ARN for an alias name or alias ARN, or None if it's
+        not found. Aliases must have been loaded first.
+        """
+        return (self.aliases or {}).get(alias)
+
+
+def get_alias_resolver(kms_client):
+    """Get the AliasResolver shared by all users of kms_client."""
+    resolver = _resolvers.get(kms_client)
+    if resolver is None:
+        # setdefault, so that concurrent callers get the same resolver.
+        resolver = _resolvers.setdefault(kms_client, AliasResolver())
+    return resolver
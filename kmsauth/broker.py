@@ -0,0 +1,236 @@
+"""
+A token broker, for services that authenticate to many other services.
+
+KMSTokenBroker owns a KMSTokenGenerator per "to" context, keeps the current
+token for each of them in memory, and refreshes tokens in the background
+before they expire. Refresh times are jittered, so that tokens minted at the
+same time don't all need to be refreshed at the same time.
+"""
+import collections
+import concurrent.futures
+import copy
+import logging
+import random
+import threading
+import time
+
+import kmsauth
+from kmsauth.utils import forksafe
+
+_BrokerToken = collections.namedtuple(
+    '_BrokerToken',
+    ['token', 'refresh_at', 'expires_at']
+)
+
+
+class KMSTokenBroker(object):
+
+    """A class that mints and caches tokens for many "to" contexts."""
+
+    def __init__(
+            self,
+            auth_key,
+            auth_context,
+            region,
+            to_auth_contexts=None,
+            token_version=2,
+            token_lifetime=10,
+            aws_creds=None,
+            endpoint_url=None,
+            kms_transport=None,
+            max_workers=8,
+            refresh_jitter=0.25,
+            ):
+        """Create a KMSTokenBroker object.
+
+        Args:
+            auth_key: The KMS key ARN or alias to use for authentication.
+                Required.
+            auth_context: The KMS encryption context to use for
+                authentication, without the to context. Required.
+            region: AWS region to connect to. Required.
+            to_auth_contexts: A list of to contexts to mint tokens for. Tokens
+                for other to contexts are minted on demand. Default: None
+            token_version: The version of the authentication token. Default: 2
+            token_lifetime: Lifetime of the authentication tokens generated.
+                Default: 10
+            aws_creds: A dict of AccessKeyId, SecretAccessKey, SessionToken,
+                or a callable returning such a dict. Default: None
+            endpoint_url: A URL to override the default endpoint used to access
+                the KMS service. Default: None
+            kms_transport: The object used to make KMS calls, see
+                kmsauth.transport. Default: None
+            max_workers: The maximum number of tokens minted concurrently.
+                Default: 8
+            refresh_jitter: The fraction of a token's usable lifetime over
+                which its refresh is spread. Tokens are refreshed after between
+                (1 - refresh_jitter) and 1 times their usable lifetime.
+                Default: 0.25
+        """
+        if auth_context is None:
+            auth_context = {}
+        if 'to' in auth_context:
+            raise kmsauth.ConfigurationError(
+                'to must not be set in a broker\'s auth_context.'
+            )
+        if refresh_jitter < 0 or refresh_jitter > 1:
+            raise kmsauth.ConfigurationError(
+                'refresh_jitter must be between 0 and 1.'
+            )
+        self.auth_key = auth_key
+        self.auth_context = auth_context
+        self.region = region
+        self.token_version = token_version
+        self.token_lifetime = token_lifetime
+        self.aws_creds = aws_creds
+        self.endpoint_url = endpoint_url
+        self.kms_transport = kms_transport
+        self.max_workers = max_workers
+        self.refresh_jitter = refresh_jitter
+        self._generators = {}
+        self._tokens = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        forksafe.register(self)
+        # The username doesn't depend on the to context. This also validates
+        # auth_context.
+        self._username = self._build_generator(None).get_username()
+        for to in to_auth_contexts or []:
+            self._get_generator(to)
+
+    def _after_fork(self):
+        # The executor's threads, and the mints they were running, don't
+        # exist in a forked child. Minted tokens are kept.
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+
+    def _build_generator(self, to):
+        context = copy.deepcopy(self.auth_context)
+        context['to'] = to
+        return kmsauth.KMSTokenGenerator(
+            self.auth_key,
+            context,
+            self.region,
+            token_version=self.token_version,
+            token_lifetime=self.token_lifetime,
+            aws_creds=self.aws_creds,
+            endpoint_url=self.endpoint_url,
+            kms_transport=self.kms_transport
+        )
+
+    def _get_generator(self, to):
+        generator = self._generators.get(to)
+        if generator is None:
+            generator = self._build_generator(to)
+            with self._lock:
+                generator = self._generators.setdefault(to, generator)
+        return generator
+
+    def _mint(self, to):
+        token, not_after = self._get_generator(to)._mint_token()
+        now = time.time()
+        # Tokens are only usable until TOKEN_SKEW before their not_after,
+        # since validators with skewed clocks may consider them expired.
+        expires_at = not_after - kmsauth.TOKEN_SKEW * 60
+        lifetime = max(expires_at - now, 0)
+        refresh_at = now + lifetime * (
+            1 - self.refresh_jitter * random.random()
+        )
+        self._tokens[to] = _BrokerToken(token, refresh_at, expires_at)
+        return token
+
+    def _refresh(self, to):
+        """
+        Start minting a token for to, in the background, unless that's
+        already in progress. Returns a future for the new token.
+        """
+        with self._lock:
+            future = self._pending.get(to)
+            if future is not None:
+                return future
+            # Another thread may have just finished minting a token.
+            entry = self._tokens.get(to)
+            if entry is not None and time.time() < entry.refresh_at:
+                future = concurrent.futures.Future()
+                future.set_result(entry.token)
+                return future
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_workers
+                )
+            future = self._executor.submit(self._mint, to)
+            self._pending[to] = future
+        future.add_done_callback(lambda f: self._pending.pop(to, None))
+        return future
+
+    @property
+    def to_auth_contexts(self):
+        """The to contexts the broker has generators for."""
+        return self._generators.keys()
+
+    def get_username(self):
+        """Get the username to send along with the broker's tokens."""
+        return self._username
+
+    def get_token(self, to, timeout=None):
+        """
+        Get an authentication token for the to context. If a token has to be
+        minted, wait for at most timeout seconds for it, then raise
+        DeadlineExceededError; the token is still cached once it's minted.
+        """
+        entry = self._tokens.get(to)
+        if entry is not None:
+            now = time.time()
+            if now < entry.refresh_at:
+                return entry.token
+            if now < entry.expires_at:
+                # The token is still valid, so use it, but replace it soon.
+                self._refresh(to)
+                return entry.token
+        try:
+            return self._refresh(to).result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise kmsauth.DeadlineExceededError(
+                'Deadline exceeded generating token.'
+            )
+
+    def prefetch(self, to_auth_contexts=None):
+        """
+        Mint tokens, concurrently, for to contexts that don't have a current
+        token. By default, this covers every to context the broker knows of.
+        Failures are logged; those tokens will be minted on demand instead.
+        """
+        if to_auth_contexts is None:
+            to_auth_contexts = list(self._generators)
+        futures = {}
+        for to in to_auth_contexts:
+            self._get_generator(to)
+            entry = self._tokens.get(to)
+            if entry is None or time.time() >= entry.refresh_at:
+                futures[self._refresh(to)] = to
+        for future in concurrent.futures.as_completed(futures):
+            if future.exception() is not None:
+                logging.error(
+                    'Failed to mint token for {0}.'.format(futures[future])
+                )
+
+    def refresh_due(self):
+        """
+        Start refreshing tokens that are due for a refresh, without waiting
+        for them. This is meant to be called periodically, so that tokens are
+        replaced before they're needed.
+        """
+        now = time.time()
+        for to, entry in list(self._tokens.items()):
+            if now >= entry.refresh_at:
+                self._refresh(to)
+
+    def close(self):
+        """Stop the broker's worker threads."""
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+        if executor is not None:
+            executor.shutdown(wait=True)
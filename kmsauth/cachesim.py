@@ -0,0 +1,185 @@
+"""
+An offline token cache simulator.
+
+Replays a token cache trace, recorded with the validator's ``cache_trace``
+argument, against several cache policies (including the validator's
+``token_cache_policy`` options) and sizes, and reports the hit ratio
+and the number of KMS calls each would have made.
+
+Run it with the ``kmsauth-cachesim`` command; see ``kmsauth-cachesim --help``.
+"""
+import argparse
+import collections
+import heapq
+import itertools
+
+from kmsauth.utils import lru
+from kmsauth.utils.cachetrace import read_trace
+from kmsauth.utils.tinylfu import WTinyLFUCache
+
+
+class MappingPolicy(object):
+
+    """Simulates a cache with a mapping interface, such as an LRU."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def access(self, key, now, not_after):
+        """Access key, and return whether it was a hit."""
+        if key in self.cache:
+            self.cache[key]
+            return True
+        self.cache[key] = not_after
+        return False
+
+
+class TTLPolicy(object):
+
+    """
+    An LRU cache, which evicts expired tokens before the least recently used
+    one.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.cache = collections.OrderedDict()
+        self.expiries = []
+
+    def _evict_expired(self, now):
+        while self.expiries and self.expiries[0][0] < now:
+            not_after, key = heapq.heappop(self.expiries)
+            self.cache.pop(key, None)
+
+    def access(self, key, now, not_after):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return True
+        if len(self.cache) >= self.capacity:
+            self._evict_expired(now)
+            if len(self.cache) >= self.capacity:
+                self.cache.popitem(last=False)
+        self.cache[key] = not_after
+        heapq.heappush(self.expiries, (not_after, key))
+        if len(self.expiries) > 4 * self.capacity:
+            self.expiries = [(self.cache[k], k) for k in self.cache]
+            heapq.heapify(self.expiries)
+        return False
+
+
+class LFUPolicy(object):
+
+    """A least frequently used cache; ties are broken by insertion order."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []
+        self._seq = itertools.count()
+
+    def _evict(self):
+        while True:
+            count, _, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                del self.counts[key]
+                return
+
+    def access(self, key, now, not_after):
+        count = self.counts.get(key)
+        hit = count is not None
+        if not hit:
+            if len(self.counts) >= self.capacity:
+                self._evict()
+            count = 0
+        self.counts[key] = count + 1
+        heapq.heappush(self.heap, (count + 1, next(self._seq), key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [
+                (c, next(self._seq), k) for k, c in self.counts.items()
+            ]
+            heapq.heapify(self.heap)
+        return hit
+
+
+def _lru_dict(capacity):
+    from lru import LRU
+    return MappingPolicy(LRU(capacity))
+
+
+POLICIES = collections.OrderedDict([
+    ('lru', lambda capacity: MappingPolicy(lru.LRUCache(capacity))),
+    ('lru-dict', _lru_dict),
+    ('ttl', TTLPolicy),
+    ('lfu', LFUPolicy),
+    ('tinylfu', lambda capacity: MappingPolicy(WTinyLFUCache(capacity))),
+])
+
+
+def simulate(records, policy):
+    """
+    Replay trace records against a policy, and return the number of hits and
+    misses. Every miss is a KMS call.
+    """
+    hits = misses = 0
+    for now, key, not_after in records:
+        if policy.access(key, now, not_after):
+            hits += 1
+        else:
+            misses += 1
+    return hits, misses
+
+
+def _sizes(value):
+    return [int(size) for size in value.split(',')]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Replay a kmsauth token cache trace against cache'
+                    ' policies.'
+    )
+    parser.add_argument('trace', help='Path of the trace file.')
+    parser.add_argument('--sizes', type=_sizes,
+                        default=[256, 1024, 4096, 16384],
+                        help='Comma separated cache sizes to simulate.')
+    parser.add_argument('--policy', action='append', dest='policies',
+                        choices=list(POLICIES),
+                        help='A policy to simulate. May be repeated.'
+                             ' Default: all of them.')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    records = list(read_trace(args.trace))
+    if not records:
+        print('The trace is empty.')
+        return
+    duration = max(records[-1][0] - records[0][0], 1)
+    print('{0:,} accesses to {1:,} tokens over {2:,.0f}s'.format(
+        len(records),
+        len(set(record[1] for record in records)),
+        duration
+    ))
+    print('{0:<10} {1:>8} {2:>10} {3:>12} {4:>12}'.format(
+        'policy', 'size', 'hit ratio', 'KMS calls', 'KMS calls/s'
+    ))
+    for name in args.policies or list(POLICIES):
+        for size in args.sizes:
+            try:
+                policy = POLICIES[name](size)
+            except ImportError:
+                print('{0:<10} not installed'.format(name))
+                break
+            hits, misses = simulate(records, policy)
+            print('{0:<10} {1:>8} {2:>10.4f} {3:>12,} {4:>12.2f}'.format(
+                name,
+                size,
+                hits / len(records),
+                misses,
+                misses / duration
+            ))
+
+
+if __name__ == '__main__':
+    main()
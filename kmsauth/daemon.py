@@ -0,0 +1,317 @@
+"""
+A host-local token validation daemon.
+
+The daemon runs a single KMSTokenValidator, and serves decrypt_token requests
+over a Unix socket, so that every process on a host shares one token cache and
+one KMS connection pool. ValidationClient is a drop-in replacement for
+KMSTokenValidator.decrypt_token, which falls back to validating in-process if
+the daemon can't be reached.
+
+Run the daemon with the ``kmsauth-validator`` command; see
+``kmsauth-validator --help``.
+"""
+import argparse
+import logging
+import signal
+
+import kmsauth
+from kmsauth.utils.cachetrace import CacheTraceRecorder
+from kmsauth.utils.framing import (
+    DaemonUnavailableError,
+    FrameClient,
+    UnixFrameServer,
+)
+
+DEFAULT_SOCKET_PATH = '/var/run/kmsauth/validator.sock'
+
+
+def error_response(e):
+    """Build a response frame for an exception."""
+    return {'ok': False, 'error': type(e).__name__, 'message': str(e)}
+
+
+def raise_error_response(response, default=None):
+    """
+    Raise the kmsauth exception described by an error response frame.
+    Unknown exception types are raised as default, or TokenValidationError.
+    """
+    if default is None:
+        default = kmsauth.TokenValidationError
+    exc = getattr(kmsauth, response.get('error', ''), None)
+    if not (isinstance(exc, type) and issubclass(exc, Exception)):
+        exc = default
+    raise exc(response.get('message', 'Authentication error.'))
+
+
+class ValidationDaemon(object):
+
+    """A Unix socket server for a KMSTokenValidator."""
+
+    def __init__(self, validator, socket_path=DEFAULT_SOCKET_PATH,
+                 socket_mode=0o660):
+        self.validator = validator
+        self.server = UnixFrameServer(
+            socket_path,
+            self.dispatch,
+            socket_mode=socket_mode
+        )
+
+    def dispatch(self, request):
+        if request.get('op') != 'decrypt_token':
+            return {
+                'ok': False,
+                'error': 'ConfigurationError',
+                'message': 'Unsupported operation.',
+            }
+        try:
+            result = self.validator.decrypt_token(
+                request['username'],
+                request['token'],
+                to_auth_context=request.get('to'),
+                timeout=request.get('timeout')
+            )
+        except (kmsauth.TokenValidationError,
+                kmsauth.ConfigurationError) as e:
+            return error_response(e)
+        except Exception:
+            logging.exception('Failed to validate token.')
+            return {
+                'ok': False,
+                'error': 'TokenValidationError',
+                'message': 'Authentication error. General error.',
+            }
+        return {'ok': True, 'result': result}
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if getattr(self.validator, 'cache_trace', None) is not None:
+            self.validator.cache_trace.close()
+
+
+class ValidationClient(object):
+
+    """
+    A client for the validation daemon, with the same decrypt_token interface
+    as KMSTokenValidator.
+    """
+
+    def __init__(
+            self,
+            socket_path=DEFAULT_SOCKET_PATH,
+            fallback_validator=None,
+            timeout=1.0,
+            retry_interval=5.0,
+            **validator_kwargs
+            ):
+        """Create a ValidationClient object.
+
+        Args:
+            socket_path: The path of the daemon's Unix socket.
+            fallback_validator: A KMSTokenValidator to use when the daemon
+                can't be reached. Default: None
+            timeout: Timeout for daemon requests, in seconds. Default: 1.0
+            retry_interval: After failing to reach the daemon, how long to
+                validate tokens in-process before trying it again, in seconds.
+                Default: 5.0
+            validator_kwargs: If fallback_validator isn't set, these are the
+                arguments used to create one, the first time it's needed. If
+                neither are set, errors reaching the daemon are raised as
+                TokenValidationError.
+        """
+        self.client = FrameClient(
+            socket_path,
+            timeout=timeout,
+            retry_interval=retry_interval
+        )
+        self._fallback_validator = fallback_validator
+        self._validator_kwargs = validator_kwargs
+
+    @property
+    def fallback_validator(self):
+        if (self._fallback_validator is None and
+                self._validator_kwargs):
+            self._fallback_validator = kmsauth.KMSTokenValidator(
+                **self._validator_kwargs
+            )
+        return self._fallback_validator
+
+    def decrypt_token(self, username, token, to_auth_context=None,
+                      timeout=None):
+        '''
+        Decrypt a token, using the daemon if it's available. timeout bounds
+        the daemon's validation, not the request to the daemon, which is
+        bounded by the client's own timeout.
+        '''
+        # Rejected here, like KMSTokenValidator does, rather than failing to
+        # encode the request.
+        text = kmsauth._check_token_format(token)
+        if text is None:
+            raise kmsauth.TokenValidationError(
+                'Authentication error. Invalid token format.'
+            )
+        request = {
+            'op': 'decrypt_token',
+            'username': username,
+            'token': text,
+        }
+        if to_auth_context is not None:
+            request['to'] = to_auth_context
+        if timeout is not None:
+            request['timeout'] = timeout
+        try:
+            response = self.client.request(request)
+        except DaemonUnavailableError as e:
+            validator = self.fallback_validator
+            if validator is None:
+                logging.error(str(e))
+                raise kmsauth.TokenValidationError(
+                    'Authentication error. Validation daemon unavailable.'
+                )
+            logging.debug('Validating in-process: {0}'.format(e))
+            return validator.decrypt_token(
+                username,
+                token,
+                to_auth_context=to_auth_context,
+                timeout=timeout
+            )
+        if not response.get('ok'):
+            raise_error_response(response)
+        return response['result']
+
+
+def _scoped_auth_key(value):
+    key, sep, account = value.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError(
+            'Scoped auth keys must be of the form KEY=ACCOUNT.'
+        )
+    return key, account
+
+
+def _user_type_cache_size(value):
+    user_type, sep, size = value.partition('=')
+    if not sep or not size.isdigit():
+        raise argparse.ArgumentTypeError(
+            'User type cache sizes must be of the form USER_TYPE=SIZE.'
+        )
+    return user_type, int(size)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description='Serve kmsauth token validation over a Unix socket.'
+    )
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH,
+                        help='Path of the Unix socket to listen on.')
+    parser.add_argument('--socket-mode', default='660',
+                        type=lambda mode: int(mode, 8),
+                        help='Permissions of the Unix socket, in octal.')
+    parser.add_argument('--region', required=True,
+                        help='AWS region to connect to.')
+    parser.add_argument('--auth-key', action='append',
+                        help='KMS key used for service authentication.'
+                             ' May be repeated.')
+    parser.add_argument('--user-auth-key', action='append',
+                        help='KMS key used for user authentication.'
+                             ' May be repeated.')
+    parser.add_argument('--scoped-auth-key', action='append',
+                        type=_scoped_auth_key, metavar='KEY=ACCOUNT',
+                        help='KMS key to account mapping. May be repeated.')
+    parser.add_argument('--to-auth-context',
+                        help='Default to context, for requests without one.')
+    parser.add_argument('--minimum-token-version', type=int, default=1)
+    parser.add_argument('--maximum-token-version', type=int, default=2)
+    parser.add_argument('--auth-token-max-lifetime', type=int, default=60)
+    parser.add_argument('--token-cache-size', type=int, default=4096)
+    parser.add_argument('--user-type-token-cache-size', action='append',
+                        type=_user_type_cache_size,
+                        metavar='USER_TYPE=SIZE',
+                        help='Size of a separate token cache for a user_type.'
+                             ' May be repeated.')
+    parser.add_argument('--token-cache-policy', default='lru',
+                        choices=['lru', 'tinylfu'])
+    parser.add_argument('--stale-token-cache-size', type=int, default=0)
+    parser.add_argument('--decrypt-rate-limit', type=float,
+                        help='KMS decrypts per second, per user.')
+    parser.add_argument('--decrypt-rate-burst', type=float)
+    parser.add_argument('--global-decrypt-rate-limit', type=float,
+                        help='KMS decrypts per second, across all users.')
+    parser.add_argument('--global-decrypt-rate-burst', type=float)
+    parser.add_argument('--max-concurrent-decrypts', type=int,
+                        help='Maximum number of concurrent KMS decrypts.')
+    parser.add_argument('--decrypt-queue-timeout', type=float, default=0.1,
+                        help='Maximum time to wait to start a KMS decrypt,'
+                             ' in seconds.')
+    parser.add_argument('--cache-trace',
+                        help='Path of a file to record token cache accesses'
+                             ' to, for kmsauth-cachesim.')
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--max-pool-connections', type=int)
+    parser.add_argument('--connect-timeout', type=float)
+    parser.add_argument('--read-timeout', type=float)
+    parser.add_argument('--log-level', default='INFO')
+    return parser
+
+
+def validator_from_args(args):
+    cache_trace = None
+    if args.cache_trace:
+        cache_trace = CacheTraceRecorder(args.cache_trace)
+    return kmsauth.KMSTokenValidator(
+        args.auth_key,
+        args.user_auth_key,
+        args.to_auth_context,
+        args.region,
+        scoped_auth_keys=dict(args.scoped_auth_key or []),
+        minimum_token_version=args.minimum_token_version,
+        maximum_token_version=args.maximum_token_version,
+        auth_token_max_lifetime=args.auth_token_max_lifetime,
+        endpoint_url=args.endpoint_url,
+        token_cache_size=args.token_cache_size,
+        token_cache_policy=args.token_cache_policy,
+        token_cache_sizes=dict(args.user_type_token_cache_size or []),
+        max_pool_connections=args.max_pool_connections,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        stale_token_cache_size=args.stale_token_cache_size,
+        decrypt_rate_limit=args.decrypt_rate_limit,
+        decrypt_rate_burst=args.decrypt_rate_burst,
+        global_decrypt_rate_limit=args.global_decrypt_rate_limit,
+        global_decrypt_rate_burst=args.global_decrypt_rate_burst,
+        max_concurrent_decrypts=args.max_concurrent_decrypts,
+        decrypt_queue_timeout=args.decrypt_queue_timeout,
+        cache_trace=cache_trace,
+    )
+
+
+def run(daemon):
+    """Serve until SIGTERM or SIGINT."""
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.shutdown()
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    daemon = ValidationDaemon(
+        validator_from_args(args),
+        socket_path=args.socket,
+        socket_mode=args.socket_mode
+    )
+    logging.info('Listening on {0}'.format(args.socket))
+    run(daemon)
+
+
+if __name__ == '__main__':
+    main()
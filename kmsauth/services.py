@@ -1,11 +1,320 @@
-"""Module for accessing boto3 clients, resources and sessions."""
+"""Module for accessing boto3 clients, resources and sessions.
 
-import boto3
-import botocore
+boto3 and botocore are slow to import, so they're only imported once a client,
+resource or session is first requested.
+"""
+
+import collections
+import datetime
+import hashlib
 import logging
+import threading
+import time
+
+from kmsauth.utils import forksafe
+
+# Maximum number of clients (and, separately, resources) kept by a
+# ClientManager.
+MAX_CACHED_CLIENTS = 64
+# Clients built from temporary credentials (a session token without a way to
+# refresh it) are dropped once they haven't been used for this many seconds.
+TEMPORARY_CREDENTIALS_IDLE_TTL = 3600
+# How often refreshable credentials without an Expiration are refreshed, in
+# seconds.
+DEFAULT_CREDENTIALS_REFRESH_INTERVAL = 900
+
+
+def connection_errors():
+    """
+    Get the exceptions raised by KMS transports when AWS can't be reached.
+
+    This is meant to be used directly in an except clause, which is only
+    evaluated when an exception is being handled, so botocore isn't imported
+    unless it's needed.
+    """
+    from botocore.exceptions import (ConnectionError,
+                                     EndpointConnectionError,
+                                     ReadTimeoutError)
+    from kmsauth.transport import TransportConnectionError
+    return (
+        ConnectionError,
+        EndpointConnectionError,
+        ReadTimeoutError,
+        TransportConnectionError,
+    )
+
+
+def _digest(*values):
+    """Hash secrets, so that they aren't kept around in cache keys."""
+    h = hashlib.sha256()
+    for value in values:
+        h.update('{0}\0'.format(value or '').encode('utf-8'))
+    return h.hexdigest()[:32]
+
+
+def _credentials_metadata(creds):
+    """
+    Convert a dict of AccessKeyId, SecretAccessKey, SessionToken and
+    (optionally) Expiration into the metadata format used by botocore's
+    RefreshableCredentials. A naive Expiration datetime, such as one from
+    utcnow(), is taken to be in UTC.
+    """
+    expiration = creds.get('Expiration')
+    if expiration is None:
+        expiration = (
+            datetime.datetime.utcnow() +
+            datetime.timedelta(seconds=DEFAULT_CREDENTIALS_REFRESH_INTERVAL)
+        ).strftime('%Y-%m-%dT%H:%M:%SZ')
+    elif isinstance(expiration, datetime.datetime):
+        if expiration.tzinfo is None:
+            # botocore compares expiry times with aware datetimes.
+            expiration = expiration.replace(tzinfo=datetime.timezone.utc)
+        expiration = expiration.isoformat()
+    return {
+        'access_key': creds['AccessKeyId'],
+        'secret_key': creds['SecretAccessKey'],
+        'token': creds.get('SessionToken'),
+        'expiry_time': expiration,
+    }
+
+
+class ClientManager(object):
+
+    """
+    A thread-safe, bounded cache of boto3 clients and resources.
+
+    Clients are keyed by everything that affects how they are built: service,
+    region, endpoint, client config and credentials. Clients built with
+    refreshable credentials are keyed by the credentials callable, so they are
+    reused across credential rotations.
+
+    Clients and their connection pools can't be shared with a forked child,
+    so the cache is cleared in the child after a fork.
+    """
 
-CLIENT_CACHE = {}
-RESOURCE_CACHE = {}
+    def __init__(
+            self,
+            max_size=MAX_CACHED_CLIENTS,
+            temporary_credentials_idle_ttl=TEMPORARY_CREDENTIALS_IDLE_TTL,
+            ):
+        self.max_size = max_size
+        self.temporary_credentials_idle_ttl = temporary_credentials_idle_ttl
+        self.clients = collections.OrderedDict()
+        self.resources = collections.OrderedDict()
+        # cache key -> time after which an unused entry is considered stale.
+        self._expires = {}
+        self._lock = threading.RLock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Another thread may have held the lock at the time of the fork.
+        self._lock = threading.RLock()
+        self.clear()
+
+    def _credentials_key(
+            self,
+            aws_access_key_id,
+            aws_secret_access_key,
+            aws_session_token,
+            refresh_credentials,
+            ):
+        if refresh_credentials is not None:
+            return ('refreshable', refresh_credentials)
+        if aws_access_key_id is None and aws_session_token is None:
+            return ('default',)
+        return (
+            'static',
+            aws_access_key_id,
+            _digest(aws_secret_access_key, aws_session_token),
+        )
+
+    def _get(self, cache, cache_key, temporary):
+        """Get an entry from a cache, evicting it if it's stale."""
+        now = time.time()
+        if cache_key not in cache:
+            return None
+        expires = self._expires.get(cache_key)
+        if expires is not None and expires < now:
+            del cache[cache_key]
+            del self._expires[cache_key]
+            return None
+        cache.move_to_end(cache_key)
+        if temporary:
+            self._expires[cache_key] = (
+                now + self.temporary_credentials_idle_ttl
+            )
+        return cache[cache_key]
+
+    def _set(self, cache, cache_key, value, temporary):
+        """Add an entry to a cache, evicting stale and old entries."""
+        now = time.time()
+        for key in [k for k in cache if self._expires.get(k, now) < now]:
+            del cache[key]
+            del self._expires[key]
+        while len(cache) >= self.max_size:
+            key, _ = cache.popitem(last=False)
+            self._expires.pop(key, None)
+        cache[cache_key] = value
+        if temporary:
+            self._expires[cache_key] = (
+                now + self.temporary_credentials_idle_ttl
+            )
+
+    def get_client(
+            self,
+            client,
+            region=None,
+            aws_access_key_id=None,
+            aws_secret_access_key=None,
+            aws_session_token=None,
+            endpoint_url=None,
+            max_pool_connections=None,
+            connect_timeout=None,
+            read_timeout=None,
+            refresh_credentials=None,
+            ):
+        """Get a boto3 client connection."""
+        import botocore.config
+
+        # do not explicitly set any params as None
+        config_params = dict(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+        )
+        config_params = {
+            k: v for (k, v) in config_params.items() if v is not None
+        }
+        cache_key = (
+            client,
+            region,
+            endpoint_url or '',
+            tuple(sorted(config_params.items())),
+            self._credentials_key(
+                aws_access_key_id,
+                aws_secret_access_key,
+                aws_session_token,
+                refresh_credentials
+            ),
+        )
+        temporary = bool(aws_session_token) and refresh_credentials is None
+        with self._lock:
+            cached = self._get(self.clients, cache_key, temporary)
+            if cached is not None:
+                return cached
+            session = self.get_session(
+                region,
+                aws_access_key_id,
+                aws_secret_access_key,
+                aws_session_token,
+                refresh_credentials
+            )
+            if not session:
+                logging.error("Failed to get {0} client.".format(client))
+                return None
+            _client = session.client(
+                client,
+                endpoint_url=endpoint_url,
+                config=botocore.config.Config(**config_params)
+            )
+            self._set(self.clients, cache_key, _client, temporary)
+            return _client
+
+    def get_resource(
+            self,
+            resource,
+            region=None,
+            aws_access_key_id=None,
+            aws_secret_access_key=None,
+            aws_session_token=None,
+            endpoint_url=None,
+            refresh_credentials=None,
+            ):
+        """Get a boto resource connection."""
+        cache_key = (
+            resource,
+            region,
+            endpoint_url or '',
+            self._credentials_key(
+                aws_access_key_id,
+                aws_secret_access_key,
+                aws_session_token,
+                refresh_credentials
+            ),
+        )
+        temporary = bool(aws_session_token) and refresh_credentials is None
+        with self._lock:
+            cached = self._get(self.resources, cache_key, temporary)
+            if cached is not None:
+                return cached
+            session = self.get_session(
+                region,
+                aws_access_key_id,
+                aws_secret_access_key,
+                aws_session_token,
+                refresh_credentials
+            )
+            if not session:
+                logging.error("Failed to get {0} resource.".format(resource))
+                return None
+            _resource = session.resource(
+                resource,
+                endpoint_url=endpoint_url
+            )
+            self._set(self.resources, cache_key, _resource, temporary)
+            return _resource
+
+    def get_session(
+            self,
+            region,
+            aws_access_key_id=None,
+            aws_secret_access_key=None,
+            aws_session_token=None,
+            refresh_credentials=None,
+            ):
+        """Get a boto3 session."""
+        import boto3.session
+
+        if refresh_credentials is None:
+            return boto3.session.Session(
+                region_name=region,
+                aws_secret_access_key=aws_secret_access_key,
+                aws_access_key_id=aws_access_key_id,
+                aws_session_token=aws_session_token
+            )
+        import botocore.credentials
+        import botocore.session
+
+        botocore_session = botocore.session.get_session()
+        # There's no public interface for setting refreshable credentials on a
+        # session, so we set them the same way botocore's own assume-role
+        # providers do.
+        botocore_session._credentials = (
+            botocore.credentials.RefreshableCredentials.create_from_metadata(
+                metadata=_credentials_metadata(refresh_credentials()),
+                refresh_using=lambda: _credentials_metadata(
+                    refresh_credentials()
+                ),
+                method='kmsauth-refresh'
+            )
+        )
+        return boto3.session.Session(
+            region_name=region,
+            botocore_session=botocore_session
+        )
+
+    def clear(self):
+        """Drop all cached clients and resources."""
+        with self._lock:
+            self.clients.clear()
+            self.resources.clear()
+            self._expires.clear()
+
+
+CLIENT_MANAGER = ClientManager()
+# Kept for backwards compatibility; these are the default manager's caches.
+CLIENT_CACHE = CLIENT_MANAGER.clients
+RESOURCE_CACHE = CLIENT_MANAGER.resources
 
 
 def get_boto_client(
@@ -18,40 +327,21 @@ def get_boto_client(
         max_pool_connections=None,
         connect_timeout=None,
         read_timeout=None,
+        refresh_credentials=None,
         ):
-    """Get a boto3 client connection."""
-    cache_key = '{0}:{1}:{2}:{3}'.format(
+    """Get a boto3 client connection from the default client manager."""
+    return CLIENT_MANAGER.get_client(
         client,
-        region,
-        aws_access_key_id,
-        endpoint_url or ''
-    )
-    if not aws_session_token:
-        if cache_key in CLIENT_CACHE:
-            return CLIENT_CACHE[cache_key]
-    session = get_boto_session(
-        region,
-        aws_access_key_id,
-        aws_secret_access_key,
-        aws_session_token
-    )
-    if not session:
-        logging.error("Failed to get {0} client.".format(client))
-        return None
-
-    # do not explicitly set any params as None
-    config_params = dict(
+        region=region,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        aws_session_token=aws_session_token,
+        endpoint_url=endpoint_url,
         max_pool_connections=max_pool_connections,
         connect_timeout=connect_timeout,
         read_timeout=read_timeout,
+        refresh_credentials=refresh_credentials,
     )
-    config_params = {k: v for (k, v) in config_params.items() if v is not None}
-    CLIENT_CACHE[cache_key] = session.client(
-        client,
-        endpoint_url=endpoint_url,
-        config=botocore.config.Config(**config_params)
-    )
-    return CLIENT_CACHE[cache_key]
 
 
 def get_boto_resource(
@@ -60,45 +350,33 @@ def get_boto_resource(
         aws_access_key_id=None,
         aws_secret_access_key=None,
         aws_session_token=None,
-        endpoint_url=None
+        endpoint_url=None,
+        refresh_credentials=None,
         ):
-    """Get a boto resource connection."""
-    cache_key = '{0}:{1}:{2}:{3}'.format(
+    """Get a boto resource connection from the default client manager."""
+    return CLIENT_MANAGER.get_resource(
         resource,
-        region,
-        aws_access_key_id,
-        endpoint_url or ''
-    )
-    if not aws_session_token:
-        if cache_key in RESOURCE_CACHE:
-            return RESOURCE_CACHE[cache_key]
-    session = get_boto_session(
-        region,
-        aws_access_key_id,
-        aws_secret_access_key,
-        aws_session_token
-    )
-    if not session:
-        logging.error("Failed to get {0} resource.".format(resource))
-        return None
-
-    RESOURCE_CACHE[cache_key] = session.resource(
-        resource,
-        endpoint_url=endpoint_url
+        region=region,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        aws_session_token=aws_session_token,
+        endpoint_url=endpoint_url,
+        refresh_credentials=refresh_credentials,
     )
-    return RESOURCE_CACHE[cache_key]
 
 
 def get_boto_session(
         region,
         aws_access_key_id=None,
         aws_secret_access_key=None,
-        aws_session_token=None
+        aws_session_token=None,
+        refresh_credentials=None,
         ):
     """Get a boto3 session."""
-    return boto3.session.Session(
-        region_name=region,
-        aws_secret_access_key=aws_secret_access_key,
-        aws_access_key_id=aws_access_key_id,
-        aws_session_token=aws_session_token
+    return CLIENT_MANAGER.get_session(
+        region,
+        aws_access_key_id,
+        aws_secret_access_key,
+        aws_session_token,
+        refresh_credentials
     )
@@ -0,0 +1,360 @@
+"""
+KMS transports.
+
+kmsauth talks to KMS through a transport: any object with boto3-compatible
+``encrypt``, ``decrypt`` and ``describe_key`` methods, and optionally
+``list_aliases``. They're called with the same keyword arguments as the boto3
+KMS client, and return dicts shaped like its responses (blobs are returned as
+bytes)::
+
+    encrypt(KeyId, Plaintext, EncryptionContext) -> {'CiphertextBlob', 'KeyId'}
+    decrypt(CiphertextBlob, EncryptionContext) -> {'Plaintext', 'KeyId'}
+    describe_key(KeyId) -> {'KeyMetadata': {'Arn', ...}}
+    list_aliases(Limit, Marker) -> {'Aliases', 'Truncated', 'NextMarker'}
+
+A boto3 KMS client is the default transport. HTTPKMSTransport is a lighter
+weight alternative, which signs requests itself and sends them over
+keep-alive connections, skipping boto3's per-call request serialization,
+event hooks and retry handling.
+"""
+import base64
+import datetime
+import hashlib
+import hmac
+import http.client
+import json
+import queue
+import threading
+import urllib.parse
+
+from kmsauth.utils import forksafe
+
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+DEFAULT_CONNECT_TIMEOUT = 60
+DEFAULT_READ_TIMEOUT = 60
+KMS_TARGET_PREFIX = 'TrentService.'
+KMS_CONTENT_TYPE = 'application/x-amz-json-1.1'
+# Errors sending a request on a pooled keep-alive connection, or reading the
+# start of its response, that mean the server had already closed it. Timeouts
+# aren't included: the server may still be processing the request.
+_STALE_CONNECTION_ERRORS = (
+    BrokenPipeError,
+    ConnectionAbortedError,
+    ConnectionResetError,
+)
+
+
+class TransportConnectionError(Exception):
+    """An exception raised when a transport couldn't reach KMS."""
+    pass
+
+
+class KMSError(Exception):
+
+    """An exception raised when KMS returned an error response."""
+
+    def __init__(self, code, message, status):
+        super(KMSError, self).__init__(
+            '{0} ({1}): {2}'.format(code, status, message)
+        )
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _hmac(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+class SigV4Signer(object):
+
+    """
+    A minimal AWS Signature Version 4 signer for KMS JSON requests.
+
+    The derived signing key only changes once a day, so it's cached.
+    """
+
+    def __init__(self, region, service='kms'):
+        self.region = region
+        self.service = service
+        self._signing_keys = {}
+
+    def _signing_key(self, secret_key, datestamp):
+        cache_key = (secret_key, datestamp)
+        key = self._signing_keys.get(cache_key)
+        if key is None:
+            key = _hmac(('AWS4' + secret_key).encode('utf-8'), datestamp)
+            key = _hmac(key, self.region)
+            key = _hmac(key, self.service)
+            key = _hmac(key, 'aws4_request')
+            # Keys are only useful for a day; don't keep old ones around.
+            self._signing_keys = {cache_key: key}
+        return key
+
+    def sign(self, method, path, headers, body, credentials, now=None):
+        """
+        Add SigV4 authentication headers to headers, in place. All headers,
+        which must include Host, are signed.
+
+        Args:
+            credentials: A dict of AccessKeyId, SecretAccessKey and
+                (optionally) SessionToken.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = amz_date[:8]
+        headers['X-Amz-Date'] = amz_date
+        if credentials.get('SessionToken'):
+            headers['X-Amz-Security-Token'] = credentials['SessionToken']
+        signed = {}
+        for name, value in headers.items():
+            signed[name.lower()] = ' '.join(str(value).split())
+        signed_headers = ';'.join(sorted(signed))
+        canonical_request = '\n'.join([
+            method,
+            path,
+            '',
+            ''.join(
+                '{0}:{1}\n'.format(name, signed[name])
+                for name in sorted(signed)
+            ),
+            signed_headers,
+            _sha256(body),
+        ])
+        scope = '{0}/{1}/{2}/aws4_request'.format(
+            datestamp,
+            self.region,
+            self.service
+        )
+        string_to_sign = '\n'.join([
+            'AWS4-HMAC-SHA256',
+            amz_date,
+            scope,
+            _sha256(canonical_request.encode('utf-8')),
+        ])
+        signature = hmac.new(
+            self._signing_key(credentials['SecretAccessKey'], datestamp),
+            string_to_sign.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        headers['Authorization'] = (
+            'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2},'
+            ' Signature={3}'.format(
+                credentials['AccessKeyId'],
+                scope,
+                signed_headers,
+                signature
+            )
+        )
+        return headers
+
+
+class HTTPKMSTransport(object):
+
+    """
+    A KMS transport that sends SigV4 signed requests over a pool of
+    keep-alive HTTP connections.
+    """
+
+    def __init__(
+            self,
+            region,
+            endpoint_url=None,
+            aws_creds=None,
+            max_pool_connections=None,
+            connect_timeout=None,
+            read_timeout=None,
+            ):
+        """Create a HTTPKMSTransport object.
+
+        Args:
+            region: AWS region to connect to. Required.
+            endpoint_url: A URL to override the default endpoint used to access
+                the KMS service. Default: None
+            aws_creds: A dict of AccessKeyId, SecretAccessKey, SessionToken,
+                or a callable returning such a dict, which is called for every
+                request. If not set, credentials are loaded from botocore's
+                default credential chain. Default: None
+            max_pool_connections: Maximum number of idle connections kept open.
+                Default: 10
+            connect_timeout: Connection timeout, in seconds. Default: 60
+            read_timeout: Read timeout, in seconds. Default: 60
+        """
+        self.region = region
+        if endpoint_url is None:
+            endpoint_url = 'https://kms.{0}.amazonaws.com'.format(region)
+        self.endpoint_url = endpoint_url
+        url = urllib.parse.urlsplit(endpoint_url)
+        self._scheme = url.scheme
+        self._host = url.netloc
+        self._hostname = url.hostname
+        self._port = url.port
+        self._path = url.path or '/'
+        self.aws_creds = aws_creds
+        self._botocore_credentials = None
+        if max_pool_connections is None:
+            max_pool_connections = DEFAULT_MAX_POOL_CONNECTIONS
+        self.connect_timeout = connect_timeout or DEFAULT_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or DEFAULT_READ_TIMEOUT
+        self.max_pool_connections = max_pool_connections
+        self._pool = queue.LifoQueue(maxsize=max_pool_connections)
+        self._lock = threading.Lock()
+        self.signer = SigV4Signer(region)
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Pooled connections are shared with the parent, so the child starts
+        # with an empty pool.
+        self._pool = queue.LifoQueue(maxsize=self.max_pool_connections)
+        self._lock = threading.Lock()
+
+    def _get_credentials(self):
+        if callable(self.aws_creds):
+            return self.aws_creds()
+        elif self.aws_creds:
+            return self.aws_creds
+        if self._botocore_credentials is None:
+            with self._lock:
+                if self._botocore_credentials is None:
+                    import botocore.session
+
+                    self._botocore_credentials = (
+                        botocore.session.get_session().get_credentials()
+                    )
+        if self._botocore_credentials is None:
+            raise TransportConnectionError('Unable to locate credentials.')
+        creds = self._botocore_credentials.get_frozen_credentials()
+        return {
+            'AccessKeyId': creds.access_key,
+            'SecretAccessKey': creds.secret_key,
+            'SessionToken': creds.token,
+        }
+
+    def _new_connection(self):
+        if self._scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                self._hostname,
+                self._port,
+                timeout=self.connect_timeout
+            )
+        else:
+            conn = http.client.HTTPConnection(
+                self._hostname,
+                self._port,
+                timeout=self.connect_timeout
+            )
+        return conn
+
+    def _get_connection(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._new_connection(), False
+
+    def _release_connection(self, conn):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _send(self, conn, body, headers):
+        conn.request('POST', self._path, body=body, headers=headers)
+        if conn.sock is not None:
+            conn.sock.settimeout(self.read_timeout)
+        return conn.getresponse()
+
+    def _call(self, operation, params):
+        body = json.dumps(params).encode('utf-8')
+        headers = {
+            'Host': self._host,
+            'Content-Type': KMS_CONTENT_TYPE,
+            'X-Amz-Target': KMS_TARGET_PREFIX + operation,
+        }
+        self.signer.sign(
+            'POST',
+            self._path,
+            headers,
+            body,
+            self._get_credentials()
+        )
+        conn, reused = self._get_connection()
+        try:
+            try:
+                response = self._send(conn, body, headers)
+            except _STALE_CONNECTION_ERRORS:
+                # http.client.RemoteDisconnected, EOF before the response
+                # started, is a ConnectionResetError.
+                if not reused:
+                    raise
+                # The server closed an idle keep-alive connection before
+                # reading the request; retry once on a fresh one.
+                conn.close()
+                conn = self._new_connection()
+                response = self._send(conn, body, headers)
+            status = response.status
+            data = response.read()
+        except (http.client.HTTPException, OSError) as e:
+            conn.close()
+            raise TransportConnectionError(
+                'Failure connecting to {0}: {1}'.format(self.endpoint_url, e)
+            )
+        if response.will_close:
+            conn.close()
+        else:
+            self._release_connection(conn)
+        try:
+            data = json.loads(data.decode('utf-8')) if data else {}
+        except ValueError:
+            data = {}
+        if status >= 400:
+            code = data.get('__type', 'UnknownError').split('#')[-1]
+            message = data.get('message', data.get('Message', ''))
+            raise KMSError(code, message, status)
+        return data
+
+    def encrypt(self, KeyId, Plaintext, EncryptionContext=None):
+        if isinstance(Plaintext, str):
+            Plaintext = Plaintext.encode('utf-8')
+        params = {
+            'KeyId': KeyId,
+            'Plaintext': base64.b64encode(Plaintext).decode('ascii'),
+        }
+        if EncryptionContext:
+            params['EncryptionContext'] = EncryptionContext
+        data = self._call('Encrypt', params)
+        data['CiphertextBlob'] = base64.b64decode(data['CiphertextBlob'])
+        return data
+
+    def decrypt(self, CiphertextBlob, EncryptionContext=None):
+        params = {
+            'CiphertextBlob': base64.b64encode(CiphertextBlob).decode('ascii'),
+        }
+        if EncryptionContext:
+            params['EncryptionContext'] = EncryptionContext
+        data = self._call('Decrypt', params)
+        data['Plaintext'] = base64.b64decode(data['Plaintext'])
+        return data
+
+    def describe_key(self, KeyId):
+        return self._call('DescribeKey', {'KeyId': KeyId})
+
+    def list_aliases(self, Limit=None, Marker=None):
+        params = {}
+        if Limit is not None:
+            params['Limit'] = Limit
+        if Marker is not None:
+            params['Marker'] = Marker
+        return self._call('ListAliases', params)
@@ -0,0 +1,112 @@
+"""
+Token cache access traces.
+
+A trace is an 8 byte magic header, followed by fixed size little-endian
+records of: the access time (a double, in epoch seconds), an anonymized
+token key (an unsigned 64 bit hash, keyed with a per-recorder random salt), and
+the token's not_after (an unsigned 32 bit int, in epoch seconds).
+"""
+import hashlib
+import os
+import struct
+import threading
+import time
+
+from kmsauth.utils import forksafe
+
+MAGIC = b'KMSATRC\x01'
+RECORD = struct.Struct('<dQI')
+_KEY = struct.Struct('<Q')
+
+
+class CacheTraceRecorder(object):
+
+    """
+    Records token cache accesses to a trace file.
+
+    A forked child keeps appending its accesses to the same file. It drops
+    its copy of the parent's buffered records, which the parent writes.
+    """
+
+    def __init__(self, path, buffer_records=4096):
+        """Create a CacheTraceRecorder object.
+
+        Args:
+            path: The path of the trace file to write. It's truncated if it
+                already exists.
+            buffer_records: The number of records to buffer before writing
+                them to the file. Default: 4096
+        """
+        self.path = path
+        self._salt = os.urandom(16)
+        self._buffer = bytearray()
+        self._buffer_size = buffer_records * RECORD.size
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        # Flushed, so that a forked child's copy of the file doesn't write it
+        # again.
+        self._file.flush()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        del self._buffer[:]
+
+    def anonymize(self, token_key):
+        """Hash a token cache key into an unsigned 64 bit int."""
+        digest = hashlib.blake2b(
+            repr(token_key).encode('utf-8'),
+            digest_size=8,
+            key=self._salt
+        ).digest()
+        return _KEY.unpack(digest)[0]
+
+    def record(self, token_key, not_after, now=None):
+        """Record an access to token_key, for a token valid until not_after."""
+        if now is None:
+            now = time.time()
+        data = RECORD.pack(now, self.anonymize(token_key), int(not_after))
+        with self._lock:
+            if self._file is None:
+                return
+            self._buffer += data
+            if len(self._buffer) >= self._buffer_size:
+                self._flush()
+
+    def _flush(self):
+        self._file.write(self._buffer)
+        self._file.flush()
+        del self._buffer[:]
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is None:
+                return
+            self._flush()
+            self._file.close()
+            self._file = None
+
+
+def read_trace(path):
+    """
+    Read a trace file, yielding (timestamp, key, not_after) tuples. Raises
+    ValueError if the file isn't a trace.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a kmsauth cache trace.'.format(path))
+        while True:
+            chunk = f.read(RECORD.size * 4096)
+            # Ignore a partial record at the end of a trace that's still
+            # being written.
+            chunk = chunk[:len(chunk) - len(chunk) % RECORD.size]
+            if not chunk:
+                return
+            for record in RECORD.iter_unpack(chunk):
+                yield record
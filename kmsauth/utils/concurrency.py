@@ -0,0 +1,52 @@
+"Concurrency limiters"
+import threading
+
+from kmsauth.utils import forksafe
+
+
+class ConcurrencyLimiter(object):
+    """
+    Limits the number of concurrent holders to limit. Callers over the limit
+    wait, for at most the timeout they pass to acquire, for a holder to
+    release.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition(threading.Lock())
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Holders and waiters were threads of the parent, which don't exist
+        # in the child, and one of them may have held the lock.
+        self.active = 0
+        self.waiting = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def _available(self):
+        return self.active < self.limit
+
+    def acquire(self, timeout=None):
+        """
+        Acquire a slot, waiting for at most timeout seconds (forever, if it's
+        None). Returns whether a slot was acquired.
+        """
+        with self._cond:
+            if not self._available():
+                if timeout is not None and timeout <= 0:
+                    return False
+                self.waiting += 1
+                try:
+                    if not self._cond.wait_for(self._available, timeout):
+                        return False
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
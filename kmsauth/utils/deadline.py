@@ -0,0 +1,23 @@
+"Deadlines for bounding the time spent on a call"
+import time
+
+
+class Deadline(object):
+    """A point in time, timeout seconds from when the Deadline is created."""
+
+    def __init__(self, timeout):
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self):
+        """The number of seconds left before the deadline, or 0."""
+        return max(self.expires_at - time.monotonic(), 0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+def from_timeout(timeout):
+    """A Deadline for timeout, or None if timeout is None."""
+    if timeout is None:
+        return None
+    return Deadline(timeout)
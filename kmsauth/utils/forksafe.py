@@ -0,0 +1,43 @@
+"""
+Fork safety.
+
+Connection pools (and locks that other threads may hold) can't be shared with
+a forked child. Objects that own them register themselves here, and their
+``_after_fork`` method is called in the child after a fork, to replace them.
+Objects that only need to know whether they're still in the process that
+created their state can compare ``generation()``, which changes in every
+forked child, instead.
+"""
+import logging
+import os
+import weakref
+
+_generation = 0
+_registered = weakref.WeakSet()
+
+
+def generation():
+    """A number that changes in the child after every fork."""
+    return _generation
+
+
+def register(obj):
+    """
+    Call obj._after_fork() in the child after a fork. obj is only weakly
+    referenced.
+    """
+    _registered.add(obj)
+
+
+def _after_fork_in_child():
+    global _generation
+    _generation += 1
+    for obj in list(_registered):
+        try:
+            obj._after_fork()
+        except Exception:
+            logging.exception('Failed to reset {0!r} after fork.'.format(obj))
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,222 @@
+"""
+Length-prefixed JSON frames, and the Unix socket server and client used by
+kmsauth's daemons.
+
+Each frame is a 4 byte, big-endian, unsigned length, followed by that many
+bytes of UTF-8 encoded JSON.
+"""
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME_SIZE = 64 * 1024
+
+
+class FramingError(Exception):
+    """An exception raised when a peer sends an invalid frame."""
+    pass
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError('Connection closed.')
+        buf += chunk
+    return bytes(buf)
+
+
+def send_frame(sock, obj):
+    """Send obj, JSON encoded, as a single frame."""
+    data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    if len(data) > MAX_FRAME_SIZE:
+        raise FramingError('Frame too large.')
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock, max_size=MAX_FRAME_SIZE):
+    """
+    Receive a single frame, and return its decoded JSON. Raises EOFError if
+    the connection is closed before a frame starts, and FramingError if it's
+    closed part way through one.
+    """
+    header = sock.recv(_HEADER.size)
+    if not header:
+        raise EOFError('Connection closed.')
+    try:
+        header += _recv_exactly(sock, _HEADER.size - len(header))
+        size, = _HEADER.unpack(header)
+        if size > max_size:
+            raise FramingError('Frame too large.')
+        data = _recv_exactly(sock, size)
+    except EOFError:
+        raise FramingError('Truncated frame.')
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        raise FramingError('Invalid frame.')
+
+
+class DaemonUnavailableError(Exception):
+    """An exception raised when a kmsauth daemon can't be reached."""
+    pass
+
+
+class _FrameHandler(socketserver.BaseRequestHandler):
+    """Handle requests on a connection, until the client closes it."""
+
+    def setup(self):
+        with self.server.connections_lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.connections_lock:
+            self.server.connections.discard(self.request)
+
+    def handle(self):
+        while True:
+            try:
+                request = recv_frame(self.request)
+            except (EOFError, OSError, FramingError):
+                return
+            try:
+                response = self.server.dispatch(request)
+            except Exception:
+                logging.exception('Failed to handle request.')
+                response = {
+                    'ok': False,
+                    'error': 'Exception',
+                    'message': 'Internal error.',
+                }
+            try:
+                send_frame(self.request, response)
+            except OSError:
+                return
+
+
+class UnixFrameServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+
+    """
+    A threaded Unix socket server, that passes each request frame to
+    dispatch and sends back the frame it returns.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, dispatch, socket_mode=0o660):
+        self.socket_path = socket_path
+        self.dispatch = dispatch
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        if os.path.exists(socket_path):
+            if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+                raise OSError(
+                    '{0} exists and is not a socket.'.format(socket_path)
+                )
+            os.unlink(socket_path)
+        # Create the socket with the right permissions, rather than fixing
+        # them up after it's already accepting connections.
+        umask = os.umask(0o777 & ~socket_mode)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self,
+                socket_path,
+                _FrameHandler
+            )
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        # Close kept-alive connections too, so that clients notice.
+        with self.connections_lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+
+class FrameClient(object):
+
+    """
+    A client for a UnixFrameServer, which keeps one connection open per
+    thread. After a failure to reach the server, requests fail fast, with
+    DaemonUnavailableError, for retry_interval seconds.
+    """
+
+    def __init__(self, socket_path, timeout=1.0, retry_interval=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._local = threading.local()
+        self._down_until = 0
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def close(self):
+        """Close this thread's connection."""
+        sock = getattr(self._local, 'sock', None)
+        self._local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def request(self, obj):
+        """Send a request frame, and return the response frame."""
+        if time.time() < self._down_until:
+            raise DaemonUnavailableError('Daemon recently unavailable.')
+        sock = getattr(self._local, 'sock', None)
+        # A kept-alive connection may have been closed by a restarted server;
+        # in that case, retry once on a new connection.
+        attempts = [True, False] if sock is not None else [False]
+        for reused in attempts:
+            sent = False
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                send_frame(sock, obj)
+                sent = True
+                return recv_frame(sock)
+            except (OSError, EOFError, FramingError) as e:
+                self.close()
+                sock = None
+                # Only retry if the server closed the connection without
+                # handling the request: sending it failed, or the connection
+                # was closed before any of the response. Never after a
+                # timeout, since the server may just be slow, and would handle
+                # the request twice.
+                closed = isinstance(e, EOFError) or (
+                    not sent and
+                    isinstance(e, OSError) and
+                    not isinstance(e, socket.timeout)
+                )
+                if not (reused and closed):
+                    self._down_until = time.time() + self.retry_interval
+                    raise DaemonUnavailableError(
+                        'Failed to reach daemon at {0}: {1}'.format(
+                            self.socket_path,
+                            e
+                        )
+                    )
@@ -14,6 +14,17 @@ class LRUCache(object):
     def __contains__(self, key):
         return key in self.cache
 
+    def __len__(self):
+        return len(self.cache)
+
+    def get(self, key, default=None):
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            return default
+        self.cache[key] = value
+        return value
+
     def __getitem__(self, key):
         value = self.cache.pop(key)
         self.cache[key] = value
@@ -0,0 +1,68 @@
+"Token bucket rate limiters"
+import threading
+import time
+
+from kmsauth.utils import forksafe
+from kmsauth.utils.lru import LRUCache
+
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: allows rate events per second on average, and
+    bursts of up to burst events.
+    """
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.monotonic() if now is None else now
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Another thread may have held the lock at the time of the fork.
+        self._lock = threading.Lock()
+
+    def try_acquire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self.tokens = min(
+                self.burst,
+                self.tokens + max(now - self.last, 0) * self.rate
+            )
+            self.last = max(now, self.last)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class KeyedRateLimiter(object):
+    """
+    A token bucket per key. Buckets for the least recently seen keys are
+    dropped once there are more than max_keys of them; a dropped key starts
+    again with a full bucket.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = LRUCache(max_keys)
+        self._lock = threading.Lock()
+        # Buckets reset their own locks.
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if key in self.buckets:
+                bucket = self.buckets[key]
+            else:
+                bucket = TokenBucket(self.rate, self.burst, now=now)
+                self.buckets[key] = bucket
+            return bucket.try_acquire(now)
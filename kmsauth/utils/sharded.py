@@ -0,0 +1,97 @@
+"""
+Sharded, thread-safe caches.
+
+Each shard is a separate cache with its own lock, so that threads using
+different keys rarely contend. Without a GIL (free-threaded CPython), caches
+are split into several shards by default; with one, a single locked shard is
+as fast, and keeps the cache's eviction order exact.
+"""
+import os
+import sys
+import threading
+
+from kmsauth.utils import forksafe
+
+# The fewest entries per shard when the shard count isn't given, so that
+# small caches aren't split into shards too small to hold their share of the
+# working set (or, for W-TinyLFU, to have a main segment).
+MIN_SHARD_CAPACITY = 64
+
+
+def gil_enabled():
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return is_gil_enabled is None or is_gil_enabled()
+
+
+def default_shard_count():
+    """1 with a GIL, otherwise a power of two of at least 4x the CPUs."""
+    if gil_enabled():
+        return 1
+    target = min(4 * (os.cpu_count() or 1), 256)
+    shards = 1
+    while shards < target:
+        shards <<= 1
+    return shards
+
+
+class ShardedCache(object):
+    """
+    A thread-safe cache, split into shards built by factory(capacity). It has
+    the same interface as kmsauth.utils.lru.LRUCache, plus get. A shard count
+    that isn't a power of two is rounded down to one.
+    """
+
+    def __init__(self, factory, capacity, shards=None):
+        if shards is None:
+            shards = default_shard_count()
+            max_shards = capacity // MIN_SHARD_CAPACITY
+        else:
+            if shards < 1:
+                raise ValueError('shards must be at least 1.')
+            # Round down to a power of two.
+            shards = 1 << (shards.bit_length() - 1)
+            max_shards = capacity
+        # Don't split the cache into more shards than that, and keep a power
+        # of two, so that shards can be picked with a mask.
+        while shards > 1 and shards > max_shards:
+            shards >>= 1
+        self.capacity = capacity
+        self.mask = shards - 1
+        shard_capacity = -(-capacity // shards)
+        self.shards = [factory(shard_capacity) for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+        if shards == 1:
+            # Skip hashing the key to pick a shard.
+            self.get = self._get_unsharded
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Other threads may have held shard locks at the time of the fork.
+        self.locks = [threading.Lock() for _ in self.shards]
+
+    def _get_unsharded(self, key, default=None):
+        with self.locks[0]:
+            return self.shards[0].get(key, default)
+
+    def get(self, key, default=None):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return self.shards[index].get(key, default)
+
+    def __contains__(self, key):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return key in self.shards[index]
+
+    def __getitem__(self, key):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            return self.shards[index][key]
+
+    def __setitem__(self, key, value):
+        index = hash(key) & self.mask
+        with self.locks[index]:
+            self.shards[index][key] = value
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
@@ -0,0 +1,70 @@
+"""
+Fast conversion between kmsauth token timestamps and epoch seconds.
+
+Token timestamps use the fixed-width TIME_FORMAT (``%Y%m%dT%H%M%SZ``, always
+UTC), so they can be converted directly to and from epoch seconds, without
+the overhead of ``datetime.strptime`` and ``strftime``.
+"""
+import re
+import time
+
+TIME_FORMAT = "%Y%m%dT%H%M%SZ"
+
+_TIMESTAMP_RE = re.compile(r'\d{8}T\d{6}Z\Z', re.ASCII)
+_DAYS_IN_MONTH = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def _days_from_civil(year, month, day):
+    """
+    Number of days since 1970-01-01 for a date in the proleptic Gregorian
+    calendar.
+    """
+    if month <= 2:
+        year -= 1
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = (
+        year_of_era * 365 + year_of_era // 4 - year_of_era // 100 +
+        day_of_year
+    )
+    return era * 146097 + day_of_era - 719468
+
+
+def parse_timestamp(value):
+    """
+    Parse a TIME_FORMAT timestamp into integer epoch seconds.
+
+    Raises ValueError if value isn't a valid TIME_FORMAT timestamp.
+    """
+    if not isinstance(value, str) or _TIMESTAMP_RE.match(value) is None:
+        raise ValueError('Invalid timestamp: {0!r}'.format(value))
+    year = int(value[0:4])
+    month = int(value[4:6])
+    day = int(value[6:8])
+    hour = int(value[9:11])
+    minute = int(value[11:13])
+    second = int(value[13:15])
+    if (month < 1 or month > 12 or day < 1 or
+            day > _DAYS_IN_MONTH[month] or
+            (month == 2 and day == 29 and not (
+                year % 4 == 0 and (year % 100 != 0 or year % 400 == 0))) or
+            hour > 23 or minute > 59 or second > 61):
+        raise ValueError('Invalid timestamp: {0!r}'.format(value))
+    return (
+        _days_from_civil(year, month, day) * 86400 +
+        hour * 3600 + minute * 60 + second
+    )
+
+
+def format_timestamp(epoch):
+    """Format epoch seconds as a TIME_FORMAT timestamp."""
+    t = time.gmtime(epoch)
+    return '%04d%02d%02dT%02d%02d%02dZ' % (
+        t.tm_year,
+        t.tm_mon,
+        t.tm_mday,
+        t.tm_hour,
+        t.tm_min,
+        t.tm_sec
+    )
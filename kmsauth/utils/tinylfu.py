@@ -0,0 +1,138 @@
+"""
+W-TinyLFU cache.
+
+A small LRU admission window sits in front of a segmented LRU main cache.
+Entries evicted from the window only displace the main cache's eviction
+candidate if they've been seen more often, according to a count-min sketch of
+recent access frequencies. One-off keys (a scan) pass through the window
+without evicting frequently used keys from the main cache.
+"""
+import collections
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+# Translation table that halves every byte.
+_HALVE = bytes(count >> 1 for count in range(256))
+
+
+class CountMinSketch(object):
+    """
+    Approximate access frequencies, in depth rows of 4 bit counters. Every
+    sample_size increments, all counters are halved, so that frequencies
+    reflect recent accesses.
+    """
+
+    MAX_COUNT = 15
+
+    def __init__(self, capacity, depth=4):
+        width = 1
+        while width < max(capacity, 16):
+            width <<= 1
+        self.mask = width - 1
+        self.depth = depth
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.sample_size = 10 * max(capacity, 1)
+        self.additions = 0
+
+    def _indexes(self, key):
+        # Double hashing: row i uses h1 + i * h2.
+        h = hash(key) & _MASK64
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        mask = self.mask
+        return [(h1 + i * h2) & mask for i in range(self.depth)]
+
+    def frequency(self, key):
+        return min(
+            row[index]
+            for row, index in zip(self.rows, self._indexes(key))
+        )
+
+    def increment(self, key):
+        indexes = self._indexes(key)
+        count = min(row[i] for row, i in zip(self.rows, indexes))
+        if count < self.MAX_COUNT:
+            # Conservative update: only raise the counters at the minimum.
+            for row, index in zip(self.rows, indexes):
+                if row[index] == count:
+                    row[index] = count + 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self._reset()
+
+    def _reset(self):
+        for row in self.rows:
+            row[:] = row.translate(_HALVE)
+        self.additions //= 2
+
+
+class WTinyLFUCache(object):
+    """
+    W-TinyLFU cache, with the same interface as kmsauth.utils.lru.LRUCache.
+    """
+
+    def __init__(self, capacity, window_ratio=0.01, protected_ratio=0.8):
+        self.capacity = capacity
+        self.window_size = max(1, int(capacity * window_ratio))
+        self.main_size = max(capacity - self.window_size, 0)
+        self.protected_size = int(self.main_size * protected_ratio)
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.sketch = CountMinSketch(capacity)
+
+    def __len__(self):
+        return len(self.window) + len(self.probation) + len(self.protected)
+
+    def __contains__(self, key):
+        return (key in self.window or
+                key in self.probation or
+                key in self.protected)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __getitem__(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+            return self.window[key]
+        if key in self.protected:
+            self.protected.move_to_end(key)
+            return self.protected[key]
+        value = self.probation.pop(key)
+        self._protect(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        for segment in (self.window, self.probation, self.protected):
+            if key in segment:
+                segment[key] = value
+                return
+        self.sketch.increment(key)
+        self.window[key] = value
+        if len(self.window) > self.window_size:
+            self._admit(*self.window.popitem(last=False))
+
+    def _protect(self, key, value):
+        self.protected[key] = value
+        if len(self.protected) > self.protected_size:
+            demoted_key, demoted_value = self.protected.popitem(last=False)
+            self.probation[demoted_key] = demoted_value
+
+    def _admit(self, key, value):
+        """Admit a key evicted from the window into the main cache."""
+        if len(self.probation) + len(self.protected) < self.main_size:
+            self.probation[key] = value
+            return
+        if self.probation:
+            segment = self.probation
+        elif self.protected:
+            segment = self.protected
+        else:
+            return
+        victim = next(iter(segment))
+        if self.sketch.frequency(key) > self.sketch.frequency(victim):
+            del segment[victim]
+            self.probation[key] = value
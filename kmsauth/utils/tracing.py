@@ -0,0 +1,30 @@
+"""
+Optional tracing of kmsauth's phases.
+
+A tracer is any object with an OpenTelemetry-style
+``start_as_current_span(name)`` method, returning a context manager whose value
+has a ``set_attribute(key, value)`` method; an ``opentelemetry.trace.Tracer``
+works as is. Without a tracer, spans are a shared no-op context manager.
+"""
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def span(tracer, name):
+    """Start a span with tracer, or return NULL_SPAN if tracer is None."""
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.start_as_current_span(name)
@@ -29,6 +29,13 @@ setup(
     version=VERSION,
     install_requires=requirements,
     packages=find_packages(exclude=["test*"]),
+    entry_points={
+        'console_scripts': [
+            'kmsauth-validator = kmsauth.daemon:main',
+            'kmsauth-agent = kmsauth.agent:main',
+            'kmsauth-cachesim = kmsauth.cachesim:main',
+        ],
+    },
     author="Ryan Lane",
     author_email="rlane@lyft.com",
     description=("A python library for reusing KMS for your own authentication"
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import kmsauth
+from kmsauth import agent
+from kmsauth.broker import KMSTokenBroker
+
+
+def _kms_transport(prefix):
+    transport = MagicMock()
+
+    def encrypt(KeyId, Plaintext, EncryptionContext):
+        return {
+            'CiphertextBlob': prefix + EncryptionContext['to'].encode('utf-8')
+        }
+    transport.encrypt = MagicMock(side_effect=encrypt)
+    return transport
+
+
+class TokenAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'agent.sock')
+        self.agent_transport = _kms_transport(b'agent:')
+        self.agent = agent.TokenAgent(
+            KMSTokenBroker(
+                'alias/authnz-unittest',
+                {'from': 'kmsauth-unittest', 'user_type': 'service'},
+                'us-east-1',
+                to_auth_contexts=['service-a'],
+                kms_transport=self.agent_transport
+            ),
+            socket_path=self.socket_path
+        )
+        self.thread = threading.Thread(target=self.agent.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.agent.shutdown()
+        self.tmpdir.cleanup()
+
+    def _generator(self, auth_context, **kwargs):
+        return agent.AgentTokenGenerator(
+            'alias/authnz-unittest',
+            auth_context,
+            'us-east-1',
+            socket_path=self.socket_path,
+            kms_transport=_kms_transport(b'local:'),
+            **kwargs
+        )
+
+    def test_get_token(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+        generator = self._generator({
+            'from': 'kmsauth-unittest',
+            'to': 'service-a',
+            'user_type': 'service'
+        })
+        self.assertEqual(generator.get_username(), '2/service/kmsauth-unittest')
+        self.assertEqual(generator.get_token(), b'YWdlbnQ6c2VydmljZS1h')
+        self.assertEqual(generator.get_token(), b'YWdlbnQ6c2VydmljZS1h')
+        self.assertEqual(self.agent_transport.encrypt.call_count, 1)
+        self.assertEqual(generator.kms_client.encrypt.call_count, 0)
+
+    def test_fallback(self):
+        # Contexts the agent doesn't serve are minted in-process.
+        for auth_context in [
+                {'from': 'kmsauth-unittest', 'to': 'service-b',
+                 'user_type': 'service'},
+                {'from': 'other', 'to': 'service-a', 'user_type': 'service'}]:
+            generator = self._generator(auth_context)
+            self.assertTrue(
+                kmsauth.ensure_text(generator.get_token()).startswith('bG9jYWw6')
+            )
+        generator = self._generator(
+            {'from': 'kmsauth-unittest', 'to': 'service-a'},
+            token_version=1
+        )
+        generator.get_token()
+        self.assertEqual(generator.kms_client.encrypt.call_count, 1)
+        # As are tokens, when the agent is down.
+        self.agent.shutdown()
+        generator = self._generator({
+            'from': 'kmsauth-unittest',
+            'to': 'service-a',
+            'user_type': 'service'
+        })
+        self.assertEqual(generator.get_token(), b'bG9jYWw6c2VydmljZS1h')
@@ -0,0 +1,105 @@
+import asyncio
+import base64
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock
+
+import kmsauth
+from kmsauth.aio import AsyncKMSTokenGenerator
+
+AUTH_CONTEXT = {
+    'from': 'kmsauth-unittest',
+    'to': 'test',
+    'user_type': 'service',
+}
+
+
+class AsyncKMSTokenGeneratorTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmpdir.name, 'cache', 'token')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def make_generator(self, **kwargs):
+        generator = AsyncKMSTokenGenerator(
+            'alias/authnz-testing',
+            AUTH_CONTEXT,
+            'us-east-1',
+            kms_transport=MagicMock(),
+            **kwargs
+        )
+        generator.generator.kms_client.encrypt.return_value = {
+            'CiphertextBlob': b'encrypted'
+        }
+        return generator
+
+    def test_get_username(self):
+        generator = self.make_generator()
+        self.assertEqual(
+            generator.get_username(),
+            '2/service/kmsauth-unittest'
+        )
+
+    def test_get_token(self):
+        generator = self.make_generator(token_cache_file=self.cache_file)
+        loop_thread = []
+
+        def encrypt(**kwargs):
+            loop_thread.append(threading.current_thread())
+            return {'CiphertextBlob': b'encrypted'}
+
+        generator.generator.kms_client.encrypt.side_effect = encrypt
+
+        async def get_tokens():
+            return await asyncio.gather(
+                *[generator.get_token() for _ in range(10)]
+            )
+
+        tokens = asyncio.run(get_tokens())
+        self.assertEqual(tokens, [base64.b64encode(b'encrypted')] * 10)
+        # Concurrent calls share one mint, which isn't run on the loop.
+        self.assertEqual(generator.generator.kms_client.encrypt.call_count, 1)
+        self.assertIsNot(loop_thread[0], threading.current_thread())
+        # Later calls use the in-memory token.
+        asyncio.run(generator.get_token())
+        self.assertEqual(generator.generator.kms_client.encrypt.call_count, 1)
+        # A new generator uses the file cache.
+        other = self.make_generator(token_cache_file=self.cache_file)
+        self.assertEqual(
+            asyncio.run(other.get_token()),
+            base64.b64encode(b'encrypted')
+        )
+        self.assertFalse(other.generator.kms_client.encrypt.called)
+
+    def test_get_token_timeout(self):
+        generator = self.make_generator()
+        finish = threading.Event()
+
+        def encrypt(**kwargs):
+            finish.wait(10)
+            return {'CiphertextBlob': b'encrypted'}
+
+        generator.generator.kms_client.encrypt.side_effect = encrypt
+
+        async def get_token():
+            with self.assertRaises(kmsauth.DeadlineExceededError):
+                await generator.get_token(timeout=0.01)
+            finish.set()
+            # The timed out mint wasn't cancelled.
+            return await generator.get_token()
+
+        self.assertEqual(
+            asyncio.run(get_token()),
+            base64.b64encode(b'encrypted')
+        )
+        self.assertEqual(generator.generator.kms_client.encrypt.call_count, 1)
+
+    def test_get_token_error(self):
+        generator = self.make_generator()
+        generator.generator.kms_client.encrypt.side_effect = Exception()
+        with self.assertRaises(kmsauth.TokenGenerationError):
+            asyncio.run(generator.get_token())
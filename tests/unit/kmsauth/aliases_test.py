@@ -0,0 +1,137 @@
+import gc
+import time
+import unittest
+import weakref
+
+from unittest.mock import MagicMock
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+from kmsauth import aliases
+from kmsauth.transport import KMSError
+
+
+def _alias(name, target='key-id'):
+    return {
+        'AliasName': 'alias/{0}'.format(name),
+        'AliasArn': 'arn:aws:kms:us-east-1:123:alias/{0}'.format(name),
+        'TargetKeyId': target,
+    }
+
+
+class AliasResolverTest(unittest.TestCase):
+    def test_is_alias(self):
+        self.assertTrue(aliases.is_alias('alias/test'))
+        self.assertTrue(
+            aliases.is_alias('arn:aws:kms:us-east-1:123:alias/test')
+        )
+        self.assertFalse(aliases.is_alias('arn:aws:kms:us-east-1:123:key/a'))
+        self.assertFalse(aliases.is_alias('1234abcd-12ab-34cd-56ef'))
+
+    def test_load_paginates(self):
+        kms_client = MagicMock()
+        kms_client.list_aliases.side_effect = [
+            {
+                'Aliases': [_alias('a', 'key-a'), _alias('aws/managed', None)],
+                'Truncated': True,
+                'NextMarker': 'page2',
+            },
+            {
+                'Aliases': [_alias('b', 'key-b')],
+                'Truncated': False,
+            },
+        ]
+        resolver = aliases.AliasResolver()
+        self.assertFalse(resolver.loaded)
+        resolver.load(kms_client)
+        resolver.load(kms_client)
+        self.assertTrue(resolver.loaded)
+        self.assertEqual(kms_client.list_aliases.call_count, 2)
+        self.assertEqual(
+            kms_client.list_aliases.call_args[1],
+            {'Limit': aliases.LIST_ALIASES_LIMIT, 'Marker': 'page2'}
+        )
+        self.assertEqual(
+            resolver.resolve('alias/a'),
+            'arn:aws:kms:us-east-1:123:key/key-a'
+        )
+        self.assertEqual(
+            resolver.resolve('arn:aws:kms:us-east-1:123:alias/b'),
+            'arn:aws:kms:us-east-1:123:key/key-b'
+        )
+        self.assertIsNone(resolver.resolve('alias/aws/managed'))
+        self.assertIsNone(resolver.resolve('alias/missing'))
+
+    def test_load_access_denied(self):
+        denied = [
+            ClientError(
+                {'Error': {'Code': 'AccessDeniedException', 'Message': ''}},
+                'ListAliases'
+            ),
+            KMSError('AccessDeniedException', '', 400),
+        ]
+        for error in denied:
+            kms_client = MagicMock()
+            kms_client.list_aliases.side_effect = error
+            resolver = aliases.AliasResolver()
+            resolver.load(kms_client)
+            resolver.load(kms_client)
+            # Not retried.
+            self.assertTrue(resolver.loaded)
+            self.assertEqual(kms_client.list_aliases.call_count, 1)
+            self.assertIsNone(resolver.resolve('alias/a'))
+
+    def test_load_retries_transient_failures(self):
+        kms_client = MagicMock()
+        kms_client.list_aliases.side_effect = [
+            EndpointConnectionError(endpoint_url='https://kms'),
+            KMSError('KMSInternalException', '', 500),
+            {'Aliases': [_alias('a')], 'Truncated': False},
+        ]
+        resolver = aliases.AliasResolver()
+        resolver.load(kms_client)
+        self.assertFalse(resolver.loaded)
+        resolver.load(kms_client)
+        self.assertFalse(resolver.loaded)
+        resolver.load(kms_client)
+        self.assertTrue(resolver.loaded)
+        self.assertEqual(
+            resolver.resolve('alias/a'),
+            'arn:aws:kms:us-east-1:123:key/key-id'
+        )
+
+    def test_load_timeout(self):
+        kms_client = MagicMock()
+        resolver = aliases.AliasResolver()
+        # Another thread is listing aliases.
+        resolver._lock.acquire()
+        try:
+            start = time.monotonic()
+            resolver.load(kms_client, timeout=0.05)
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            resolver._lock.release()
+        self.assertFalse(resolver.loaded)
+        self.assertFalse(kms_client.list_aliases.called)
+
+    def test_get_alias_resolver(self):
+        kms_client = MagicMock()
+        resolver = aliases.get_alias_resolver(kms_client)
+        self.assertIs(aliases.get_alias_resolver(kms_client), resolver)
+        self.assertIsNot(aliases.get_alias_resolver(MagicMock()), resolver)
+
+    def test_get_alias_resolver_drops_client(self):
+        kms_client = MagicMock()
+        kms_client.list_aliases.return_value = {
+            'Aliases': [_alias('a')],
+            'Truncated': False,
+        }
+        aliases.get_alias_resolver(kms_client).load(kms_client)
+        ref = weakref.ref(kms_client)
+        # Drop other tests' clients first.
+        gc.collect()
+        count = len(aliases._resolvers)
+        del kms_client
+        gc.collect()
+        self.assertIsNone(ref())
+        self.assertEqual(len(aliases._resolvers), count - 1)
@@ -0,0 +1,116 @@
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import kmsauth
+from kmsauth import broker
+
+
+def _kms_transport():
+    transport = MagicMock()
+
+    def encrypt(KeyId, Plaintext, EncryptionContext):
+        return {'CiphertextBlob': EncryptionContext['to'].encode('utf-8')}
+    transport.encrypt = MagicMock(side_effect=encrypt)
+    return transport
+
+
+class KMSTokenBrokerTest(unittest.TestCase):
+    def test_validate_config(self):
+        with self.assertRaises(kmsauth.ConfigurationError):
+            broker.KMSTokenBroker(
+                'alias/authnz-unittest',
+                {'from': 'test', 'to': 'test', 'user_type': 'service'},
+                'us-east-1'
+            )
+        with self.assertRaises(kmsauth.ConfigurationError):
+            broker.KMSTokenBroker(
+                'alias/authnz-unittest',
+                # Missing user_type context
+                {'from': 'test'},
+                'us-east-1'
+            )
+
+    def test_get_token(self):
+        transport = _kms_transport()
+        token_broker = broker.KMSTokenBroker(
+            'alias/authnz-unittest',
+            {'from': 'kmsauth-unittest', 'user_type': 'service'},
+            'us-east-1',
+            to_auth_contexts=['service-a', 'service-b'],
+            kms_transport=transport
+        )
+        self.assertEqual(
+            token_broker.get_username(),
+            '2/service/kmsauth-unittest'
+        )
+        token_broker.prefetch()
+        self.assertEqual(transport.encrypt.call_count, 2)
+        self.assertEqual(token_broker.get_token('service-a'), b'c2VydmljZS1h')
+        self.assertEqual(token_broker.get_token('service-b'), b'c2VydmljZS1i')
+        self.assertEqual(transport.encrypt.call_count, 2)
+        # Unknown to contexts are minted on demand.
+        self.assertEqual(token_broker.get_token('service-c'), b'c2VydmljZS1j')
+        self.assertEqual(transport.encrypt.call_count, 3)
+        token_broker.close()
+
+    def test_refresh(self):
+        transport = _kms_transport()
+        token_broker = broker.KMSTokenBroker(
+            'alias/authnz-unittest',
+            {'from': 'kmsauth-unittest', 'user_type': 'service'},
+            'us-east-1',
+            kms_transport=transport,
+            refresh_jitter=0.5
+        )
+        token_broker.get_token('service-a')
+        entry = token_broker._tokens['service-a']
+        lifetime = entry.expires_at - time.time()
+        self.assertLessEqual(entry.refresh_at, entry.expires_at)
+        self.assertGreaterEqual(
+            entry.refresh_at,
+            entry.expires_at - lifetime * 0.5 - 1
+        )
+        # Tokens due for a refresh are still returned, while a new token is
+        # minted in the background.
+        token_broker._tokens['service-a'] = entry._replace(refresh_at=0)
+        self.assertEqual(token_broker.get_token('service-a'), entry.token)
+        token_broker.close()
+        self.assertEqual(transport.encrypt.call_count, 2)
+        self.assertGreater(token_broker._tokens['service-a'].refresh_at, 0)
+        # Expired tokens are replaced before returning.
+        token_broker._tokens['service-a'] = entry._replace(
+            refresh_at=0,
+            expires_at=0
+        )
+        token_broker.get_token('service-a')
+        self.assertEqual(transport.encrypt.call_count, 3)
+        token_broker.close()
+
+    def test_concurrent_mints_coalesce(self):
+        transport = _kms_transport()
+        release = threading.Event()
+        encrypt = transport.encrypt.side_effect
+
+        def slow_encrypt(**kwargs):
+            release.wait()
+            return encrypt(**kwargs)
+        transport.encrypt.side_effect = slow_encrypt
+        token_broker = broker.KMSTokenBroker(
+            'alias/authnz-unittest',
+            {'from': 'kmsauth-unittest', 'user_type': 'service'},
+            'us-east-1',
+            kms_transport=transport
+        )
+        threads = [
+            threading.Thread(target=token_broker.get_token, args=('svc',))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(transport.encrypt.call_count, 1)
+        token_broker.close()
@@ -0,0 +1,56 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from kmsauth import cachesim
+from kmsauth.utils import cachetrace
+
+
+def records(keys, not_after=100):
+    return [(float(now), key, not_after) for now, key in enumerate(keys)]
+
+
+class CacheSimTest(unittest.TestCase):
+    def test_lru(self):
+        policy = cachesim.POLICIES['lru'](2)
+        self.assertEqual(
+            cachesim.simulate(records([1, 2, 1, 3, 2, 1]), policy),
+            (1, 5)
+        )
+
+    def test_ttl(self):
+        policy = cachesim.TTLPolicy(2)
+        self.assertFalse(policy.access(1, 0, 100))
+        self.assertFalse(policy.access(2, 0, 5))
+        self.assertTrue(policy.access(2, 1, 5))
+        # 2 is more recently used, but expired, so it's evicted rather than 1.
+        self.assertFalse(policy.access(3, 10, 100))
+        self.assertTrue(policy.access(1, 11, 100))
+        self.assertFalse(policy.access(2, 12, 5))
+
+    def test_lfu(self):
+        policy = cachesim.LFUPolicy(2)
+        self.assertEqual(
+            cachesim.simulate(records([1, 1, 2, 3, 1, 2]), policy),
+            (2, 4)
+        )
+        self.assertEqual(set(policy.counts), {1, 2})
+
+    def test_main(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace')
+            recorder = cachetrace.CacheTraceRecorder(path)
+            for now, key in enumerate([1, 2, 1, 3, 1, 2]):
+                recorder.record((key,), 1000, now=now)
+            recorder.close()
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                cachesim.main([path, '--sizes', '1,4', '--policy', 'lru',
+                               '--policy', 'lfu'])
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], '6 accesses to 3 tokens over 5s')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[2].split()[:4], ['lru', '1', '0.0000', '6'])
+        self.assertEqual(lines[3].split()[:4], ['lru', '4', '0.5000', '3'])
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from kmsauth.utils import cachetrace
+
+
+class CacheTraceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'trace')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_record_and_read(self):
+        recorder = cachetrace.CacheTraceRecorder(self.path, buffer_records=2)
+        key = ('abc', 'service-a', 'service-b', 'service')
+        other_key = ('def', 'service-a', 'service-b', 'service')
+        recorder.record(key, 2000, now=1000.5)
+        recorder.record(other_key, 2001, now=1001)
+        recorder.record(key, 2000, now=1002)
+        # The first two records have been flushed, the last is buffered.
+        self.assertEqual(len(list(cachetrace.read_trace(self.path))), 2)
+        recorder.close()
+        records = list(cachetrace.read_trace(self.path))
+        self.assertEqual(
+            [(now, not_after) for now, _, not_after in records],
+            [(1000.5, 2000), (1001, 2001), (1002, 2000)]
+        )
+        keys = [record[1] for record in records]
+        self.assertEqual(keys[0], keys[2])
+        self.assertNotEqual(keys[0], keys[1])
+        self.assertEqual(keys[0], recorder.anonymize(key))
+        # Keys are salted per recorder, so traces can't be matched to tokens.
+        self.assertNotEqual(
+            keys[0],
+            cachetrace.CacheTraceRecorder(self.path).anonymize(key)
+        )
+        # Records after close are dropped.
+        recorder.record(key, 2000)
+
+    def test_read_trace_invalid(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a trace')
+        with self.assertRaises(ValueError):
+            list(cachetrace.read_trace(self.path))
+
+    def test_read_trace_partial_record(self):
+        recorder = cachetrace.CacheTraceRecorder(self.path)
+        recorder.record(('abc',), 2000, now=1000)
+        recorder.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00' * 5)
+        self.assertEqual(len(list(cachetrace.read_trace(self.path))), 1)
@@ -0,0 +1,32 @@
+import threading
+import unittest
+
+from kmsauth.utils import concurrency
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    def test_acquire(self):
+        limiter = concurrency.ConcurrencyLimiter(2)
+        self.assertTrue(limiter.acquire(0))
+        self.assertTrue(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0))
+        self.assertFalse(limiter.acquire(0.01))
+        self.assertEqual(limiter.waiting, 0)
+        limiter.release()
+        self.assertTrue(limiter.acquire(0))
+
+    def test_acquire_waits_for_release(self):
+        limiter = concurrency.ConcurrencyLimiter(1)
+        limiter.acquire()
+        results = []
+        waiter = threading.Thread(
+            target=lambda: results.append(limiter.acquire(10))
+        )
+        waiter.start()
+        while limiter.waiting == 0:
+            pass
+        limiter.release()
+        waiter.join()
+        self.assertEqual(results, [True])
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(limiter.waiting, 0)
@@ -0,0 +1,121 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import kmsauth
+from kmsauth import daemon
+
+# Fake KMS ciphertexts, with a KMS ciphertext header.
+TOKEN = base64.b64encode(b'\x01\x02\x02\x00' + b'\x00' * 96).decode('ascii')
+OTHER_TOKEN = base64.b64encode(
+    b'\x01\x02\x02\x00' + b'\x01' * 96
+).decode('ascii')
+
+
+def _validator():
+    validator = kmsauth.KMSTokenValidator(
+        'alias/authnz-unittest',
+        'alias/authnz-user-unittest',
+        'kmsauth-unittest',
+        'us-east-1'
+    )
+    validator._get_key_arn = MagicMock(return_value='mocked')
+    validator._get_key_alias_from_cache = MagicMock(
+        return_value='authnz-testing'
+    )
+    now = time.time()
+    validator.kms_client = MagicMock()
+    validator.kms_client.decrypt.return_value = {
+        'Plaintext': json.dumps({
+            'not_before': kmsauth.format_timestamp(now - 60),
+            'not_after': kmsauth.format_timestamp(now + 600)
+        }),
+        'KeyId': 'mocked'
+    }
+    return validator
+
+
+class ValidationDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'validator.sock')
+        self.validator = _validator()
+        self.daemon = daemon.ValidationDaemon(
+            self.validator,
+            socket_path=self.socket_path,
+            socket_mode=0o600
+        )
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.tmpdir.cleanup()
+
+    def test_decrypt_token(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+        client = daemon.ValidationClient(self.socket_path)
+        ret = client.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        self.assertEqual(ret['key_alias'], 'authnz-testing')
+        client.decrypt_token(
+            '2/service/kmsauth-unittest',
+            TOKEN.encode('ascii'),
+            to_auth_context='other-service'
+        )
+        # The daemon's cache is shared by all clients.
+        daemon.ValidationClient(self.socket_path).decrypt_token(
+            '2/service/kmsauth-unittest',
+            TOKEN
+        )
+        self.assertEqual(self.validator.kms_client.decrypt.call_count, 2)
+        with self.assertRaisesRegexp(
+                kmsauth.TokenValidationError,
+                'Unacceptable token version.'):
+            client.decrypt_token('3/service/kmsauth-unittest', TOKEN)
+
+    def test_decrypt_token_invalid_token(self):
+        client = daemon.ValidationClient(self.socket_path)
+        for token in [b'\xff\xfe' * 50, None, 12345, 'not a token']:
+            with self.assertRaisesRegex(
+                    kmsauth.TokenValidationError,
+                    'Invalid token format.'):
+                client.decrypt_token('2/service/kmsauth-unittest', token)
+        self.assertEqual(self.validator.kms_client.decrypt.call_count, 0)
+
+    def test_fallback(self):
+        fallback = _validator()
+        client = daemon.ValidationClient(
+            self.socket_path,
+            fallback_validator=fallback
+        )
+        client.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        self.assertEqual(fallback.kms_client.decrypt.call_count, 0)
+        self.daemon.shutdown()
+        client.decrypt_token('2/service/kmsauth-unittest', OTHER_TOKEN)
+        self.assertEqual(fallback.kms_client.decrypt.call_count, 1)
+        # Without a fallback, an unavailable daemon is a validation error.
+        client = daemon.ValidationClient(self.socket_path)
+        with self.assertRaisesRegexp(
+                kmsauth.TokenValidationError,
+                'Validation daemon unavailable.'):
+            client.decrypt_token('2/service/kmsauth-unittest', OTHER_TOKEN)
+
+    def test_parser(self):
+        args = daemon.build_parser().parse_args([
+            '--region', 'us-east-1',
+            '--auth-key', 'alias/a',
+            '--auth-key', 'alias/b',
+            '--scoped-auth-key', 'alias/c=sandbox',
+            '--user-type-token-cache-size', 'user=100',
+        ])
+        validator = daemon.validator_from_args(args)
+        self.assertEqual(validator.auth_key, ['alias/a', 'alias/b'])
+        self.assertEqual(validator.scoped_auth_keys, {'alias/c': 'sandbox'})
+        self.assertIsNone(validator.to_auth_context)
+        self.assertEqual(list(validator.TOKEN_PARTITIONS), ['user'])
@@ -0,0 +1,22 @@
+import unittest
+from unittest.mock import patch
+
+from kmsauth.utils import deadline
+
+
+class DeadlineTest(unittest.TestCase):
+    @patch('kmsauth.utils.deadline.time.monotonic')
+    def test_deadline(self, monotonic):
+        monotonic.return_value = 100
+        d = deadline.Deadline(2)
+        self.assertFalse(d.expired())
+        self.assertEqual(d.remaining(), 2)
+        monotonic.return_value = 101.5
+        self.assertEqual(d.remaining(), 0.5)
+        monotonic.return_value = 103
+        self.assertTrue(d.expired())
+        self.assertEqual(d.remaining(), 0)
+
+    def test_from_timeout(self):
+        self.assertIsNone(deadline.from_timeout(None))
+        self.assertTrue(deadline.from_timeout(0).expired())
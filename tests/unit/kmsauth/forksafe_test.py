@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+import weakref
+from unittest.mock import MagicMock, patch
+
+from kmsauth import services
+from kmsauth.transport import HTTPKMSTransport
+from kmsauth.utils import cachetrace
+from kmsauth.utils import forksafe
+from kmsauth.utils.concurrency import ConcurrencyLimiter
+from kmsauth.utils.ratelimit import KeyedRateLimiter, TokenBucket
+
+
+class Resettable(object):
+    def __init__(self):
+        self.resets = 0
+
+    def _after_fork(self):
+        self.resets += 1
+
+
+class ForkSafeTest(unittest.TestCase):
+    # Registered objects and the generation are patched, so that the rest of
+    # the process, including the global CLIENT_MANAGER, isn't reset.
+    @patch.object(forksafe, '_registered', weakref.WeakSet())
+    @patch.object(forksafe, '_generation', forksafe._generation)
+    def test_after_fork_in_child(self):
+        generation = forksafe.generation()
+        obj = Resettable()
+        forksafe.register(obj)
+        dropped = Resettable()
+        forksafe.register(dropped)
+        del dropped
+        forksafe._after_fork_in_child()
+        self.assertEqual(forksafe.generation(), generation + 1)
+        self.assertEqual(obj.resets, 1)
+        self.assertEqual(len(forksafe._registered), 1)
+
+    def test_client_manager(self):
+        manager = services.ClientManager()
+        manager.clients['key'] = MagicMock()
+        clients = manager.clients
+        self.assertIn(manager, forksafe._registered)
+        manager._after_fork()
+        self.assertIs(manager.clients, clients)
+        self.assertEqual(len(manager.clients), 0)
+
+    def test_http_transport(self):
+        transport = HTTPKMSTransport(
+            'us-east-1',
+            endpoint_url='http://localhost:1'
+        )
+        conn = MagicMock()
+        transport._release_connection(conn)
+        self.assertIn(transport, forksafe._registered)
+        transport._after_fork()
+        self.assertIsNot(transport._get_connection()[0], conn)
+        self.assertFalse(conn.close.called)
+
+    def test_concurrency_limiter(self):
+        limiter = ConcurrencyLimiter(1)
+        self.assertTrue(limiter.acquire(0))
+        self.assertIn(limiter, forksafe._registered)
+        limiter._after_fork()
+        # The parent's holder never releases its slot in the child.
+        self.assertEqual(limiter.active, 0)
+        self.assertTrue(limiter.acquire(0))
+
+    def test_rate_limiters(self):
+        bucket = TokenBucket(1, 1)
+        lock = bucket._lock
+        self.assertIn(bucket, forksafe._registered)
+        bucket._after_fork()
+        self.assertIsNot(bucket._lock, lock)
+        limiter = KeyedRateLimiter(1, 1)
+        limiter.try_acquire('key')
+        lock = limiter._lock
+        self.assertIn(limiter, forksafe._registered)
+        self.assertIn(limiter.buckets['key'], forksafe._registered)
+        limiter._after_fork()
+        self.assertIsNot(limiter._lock, lock)
+
+    def test_cache_trace_recorder(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'trace')
+            recorder = cachetrace.CacheTraceRecorder(path)
+            recorder.record(('parent',), 100, now=1)
+            self.assertIn(recorder, forksafe._registered)
+            recorder._after_fork()
+            # The parent writes its own buffered records.
+            recorder.record(('child',), 200, now=2)
+            recorder.close()
+            self.assertEqual(
+                [r[2] for r in cachetrace.read_trace(path)],
+                [200]
+            )
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'Requires os.fork')
+    def test_fork(self):
+        obj = Resettable()
+        forksafe.register(obj)
+        generation = forksafe.generation()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                ok = (forksafe.generation() == generation + 1 and
+                      obj.resets == 1)
+                os.write(write_fd, b'1' if ok else b'0')
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        result = os.read(read_fd, 1)
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'1')
+        self.assertEqual(obj.resets, 0)
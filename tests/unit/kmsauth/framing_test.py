@@ -0,0 +1,68 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from kmsauth.utils import framing
+
+
+class FrameClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.socket_path = os.path.join(self.tmpdir.name, 'test.sock')
+        self.requests = []
+        self.delay = 0
+        self.server = self._serve()
+        self.client = framing.FrameClient(self.socket_path, timeout=0.3)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def _dispatch(self, request):
+        self.requests.append(request)
+        time.sleep(self.delay)
+        return {'ok': True}
+
+    def _serve(self):
+        server = framing.UnixFrameServer(self.socket_path, self._dispatch)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def test_recv_frame(self):
+        left, right = socket.socketpair()
+        framing.send_frame(left, {'a': 1})
+        self.assertEqual(framing.recv_frame(right), {'a': 1})
+        left.sendall(b'\x00\x00')
+        left.close()
+        with self.assertRaises(framing.FramingError):
+            framing.recv_frame(right)
+        right.close()
+
+    def test_retry_after_restart(self):
+        self.assertEqual(self.client.request({'n': 1}), {'ok': True})
+        # A restarted server closes kept-alive connections.
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = self._serve()
+        self.assertEqual(self.client.request({'n': 2}), {'ok': True})
+        self.assertEqual(self.requests, [{'n': 1}, {'n': 2}])
+
+    def test_timeout_not_retried(self):
+        self.client.request({'n': 1})
+        self.delay = 0.5
+        start = time.time()
+        with self.assertRaises(framing.DaemonUnavailableError):
+            self.client.request({'n': 2})
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.requests, [{'n': 1}, {'n': 2}])
+        # The daemon is considered down, rather than retried.
+        with self.assertRaises(framing.DaemonUnavailableError):
+            self.client.request({'n': 3})
+        self.assertEqual(len(self.requests), 2)
@@ -1,13 +1,50 @@
 import base64
+import contextlib
 import datetime
 import json
+import subprocess
+import sys
+import threading
+import time
+import weakref
 
 import unittest
 from unittest.mock import patch
 from unittest.mock import MagicMock
 
+from botocore.exceptions import EndpointConnectionError
+
 import kmsauth
+from kmsauth import aliases
+from kmsauth.utils import forksafe
+from kmsauth.utils.deadline import Deadline
 from kmsauth.utils import lru
+from kmsauth.utils.tinylfu import WTinyLFUCache
+
+
+class RecordingTracer(object):
+    """A tracer that records the names and attributes of its spans."""
+
+    def __init__(self):
+        self.spans = []
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name):
+        span = MagicMock()
+        span.attributes = {}
+        span.set_attribute.side_effect = span.attributes.__setitem__
+        self.spans.append((name, span))
+        yield span
+
+    def names(self):
+        return [name for name, _ in self.spans]
+
+
+# Fake KMS ciphertexts, with a KMS ciphertext header.
+TOKEN = base64.b64encode(b'\x01\x02\x02\x00' + b'\x00' * 96).decode('ascii')
+OTHER_TOKEN = base64.b64encode(
+    b'\x01\x02\x02\x00' + b'\x01' * 96
+).decode('ascii')
 
 
 class KMSTokenValidatorTest(unittest.TestCase):
@@ -31,8 +68,8 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 None,
                 'kmsauth-unittest',
                 'us-east-1',
-                # 3 is an invalid token version
-                minimum_token_version=3
+                # 4 is an invalid token version
+                minimum_token_version=4
             )
         with self.assertRaises(kmsauth.ConfigurationError):
             kmsauth.KMSTokenValidator(
@@ -49,8 +86,8 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 None,
                 'kmsauth-unittest',
                 'us-east-1',
-                # 3 is an invalid token version
-                maximum_token_version=3
+                # 4 is an invalid token version
+                maximum_token_version=4
             )
         with self.assertRaises(kmsauth.ConfigurationError):
             kmsauth.KMSTokenValidator(
@@ -100,6 +137,85 @@ class KMSTokenValidatorTest(unittest.TestCase):
             'mocked:arn'
         )
 
+    def test__get_key_arn_list_aliases(self):
+        kms_client = MagicMock()
+        kms_client.list_aliases.return_value = {
+            'Aliases': [
+                {
+                    'AliasName': 'alias/{0}'.format(name),
+                    'AliasArn': 'arn:aws:kms:us-east-1:123:alias/{0}'.format(
+                        name
+                    ),
+                    'TargetKeyId': name,
+                }
+                for name in ['service', 'user', 'scoped']
+            ],
+            'Truncated': False
+        }
+        kms_client.describe_key.return_value = {
+            'KeyMetadata': {'Arn': 'arn:aws:kms:us-east-1:123:key/raw'}
+        }
+        validators = [
+            kmsauth.KMSTokenValidator(
+                ['alias/service', 'raw'],
+                'alias/user',
+                'kmsauth-unittest',
+                'us-east-1',
+                scoped_auth_keys={'alias/scoped': 'account'},
+                kms_transport=kms_client
+            )
+            for _ in range(2)
+        ]
+        for validator in validators:
+            validator.warm_up()
+            self.assertEqual(
+                validator._get_key_arn('alias/scoped'),
+                'arn:aws:kms:us-east-1:123:key/scoped'
+            )
+            self.assertEqual(
+                validator._get_key_alias_from_cache(
+                    'arn:aws:kms:us-east-1:123:key/user'
+                ),
+                'alias/user'
+            )
+        # Aliases are listed once for both validators, and only raw key IDs
+        # are described.
+        self.assertEqual(kms_client.list_aliases.call_count, 1)
+        self.assertEqual(kms_client.describe_key.call_count, 2)
+        kms_client.describe_key.assert_called_with(KeyId='raw')
+        # Aliases that aren't listed are described.
+        validators[0]._get_key_arn('alias/new')
+        kms_client.describe_key.assert_called_with(KeyId='alias/new')
+        # Alias ARNs are resolved too, rather than taken as key ARNs.
+        self.assertEqual(
+            validators[0]._get_key_arn(
+                'arn:aws:kms:us-east-1:123:alias/service'
+            ),
+            'arn:aws:kms:us-east-1:123:key/service'
+        )
+        self.assertEqual(kms_client.describe_key.call_count, 3)
+        # Waiting for another thread's sweep is bounded by the deadline.
+        kms_client = MagicMock()
+        validator = kmsauth.KMSTokenValidator(
+            'alias/service',
+            None,
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=kms_client
+        )
+        resolver = aliases.get_alias_resolver(kms_client)
+        resolver._lock.acquire()
+        try:
+            with self.assertRaises(kmsauth.DeadlineExceededError):
+                validator._get_key_arn(
+                    'alias/service',
+                    deadline=Deadline(0.05)
+                )
+        finally:
+            resolver._lock.release()
+        self.assertFalse(kms_client.list_aliases.called)
+        self.assertFalse(kms_client.describe_key.called)
+
     def test__get_key_arn_cached(self):
         validator = kmsauth.KMSTokenValidator(
             'alias/authnz-unittest',
@@ -174,6 +290,14 @@ class KMSTokenValidatorTest(unittest.TestCase):
             validator._parse_username('kmsauth-unittest'),
             (1, 'service', 'kmsauth-unittest')
         )
+        self.assertEqual(
+            validator._parse_username('3/s/kmsauth-unittest'),
+            (3, 'service', 'kmsauth-unittest')
+        )
+        self.assertEqual(
+            validator._parse_username('3/u/kmsauth-unittest'),
+            (3, 'user', 'kmsauth-unittest')
+        )
         self.assertEqual(
             validator._parse_username('2/service/kmsauth-unittest'),
             (2, 'service', 'kmsauth-unittest')
@@ -182,6 +306,54 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 kmsauth.TokenValidationError,
                 'Unsupported username format.'):
             validator._parse_username('3/service/kmsauth-unittest/extratoken')
+        for username in [
+                None,
+                '',
+                'a' * 257,
+                'kmsauth unittest',
+                '2/service/',
+                '2/service/kmsauth-unittest\n',
+                'x/service/kmsauth-unittest',
+                '02/service/kmsauth-unittest',
+                '2/Service/kmsauth-unittest',
+                '2/service/../kmsauth-unittest',
+                'service/kmsauth-unittest']:
+            with self.assertRaisesRegexp(
+                    kmsauth.TokenValidationError,
+                    'Unsupported username format.'):
+                validator._parse_username(username)
+
+    def test_decrypt_token_precheck(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1'
+        )
+        validator.kms_client = MagicMock()
+        header = b'\x01\x02\x02\x00'
+        for token in [
+                '',
+                'ZW5jcnlwdGVk',
+                # Too short.
+                base64.b64encode(header + b'\x00' * 59),
+                # Too long.
+                base64.b64encode(header + b'\x00' * 6141),
+                # Wrong ciphertext version.
+                base64.b64encode(b'\x02' + b'\x00' * 99),
+                # Not base64.
+                TOKEN[:-4] + 'AA-_',
+                TOKEN[:-4] + 'A=AA',
+                TOKEN[:-4] + 'A===',
+                TOKEN[:-1],
+                TOKEN + '\n',
+                TOKEN.encode('ascii') + b'\xff\xff\xff\xff',
+                None]:
+            with self.assertRaisesRegexp(
+                    kmsauth.TokenValidationError,
+                    'Invalid token format.'):
+                validator.decrypt_token('2/service/kmsauth-unittest', token)
+        self.assertEqual(validator.kms_client.decrypt.call_count, 0)
 
     def test_decrypt_token(self):
         validator = kmsauth.KMSTokenValidator(
@@ -213,7 +385,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
         self.assertEqual(
             validator.decrypt_token(
                 'kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
             ),
             {
                 'payload': json.loads(payload),
@@ -226,7 +398,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
         self.assertEqual(
             validator.decrypt_token(
                 '2/user/testuser',
-                'ZW5jcnlwdGVk'
+                TOKEN
             ),
             {
                 'payload': json.loads(payload),
@@ -240,7 +412,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Unacceptable token version.'):
             validator.decrypt_token(
                 '3/user/testuser',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # Ensure we check user types
         with self.assertRaisesRegexp(
@@ -248,7 +420,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. Unsupported user_type.'):
             validator.decrypt_token(
                 '2/unsupported/testuser',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # Missing KeyId, will cause an exception to be thrown
         validator.kms_client.decrypt.return_value = {
@@ -259,7 +431,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. General error.'):
             validator.decrypt_token(
                 '2/service/kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # Payload missing not_before/not_after
         empty_payload = json.dumps({})
@@ -272,7 +444,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. Missing validity.'):
             validator.decrypt_token(
                 '2/service/kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # lifetime of 0 will make every token invalid. testing for proper delta
         # checking.
@@ -297,7 +469,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. Token lifetime exceeded.'):
             validator.decrypt_token(
                 '2/service/kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # Token too old
         validator = kmsauth.KMSTokenValidator(
@@ -329,7 +501,7 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. Invalid time validity for token.'):
             validator.decrypt_token(
                 '2/service/kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
             )
         # Token too young
         now = datetime.datetime.utcnow()
@@ -350,9 +522,616 @@ class KMSTokenValidatorTest(unittest.TestCase):
                 'Authentication error. Invalid time validity for token'):
             validator.decrypt_token(
                 '2/service/kmsauth-unittest',
-                'ZW5jcnlwdGVk'
+                TOKEN
+            )
+
+    def test_decrypt_token_stale_cache(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            stale_token_cache_size=10
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        not_before = now.strftime(time_format)
+        _not_after = now + datetime.timedelta(minutes=60)
+        not_after = _not_after.strftime(time_format)
+        payload = json.dumps({
+            'not_before': not_before,
+            'not_after': not_after
+        })
+        validator.kms_client.decrypt = MagicMock()
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'mocked'
+        }
+        expected = {
+            'payload': json.loads(payload),
+            'key_alias': 'authnz-testing'
+        }
+        self.assertEqual(
+            validator.decrypt_token('2/service/kmsauth-unittest', TOKEN),
+            expected
+        )
+        # Evict everything from the primary cache, and make KMS unreachable.
+        validator.TOKENS = lru.LRUCache(4096)
+        validator.kms_client.decrypt.side_effect = EndpointConnectionError(
+            endpoint_url='https://kms.us-east-1.amazonaws.com'
+        )
+        # Previously validated tokens are served from the stale cache.
+        self.assertEqual(
+            validator.decrypt_token('2/service/kmsauth-unittest', TOKEN),
+            expected
+        )
+        # New tokens still fail.
+        with self.assertRaisesRegexp(
+                kmsauth.TokenValidationError,
+                'Failure connecting to AWS endpoint.'):
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                OTHER_TOKEN
+            )
+        # Stale tokens past their not_after are rejected.
+        validator.TOKENS = lru.LRUCache(4096)
+        token_key = validator._token_key(
+            TOKEN,
+            'kmsauth-unittest',
+            'kmsauth-unittest',
+            'service'
+        )
+        ret, not_before, not_after = validator.STALE_TOKENS.get(token_key)
+        validator.STALE_TOKENS[token_key] = (
+            ret,
+            not_before - 30 * 60,
+            not_before - 60
+        )
+        with self.assertRaisesRegexp(
+                kmsauth.TokenValidationError,
+                'Invalid time validity for token.'):
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN
+            )
+
+    def test_decrypt_token_to_auth_context(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            None,
+            'us-east-1'
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        payload = json.dumps({
+            'not_before': now.strftime(time_format),
+            'not_after': (
+                now + datetime.timedelta(minutes=60)
+            ).strftime(time_format)
+        })
+        validator.kms_client.decrypt = MagicMock()
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'mocked'
+        }
+        with self.assertRaises(kmsauth.ConfigurationError):
+            validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        for to in ['service-a', 'service-b', 'service-a']:
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN,
+                to_auth_context=to
+            )
+        # The audience is part of both the encryption context and the cache
+        # key, so each audience is checked with KMS once.
+        self.assertEqual(validator.kms_client.decrypt.call_count, 2)
+        contexts = [
+            call[1]['EncryptionContext']['to']
+            for call in validator.kms_client.decrypt.call_args_list
+        ]
+        self.assertEqual(contexts, ['service-a', 'service-b'])
+        # from and to values can't be shifted into each other.
+        validator.decrypt_token(
+            '2/service/kmsauth-unittes',
+            TOKEN,
+            to_auth_context='tservice-a'
+        )
+        self.assertEqual(validator.kms_client.decrypt.call_count, 3)
+
+    def test_decrypt_token_rate_limit(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            decrypt_rate_limit=0.001,
+            decrypt_rate_burst=1,
+            global_decrypt_rate_limit=0.001,
+            global_decrypt_rate_burst=2,
+            stats=MagicMock()
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        payload = json.dumps({
+            'not_before': now.strftime(time_format),
+            'not_after': (
+                now + datetime.timedelta(minutes=60)
+            ).strftime(time_format)
+        })
+        validator.kms_client.decrypt = MagicMock()
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'mocked'
+        }
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        # Cache hits don't count against the limit.
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        with self.assertRaises(kmsauth.RateLimitExceededError):
+            validator.decrypt_token('2/service/kmsauth-unittest', OTHER_TOKEN)
+        validator.stats.incr.assert_any_call('kms_decrypt_rate_limited')
+        # Other principals have their own limit, within the global one.
+        validator.decrypt_token('2/service/kmsauth-other', TOKEN)
+        with self.assertRaises(kmsauth.RateLimitExceededError):
+            validator.decrypt_token('2/user/kmsauth-unittest', TOKEN)
+        validator.stats.incr.assert_any_call(
+            'kms_decrypt_rate_limited_global'
+        )
+        self.assertEqual(validator.kms_client.decrypt.call_count, 2)
+
+    def test_decrypt_token_concurrency_limit(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            max_concurrent_decrypts=1,
+            decrypt_queue_timeout=0.01,
+            stats=MagicMock()
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        payload = json.dumps({
+            'not_before': now.strftime(time_format),
+            'not_after': (
+                now + datetime.timedelta(minutes=60)
+            ).strftime(time_format)
+        })
+        started = threading.Event()
+        finish = threading.Event()
+
+        def decrypt(**kwargs):
+            started.set()
+            finish.wait(10)
+            return {'Plaintext': payload, 'KeyId': 'mocked'}
+
+        validator.kms_client.decrypt = MagicMock(side_effect=decrypt)
+        blocked = threading.Thread(
+            target=validator.decrypt_token,
+            args=('2/service/kmsauth-unittest', TOKEN)
+        )
+        blocked.start()
+        started.wait(10)
+        # The only slot is taken, so this is shed rather than queued.
+        with self.assertRaises(kmsauth.ServiceOverloadedError):
+            validator.decrypt_token('2/service/kmsauth-unittest', OTHER_TOKEN)
+        validator.stats.incr.assert_any_call('kms_decrypt_shed')
+        validator.stats.gauge.assert_any_call('kms_decrypt_queue_depth', 0)
+        self.assertTrue(validator.stats.timing.called)
+        finish.set()
+        blocked.join()
+        # Once the slot is released, decrypts go through again.
+        validator.decrypt_token('2/service/kmsauth-unittest', OTHER_TOKEN)
+        self.assertEqual(validator.kms_client.decrypt.call_count, 2)
+
+    def test_decrypt_token_concurrency_limit_no_queue_timeout(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock(),
+            max_concurrent_decrypts=1,
+            decrypt_queue_timeout=None
+        )
+        self.assertTrue(validator.decrypt_concurrency_limiter.acquire(0))
+        # Without a queue timeout, decrypts wait until the deadline.
+        start = time.monotonic()
+        with self.assertRaises(kmsauth.DeadlineExceededError):
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN,
+                timeout=0.05
+            )
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertFalse(validator.kms_client.decrypt.called)
+
+    def test_decrypt_token_timeout(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock()
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        payload = json.dumps({
+            'not_before': now.strftime(time_format),
+            'not_after': (
+                now + datetime.timedelta(minutes=60)
+            ).strftime(time_format)
+        })
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+        }
+        validator.kms_client.describe_key.return_value = {
+            'KeyMetadata': {
+                'Arn': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+            }
+        }
+        with self.assertRaises(kmsauth.DeadlineExceededError):
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN,
+                timeout=0
+            )
+        self.assertFalse(validator.kms_client.decrypt.called)
+
+        # The deadline also applies to key lookups after the decrypt.
+        def slow_decrypt(**kwargs):
+            time.sleep(0.02)
+            return validator.kms_client.decrypt.return_value
+
+        validator.kms_client.decrypt.side_effect = slow_decrypt
+        with self.assertRaises(kmsauth.DeadlineExceededError):
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN,
+                timeout=0.01
+            )
+        self.assertFalse(validator.kms_client.describe_key.called)
+        validator.kms_client.decrypt.side_effect = None
+        self.assertEqual(
+            validator.decrypt_token(
+                '2/service/kmsauth-unittest',
+                TOKEN,
+                timeout=10
+            )['key_alias'],
+            'alias/authnz-unittest'
+        )
+        # Cached tokens are returned regardless of the deadline.
+        validator.decrypt_token(
+            '2/service/kmsauth-unittest',
+            TOKEN,
+            timeout=0
+        )
+        self.assertEqual(validator.kms_client.decrypt.call_count, 2)
+
+    def test_decrypt_token_tracer(self):
+        tracer = RecordingTracer()
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock(),
+            tracer=tracer
+        )
+        time_format = "%Y%m%dT%H%M%SZ"
+        now = datetime.datetime.utcnow()
+        payload = json.dumps({
+            'not_before': now.strftime(time_format),
+            'not_after': (
+                now + datetime.timedelta(minutes=60)
+            ).strftime(time_format)
+        })
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+        }
+        validator.kms_client.describe_key.return_value = {
+            'KeyMetadata': {
+                'Arn': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+            }
+        }
+        validator.kms_client.list_aliases.return_value = {
+            'Aliases': [],
+            'Truncated': False
+        }
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        self.assertEqual(tracer.names(), [
+            'kmsauth.decrypt_token',
+            'kmsauth.hash_token',
+            'kmsauth.token_cache_lookup',
+            'kmsauth.kms_decrypt',
+            'kmsauth.list_aliases',
+            'kmsauth.describe_key',
+            'kmsauth.parse_payload',
+            'kmsauth.validate_time',
+        ])
+        self.assertEqual(tracer.spans[0][1].attributes, {
+            'kmsauth.token_version': 2,
+            'kmsauth.user_type': 'service',
+            'kmsauth.cache_hit': False,
+        })
+        tracer.spans = []
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        self.assertEqual(tracer.names(), [
+            'kmsauth.decrypt_token',
+            'kmsauth.hash_token',
+            'kmsauth.token_cache_lookup',
+            'kmsauth.validate_time',
+        ])
+        self.assertTrue(tracer.spans[0][1].attributes['kmsauth.cache_hit'])
+
+    def test_token_cache_policy(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            token_cache_policy='tinylfu'
+        )
+        self.assertIsInstance(validator.TOKENS.shards[0], WTinyLFUCache)
+        with self.assertRaises(kmsauth.ConfigurationError):
+            kmsauth.KMSTokenValidator(
+                'alias/authnz-unittest',
+                'alias/authnz-user-unittest',
+                'kmsauth-unittest',
+                'us-east-1',
+                token_cache_policy='fifo'
+            )
+
+    def test_token_cache_shards(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            token_cache_shards=3
+        )
+        self.assertEqual(len(validator.TOKENS.shards), 2)
+        with self.assertRaises(kmsauth.ConfigurationError):
+            kmsauth.KMSTokenValidator(
+                'alias/authnz-unittest',
+                'alias/authnz-user-unittest',
+                'kmsauth-unittest',
+                'us-east-1',
+                token_cache_shards=0
             )
 
+    def test_token_cache_partitions(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock(),
+            token_cache_size=10,
+            token_cache_sizes={'user': 1},
+            stats=MagicMock()
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        now = time.time()
+        payload = json.dumps({
+            'not_before': kmsauth.format_timestamp(now - 60),
+            'not_after': kmsauth.format_timestamp(now + 600)
+        })
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'mocked'
+        }
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        # User tokens only evict each other.
+        validator.decrypt_token('2/user/kmsauth-unittest', TOKEN)
+        validator.decrypt_token('2/user/kmsauth-unittest', OTHER_TOKEN)
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        validator.decrypt_token('2/user/kmsauth-unittest', OTHER_TOKEN)
+        validator.decrypt_token('2/user/kmsauth-unittest', TOKEN)
+        self.assertEqual(validator.kms_client.decrypt.call_count, 4)
+        counts = {}
+        for call in validator.stats.incr.call_args_list:
+            counts[call[0][0]] = counts.get(call[0][0], 0) + 1
+        self.assertEqual(counts['token_cache_hit.default'], 1)
+        self.assertEqual(counts['token_cache_miss.default'], 1)
+        self.assertEqual(counts['token_cache_hit.user'], 1)
+        self.assertEqual(counts['token_cache_miss.user'], 3)
+
+    # Registered objects and the generation are patched, so that the rest of
+    # the process isn't reset.
+    @patch.object(forksafe, '_registered', weakref.WeakSet())
+    @patch.object(forksafe, '_generation', forksafe._generation)
+    @patch('kmsauth._get_kms_client')
+    def test_kms_client_after_fork(self, get_kms_client):
+        get_kms_client.side_effect = lambda *args, **kwargs: MagicMock()
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1'
+        )
+        client = validator.kms_client
+        self.assertIs(validator.kms_client, client)
+        forksafe._after_fork_in_child()
+        self.assertIsNot(validator.kms_client, client)
+        # Explicitly set clients are kept.
+        client = MagicMock()
+        validator.kms_client = client
+        forksafe._after_fork_in_child()
+        self.assertIs(validator.kms_client, client)
+
+    def test_warm_up(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock()
+        )
+        now = time.time()
+        payload = json.dumps({
+            'not_before': kmsauth.format_timestamp(now - 60),
+            'not_after': kmsauth.format_timestamp(now + 600)
+        })
+        arn = 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': arn
+        }
+        validator.kms_client.describe_key.return_value = {
+            'KeyMetadata': {'Arn': arn}
+        }
+        self.assertEqual(validator.warm_up([
+            ('2/service/kmsauth-unittest', TOKEN),
+            ('2/service/kmsauth-unittest', 'invalid'),
+        ]), 1)
+        self.assertEqual(
+            sorted(validator.KEY_METADATA),
+            ['alias/authnz-unittest', 'alias/authnz-user-unittest']
+        )
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        self.assertEqual(validator.kms_client.decrypt.call_count, 1)
+        self.assertEqual(validator.kms_client.describe_key.call_count, 2)
+
+    def test_decrypt_token_cache_trace(self):
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            'alias/authnz-user-unittest',
+            'kmsauth-unittest',
+            'us-east-1',
+            kms_transport=MagicMock(),
+            cache_trace=MagicMock()
+        )
+        validator._get_key_arn = MagicMock(return_value='mocked')
+        validator._get_key_alias_from_cache = MagicMock(
+            return_value='authnz-testing'
+        )
+        now = time.time()
+        payload = json.dumps({
+            'not_before': kmsauth.format_timestamp(now - 60),
+            'not_after': kmsauth.format_timestamp(now + 600)
+        })
+        validator.kms_client.decrypt.return_value = {
+            'Plaintext': payload,
+            'KeyId': 'mocked'
+        }
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        validator.decrypt_token('2/service/kmsauth-unittest', TOKEN)
+        calls = validator.cache_trace.record.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(calls[0], calls[1])
+        token_key, not_after = calls[0][0]
+        self.assertEqual(token_key[1:], (
+            'kmsauth-unittest',
+            'kmsauth-unittest',
+            'service'
+        ))
+        self.assertEqual(not_after, int(now + 600))
+
+    def test_decrypt_token_binary_payload(self):
+        kms_client = MagicMock()
+        kms_client.encrypt.return_value = {
+            'CiphertextBlob': base64.b64decode(TOKEN)
+        }
+        generator = kmsauth.KMSTokenGenerator(
+            'alias/authnz-unittest',
+            {'from': 'kmsauth-unittest',
+             'to': 'test',
+             'user_type': 'service'},
+            'us-east-1',
+            token_version=3,
+            kms_transport=kms_client
+        )
+        now = int(time.time())
+        token = generator.get_token()
+        username = generator.get_username()
+        self.assertEqual(username, '3/s/kmsauth-unittest')
+        plaintext = kms_client.encrypt.call_args[1]['Plaintext']
+        self.assertEqual(len(plaintext), 10)
+        self.assertEqual(
+            kms_client.encrypt.call_args[1]['EncryptionContext']['user_type'],
+            'service'
+        )
+        kms_client.decrypt.return_value = {
+            'Plaintext': plaintext,
+            'KeyId': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+        }
+        kms_client.describe_key.return_value = {
+            'KeyMetadata': {
+                'Arn': 'arn:aws:kms:us-east-1:123:key/authnz-unittest'
+            }
+        }
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            None,
+            'test',
+            'us-east-1',
+            kms_transport=kms_client
+        )
+        # Version 3 tokens are only accepted once enabled.
+        with self.assertRaisesRegex(
+                kmsauth.TokenValidationError,
+                'Unacceptable token version.'):
+            validator.decrypt_token(username, token)
+        validator = kmsauth.KMSTokenValidator(
+            'alias/authnz-unittest',
+            None,
+            'test',
+            'us-east-1',
+            maximum_token_version=3,
+            kms_transport=kms_client
+        )
+        ret = validator.decrypt_token(username, token)
+        self.assertEqual(ret['key_alias'], 'alias/authnz-unittest')
+        self.assertAlmostEqual(
+            kmsauth.parse_timestamp(ret['payload']['not_before']),
+            now - kmsauth.TOKEN_SKEW * 60,
+            delta=1
+        )
+        self.assertAlmostEqual(
+            kmsauth.parse_timestamp(ret['payload']['not_after']),
+            now + (generator.token_lifetime - kmsauth.TOKEN_SKEW) * 60,
+            delta=1
+        )
+        self.assertEqual(
+            kms_client.decrypt.call_args[1]['EncryptionContext'],
+            {'from': 'kmsauth-unittest', 'to': 'test', 'user_type': 'service'}
+        )
+        # JSON payloads, truncated payloads, other formats and unknown flags
+        # are rejected.
+        for payload in [
+                json.dumps(ret['payload']),
+                plaintext[:-1],
+                b'\x02' + plaintext[1:],
+                plaintext[:1] + b'\x01' + plaintext[2:]]:
+            validator.TOKENS = lru.LRUCache(4096)
+            kms_client.decrypt.return_value['Plaintext'] = payload
+            with self.assertRaisesRegex(
+                    kmsauth.TokenValidationError,
+                    'Authentication error. Invalid payload.'):
+                validator.decrypt_token(username, token)
+
 
 class KMSTokenGeneratorTest(unittest.TestCase):
 
@@ -381,7 +1160,7 @@ class KMSTokenGeneratorTest(unittest.TestCase):
                 {'from': 'test', 'to': 'test', 'user_type': 'user'},
                 'us-east-1',
                 # invalid token version
-                token_version=3
+                token_version=4
             )
         assert(kmsauth.KMSTokenGenerator(
             'alias/authnz-unittest',
@@ -423,6 +1202,18 @@ class KMSTokenGeneratorTest(unittest.TestCase):
             client.get_username(),
             '2/service/kmsauth-unittest'
         )
+        client = kmsauth.KMSTokenGenerator(
+            'alias/authnz-testing',
+            {'from': 'kmsauth-unittest',
+             'to': 'test',
+             'user_type': 'user'},
+            'us-east-1',
+            token_version=3
+        )
+        self.assertEqual(
+            client.get_username(),
+            '3/u/kmsauth-unittest'
+        )
 
     @patch(
         'kmsauth.services.get_boto_client'
@@ -442,3 +1233,63 @@ class KMSTokenGeneratorTest(unittest.TestCase):
         )
         token = client.get_token()
         self.assertEqual(token, base64.b64encode(b'encrypted'))
+
+    def test_get_token_tracer(self):
+        tracer = RecordingTracer()
+        client = kmsauth.KMSTokenGenerator(
+            'alias/authnz-testing',
+            {'from': 'kmsauth-unittest',
+             'to': 'test',
+             'user_type': 'service'},
+            'us-east-1',
+            kms_transport=MagicMock(),
+            tracer=tracer
+        )
+        client.kms_client.encrypt.return_value = {
+            'CiphertextBlob': b'encrypted'
+        }
+        client.get_token()
+        self.assertEqual(tracer.names(), [
+            'kmsauth.get_token',
+            'kmsauth.token_cache_read',
+            'kmsauth.kms_encrypt',
+            'kmsauth.token_cache_write',
+        ])
+        self.assertFalse(tracer.spans[0][1].attributes['kmsauth.cache_hit'])
+
+    def test_get_token_timeout(self):
+        client = kmsauth.KMSTokenGenerator(
+            'alias/authnz-testing',
+            {'from': 'kmsauth-unittest',
+             'to': 'test',
+             'user_type': 'service'},
+            'us-east-1',
+            kms_transport=MagicMock()
+        )
+        with self.assertRaises(kmsauth.DeadlineExceededError):
+            client.get_token(timeout=0)
+        self.assertFalse(client.kms_client.encrypt.called)
+        client.kms_client.encrypt.return_value = {
+            'CiphertextBlob': b'encrypted'
+        }
+        self.assertEqual(
+            client.get_token(timeout=10),
+            base64.b64encode(b'encrypted')
+        )
+
+
+class KMSAuthImportTest(unittest.TestCase):
+
+    def test_lazy_boto3_import(self):
+        # Importing kmsauth and building validators and generators shouldn't
+        # load boto3; it's only needed for the first KMS call.
+        script = (
+            "import sys, kmsauth\n"
+            "kmsauth.KMSTokenValidator('alias/a', None, 'to', 'us-east-1')\n"
+            "kmsauth.KMSTokenGenerator(\n"
+            "    'alias/a', {'from': 'a', 'to': 'b', 'user_type': 'service'},\n"
+            "    'us-east-1')\n"
+            "print('boto3' in sys.modules or 'botocore' in sys.modules)\n"
+        )
+        out = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(out.strip(), b'False')
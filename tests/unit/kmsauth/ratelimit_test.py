@@ -0,0 +1,35 @@
+import unittest
+
+from kmsauth.utils import ratelimit
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_try_acquire(self):
+        bucket = ratelimit.TokenBucket(2, 3, now=0)
+        # The bucket starts full.
+        self.assertEqual(
+            [bucket.try_acquire(now=0) for _ in range(4)],
+            [True, True, True, False]
+        )
+        # It refills at rate per second.
+        self.assertTrue(bucket.try_acquire(now=0.5))
+        self.assertFalse(bucket.try_acquire(now=0.5))
+        # But never holds more than burst.
+        self.assertEqual(
+            [bucket.try_acquire(now=100) for _ in range(4)],
+            [True, True, True, False]
+        )
+        # Time going backwards doesn't add tokens.
+        self.assertFalse(bucket.try_acquire(now=50))
+
+
+class KeyedRateLimiterTest(unittest.TestCase):
+    def test_try_acquire(self):
+        limiter = ratelimit.KeyedRateLimiter(0.001, 1, max_keys=2)
+        self.assertTrue(limiter.try_acquire('a'))
+        self.assertFalse(limiter.try_acquire('a'))
+        self.assertTrue(limiter.try_acquire('b'))
+        self.assertFalse(limiter.try_acquire('b'))
+        # Evicting a key's bucket resets it.
+        self.assertTrue(limiter.try_acquire('c'))
+        self.assertTrue(limiter.try_acquire('a'))
@@ -0,0 +1,117 @@
+import datetime
+import unittest
+from unittest.mock import MagicMock
+
+from kmsauth import services
+
+
+class ClientManagerTest(unittest.TestCase):
+    def test_get_client_cached(self):
+        manager = services.ClientManager()
+        client = manager.get_client('kms', region='us-east-1')
+        self.assertIs(client, manager.get_client('kms', region='us-east-1'))
+        # Clients with different configs don't share a connection pool.
+        self.assertIsNot(
+            client,
+            manager.get_client(
+                'kms',
+                region='us-east-1',
+                max_pool_connections=100
+            )
+        )
+        self.assertIsNot(
+            client,
+            manager.get_client('kms', region='us-east-1', read_timeout=1)
+        )
+
+    def test_get_client_session_token(self):
+        manager = services.ClientManager()
+        creds = {
+            'aws_access_key_id': 'AKIDEXAMPLE',
+            'aws_secret_access_key': 'secret',
+            'aws_session_token': 'token1'
+        }
+        client = manager.get_client('kms', region='us-east-1', **creds)
+        self.assertIs(
+            client,
+            manager.get_client('kms', region='us-east-1', **creds)
+        )
+        creds['aws_session_token'] = 'token2'
+        self.assertIsNot(
+            client,
+            manager.get_client('kms', region='us-east-1', **creds)
+        )
+
+    def test_get_client_evicts(self):
+        manager = services.ClientManager(
+            max_size=2,
+            temporary_credentials_idle_ttl=-1
+        )
+        manager.get_client('kms', region='us-east-1')
+        manager.get_client('kms', region='us-west-2')
+        manager.get_client('kms', region='eu-west-1')
+        self.assertEqual(len(manager.clients), 2)
+        # Clients from temporary credentials are dropped once they are idle.
+        creds = {
+            'aws_access_key_id': 'AKIDEXAMPLE',
+            'aws_secret_access_key': 'secret',
+            'aws_session_token': 'token'
+        }
+        client = manager.get_client('kms', region='us-east-1', **creds)
+        self.assertIsNot(
+            client,
+            manager.get_client('kms', region='us-east-1', **creds)
+        )
+        manager.get_client('kms', region='us-west-2')
+        self.assertNotIn(client, manager.clients.values())
+
+    def test_get_client_refreshable(self):
+        manager = services.ClientManager()
+        refresh = MagicMock(return_value={
+            'AccessKeyId': 'AKIDEXAMPLE',
+            'SecretAccessKey': 'secret',
+            'SessionToken': 'token'
+        })
+        client = manager.get_client(
+            'kms',
+            region='us-east-1',
+            refresh_credentials=refresh
+        )
+        self.assertIs(
+            client,
+            manager.get_client(
+                'kms',
+                region='us-east-1',
+                refresh_credentials=refresh
+            )
+        )
+        creds = client._request_signer._credentials.get_frozen_credentials()
+        self.assertEqual(creds.access_key, 'AKIDEXAMPLE')
+        self.assertEqual(creds.token, 'token')
+
+    def test_get_client_refreshable_expiration(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        expirations = [
+            # Aware, naive (as from utcnow()) and missing.
+            now + datetime.timedelta(hours=1),
+            (now + datetime.timedelta(hours=1)).replace(tzinfo=None),
+            None,
+        ]
+        for expiration in expirations:
+            creds = {
+                'AccessKeyId': 'AKIDEXAMPLE',
+                'SecretAccessKey': 'secret',
+                'SessionToken': 'token'
+            }
+            if expiration is not None:
+                creds['Expiration'] = expiration
+            client = services.ClientManager().get_client(
+                'kms',
+                region='us-east-1',
+                refresh_credentials=MagicMock(return_value=creds)
+            )
+            credentials = client._request_signer._credentials
+            frozen = credentials.get_frozen_credentials()
+            self.assertEqual(frozen.access_key, 'AKIDEXAMPLE')
+            # Not due for a refresh.
+            self.assertGreater(credentials._seconds_remaining(), 600)
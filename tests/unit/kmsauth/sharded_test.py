@@ -0,0 +1,103 @@
+import unittest
+
+from unittest.mock import patch
+
+from kmsauth.utils import forksafe
+from kmsauth.utils import lru
+from kmsauth.utils import sharded
+
+
+class ShardedCacheTest(unittest.TestCase):
+    def test_get_set(self):
+        cache = sharded.ShardedCache(lru.LRUCache, 64, shards=4)
+        cache['a'] = 1
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        with self.assertRaises(KeyError):
+            cache['b']
+        self.assertEqual(len(cache), 1)
+
+    def test_get_unsharded(self):
+        cache = sharded.ShardedCache(lru.LRUCache, 2, shards=1)
+        cache['a'] = 1
+        cache['b'] = 2
+        # get moves a to the front, so b is evicted.
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_capacity_split(self):
+        cache = sharded.ShardedCache(lru.LRUCache, 10, shards=4)
+        self.assertEqual(len(cache.shards), 4)
+        self.assertEqual(len(cache.locks), 4)
+        for shard in cache.shards:
+            self.assertEqual(shard.capacity, 3)
+        for i in range(100):
+            cache[i] = i
+        self.assertLessEqual(len(cache), 12)
+
+    def test_shards_clamped_to_capacity(self):
+        cache = sharded.ShardedCache(lru.LRUCache, 5, shards=16)
+        self.assertEqual(len(cache.shards), 4)
+        cache = sharded.ShardedCache(lru.LRUCache, 1, shards=16)
+        self.assertEqual(len(cache.shards), 1)
+
+    def test_shards_rounded_to_power_of_two(self):
+        for shards, expected in [(3, 2), (6, 4), (16, 16)]:
+            cache = sharded.ShardedCache(lru.LRUCache, 300, shards=shards)
+            self.assertEqual(len(cache.shards), expected)
+            self.assertEqual(cache.mask, expected - 1)
+        # Every shard is used, so the cache holds its full capacity.
+        cache = sharded.ShardedCache(lru.LRUCache, 300, shards=3)
+        for i in range(1000):
+            cache[i] = i
+        self.assertEqual(len(cache), 300)
+        for shards in [0, -1]:
+            with self.assertRaises(ValueError):
+                sharded.ShardedCache(lru.LRUCache, 300, shards=shards)
+
+    @patch('kmsauth.utils.sharded.default_shard_count', return_value=256)
+    def test_default_shards_min_capacity(self, default_shard_count):
+        # Shards keep at least MIN_SHARD_CAPACITY entries each...
+        cache = sharded.ShardedCache(lru.LRUCache, 256)
+        self.assertEqual(len(cache.shards), 4)
+        for i in range(100):
+            cache[i] = i
+        self.assertEqual(len(cache), 100)
+        self.assertEqual(len(sharded.ShardedCache(lru.LRUCache, 63).shards), 1)
+        self.assertEqual(
+            len(sharded.ShardedCache(lru.LRUCache, 65536).shards),
+            256
+        )
+        # ...unless the shard count is given.
+        cache = sharded.ShardedCache(lru.LRUCache, 256, shards=256)
+        self.assertEqual(len(cache.shards), 256)
+
+    def test_after_fork(self):
+        cache = sharded.ShardedCache(lru.LRUCache, 64, shards=4)
+        cache['a'] = 1
+        locks = cache.locks
+        self.assertIn(cache, forksafe._registered)
+        cache._after_fork()
+        self.assertEqual(len(cache.locks), 4)
+        self.assertTrue(all(
+            new is not old for new, old in zip(cache.locks, locks)
+        ))
+        self.assertEqual(cache['a'], 1)
+
+    @patch('os.cpu_count', return_value=3)
+    def test_default_shard_count(self, cpu_count):
+        with patch('sys._is_gil_enabled', create=True, return_value=True):
+            self.assertEqual(sharded.default_shard_count(), 1)
+            cache = sharded.ShardedCache(lru.LRUCache, 64)
+            self.assertEqual(len(cache.shards), 1)
+        with patch('sys._is_gil_enabled', create=True, return_value=False):
+            self.assertFalse(sharded.gil_enabled())
+            self.assertEqual(sharded.default_shard_count(), 16)
+        cpu_count.return_value = 1024
+        with patch('sys._is_gil_enabled', create=True, return_value=False):
+            self.assertEqual(sharded.default_shard_count(), 256)
@@ -0,0 +1,57 @@
+import calendar
+import datetime
+import unittest
+
+from kmsauth.utils import timestamp
+
+
+class TimestampTest(unittest.TestCase):
+    def test_parse_timestamp(self):
+        for value in [
+                '19700101T000000Z',
+                '20000229T235959Z',
+                '20231231T120000Z',
+                '20991231T235959Z']:
+            expected = calendar.timegm(
+                datetime.datetime.strptime(
+                    value,
+                    timestamp.TIME_FORMAT
+                ).timetuple()
+            )
+            self.assertEqual(timestamp.parse_timestamp(value), expected)
+
+    def test_parse_timestamp_invalid(self):
+        for value in [
+                None,
+                b'20200101T000000Z',
+                '',
+                '20200101T000000',
+                '20200101 000000Z',
+                '20200101T000000Z ',
+                '2020010100T0000Z',
+                '2020-101T000000Z',
+                '20201301T000000Z',
+                '20200230T000000Z',
+                '20190229T000000Z',
+                '21000229T000000Z',
+                '20200100T000000Z',
+                '20200101T240000Z',
+                '20200101T006000Z',
+                '2020١101T000000Z']:
+            with self.assertRaises(ValueError):
+                timestamp.parse_timestamp(value)
+
+    def test_format_timestamp(self):
+        self.assertEqual(
+            timestamp.format_timestamp(0),
+            '19700101T000000Z'
+        )
+        self.assertEqual(
+            timestamp.format_timestamp(951868799.9),
+            '20000229T235959Z'
+        )
+        value = '20240615T081530Z'
+        self.assertEqual(
+            timestamp.format_timestamp(timestamp.parse_timestamp(value)),
+            value
+        )
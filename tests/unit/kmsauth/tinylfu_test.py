@@ -0,0 +1,73 @@
+import unittest
+
+from kmsauth.utils import lru
+from kmsauth.utils import tinylfu
+
+
+class CountMinSketchTest(unittest.TestCase):
+    def test_frequency(self):
+        sketch = tinylfu.CountMinSketch(64)
+        for _ in range(3):
+            sketch.increment('hot')
+        sketch.increment('warm')
+        self.assertEqual(sketch.frequency('hot'), 3)
+        self.assertEqual(sketch.frequency('warm'), 1)
+        self.assertEqual(sketch.frequency('cold'), 0)
+
+    def test_frequency_saturates(self):
+        sketch = tinylfu.CountMinSketch(1024)
+        for _ in range(100):
+            sketch.increment('hot')
+        self.assertEqual(
+            sketch.frequency('hot'),
+            tinylfu.CountMinSketch.MAX_COUNT
+        )
+
+    def test_reset(self):
+        sketch = tinylfu.CountMinSketch(16)
+        for _ in range(10):
+            sketch.increment('hot')
+        # The next increment triggers a reset. Other keys aren't used, since
+        # they could collide with hot.
+        sketch.additions = sketch.sample_size - 1
+        sketch.increment('hot')
+        self.assertEqual(sketch.frequency('hot'), 5)
+        self.assertEqual(sketch.additions, sketch.sample_size // 2)
+
+
+class WTinyLFUCacheTest(unittest.TestCase):
+    def test_mapping(self):
+        cache = tinylfu.WTinyLFUCache(4)
+        cache['a'] = 1
+        self.assertIn('a', cache)
+        self.assertEqual(cache['a'], 1)
+        cache['a'] = 2
+        self.assertEqual(cache['a'], 2)
+        with self.assertRaises(KeyError):
+            cache['missing']
+        for i in range(10):
+            cache[i] = i
+        self.assertLessEqual(len(cache), 4)
+
+    def test_scan_resistance(self):
+        hot = ['hot{0}'.format(i) for i in range(50)]
+
+        def run(cache):
+            hits = 0
+            for scan in range(20):
+                for key in hot:
+                    if key in cache:
+                        cache[key]
+                        hits += 1
+                    else:
+                        cache[key] = key
+                # A burst of one-off keys, larger than the cache.
+                for i in range(200):
+                    key = 'scan{0}-{1}'.format(scan, i)
+                    if key not in cache:
+                        cache[key] = key
+            return hits
+
+        # An LRU loses every hot key to each scan, W-TinyLFU keeps most.
+        self.assertEqual(run(lru.LRUCache(100)), 0)
+        self.assertGreater(run(tinylfu.WTinyLFUCache(100)), 50 * 15)
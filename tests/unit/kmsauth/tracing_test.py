@@ -0,0 +1,19 @@
+import unittest
+from unittest.mock import MagicMock
+
+from kmsauth.utils import tracing
+
+
+class TracingTest(unittest.TestCase):
+    def test_span(self):
+        with tracing.span(None, 'test') as span:
+            span.set_attribute('key', 'value')
+        self.assertIs(span, tracing.NULL_SPAN)
+        tracer = MagicMock()
+        tracing.span(tracer, 'test')
+        tracer.start_as_current_span.assert_called_once_with('test')
+
+    def test_null_span_propagates_exceptions(self):
+        with self.assertRaises(ValueError):
+            with tracing.NULL_SPAN:
+                raise ValueError()
@@ -0,0 +1,235 @@
+import base64
+import datetime
+import http.server
+import json
+import threading
+import time
+import unittest
+
+import kmsauth
+from kmsauth import transport
+
+# The fake KMS "encrypts" by reversing the plaintext, behind a header.
+HEADER = b'\x01' + b'\x00' * 63
+
+
+def _encrypt(plaintext):
+    return HEADER + plaintext[::-1]
+
+
+def _decrypt(ciphertext):
+    return ciphertext[len(HEADER):][::-1]
+
+
+CREDS = {
+    'AccessKeyId': 'AKIDEXAMPLE',
+    'SecretAccessKey': 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY',
+    'SessionToken': 'session-token',
+}
+
+
+class FakeKMSHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append((dict(self.headers), body))
+        time.sleep(self.server.delay)
+        target = self.headers['X-Amz-Target']
+        status = 200
+        if target == 'TrentService.Decrypt':
+            response = {
+                'KeyId': 'arn:aws:kms:us-east-1:123:key/mocked',
+                'Plaintext': base64.b64encode(
+                    _decrypt(base64.b64decode(body['CiphertextBlob']))
+                ).decode('ascii'),
+            }
+        elif target == 'TrentService.Encrypt':
+            response = {
+                'KeyId': 'arn:aws:kms:us-east-1:123:key/mocked',
+                'CiphertextBlob': base64.b64encode(
+                    _encrypt(base64.b64decode(body['Plaintext']))
+                ).decode('ascii'),
+            }
+        elif target == 'TrentService.ListAliases':
+            response = {
+                'Aliases': [{
+                    'AliasName': 'alias/mocked',
+                    'AliasArn': 'arn:aws:kms:us-east-1:123:alias/mocked',
+                    'TargetKeyId': 'mocked',
+                }],
+                'Truncated': False,
+            }
+        else:
+            status = 400
+            response = {
+                '__type': 'NotFoundException',
+                'message': 'Key not found.',
+            }
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', transport.KMS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.drop_connections:
+            # Close the connection without telling the client.
+            self.close_connection = True
+
+
+class HTTPKMSTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            FakeKMSHandler
+        )
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.drop_connections = False
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.transport = transport.HTTPKMSTransport(
+            'us-east-1',
+            endpoint_url='http://127.0.0.1:{0}'.format(
+                self.server.server_address[1]
+            ),
+            aws_creds=CREDS
+        )
+
+    def tearDown(self):
+        self.transport.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_decrypt(self):
+        data = self.transport.decrypt(
+            CiphertextBlob=_encrypt(b'hello'),
+            EncryptionContext={'to': 'a', 'from': 'b'}
+        )
+        self.assertEqual(data['Plaintext'], b'hello')
+        self.assertEqual(data['KeyId'], 'arn:aws:kms:us-east-1:123:key/mocked')
+        headers, body = self.server.requests[0]
+        self.assertEqual(body['EncryptionContext'], {'to': 'a', 'from': 'b'})
+        self.assertEqual(headers['X-Amz-Security-Token'], 'session-token')
+        self.assertTrue(
+            headers['Authorization'].startswith(
+                'AWS4-HMAC-SHA256 Credential=AKIDEXAMPLE/'
+            )
+        )
+        # The connection is kept alive and reused.
+        self.transport.decrypt(CiphertextBlob=_encrypt(b'hello'))
+        self.assertEqual(self.transport._pool.qsize(), 1)
+
+    def test_retry_stale_connection(self):
+        # The server closes the pooled connection after responding.
+        self.server.drop_connections = True
+        self.transport.decrypt(CiphertextBlob=_encrypt(b'hello'))
+        time.sleep(0.1)
+        self.transport.decrypt(CiphertextBlob=_encrypt(b'hello'))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_read_timeout_not_retried(self):
+        self.transport.read_timeout = 0.2
+        self.transport.decrypt(CiphertextBlob=_encrypt(b'hello'))
+        self.server.delay = 0.5
+        start = time.time()
+        with self.assertRaises(transport.TransportConnectionError):
+            self.transport.encrypt(KeyId='alias/test', Plaintext=b'hello')
+        self.assertLess(time.time() - start, 0.4)
+        # The timed out request was sent only once, on the pooled connection.
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_list_aliases(self):
+        response = self.transport.list_aliases(Limit=10, Marker='next')
+        self.assertEqual(response['Aliases'][0]['TargetKeyId'], 'mocked')
+        headers, body = self.server.requests[0]
+        self.assertEqual(headers['X-Amz-Target'], 'TrentService.ListAliases')
+        self.assertEqual(body, {'Limit': 10, 'Marker': 'next'})
+
+    def test_errors(self):
+        with self.assertRaises(transport.KMSError) as e:
+            self.transport.describe_key(KeyId='alias/missing')
+        self.assertEqual(e.exception.code, 'NotFoundException')
+        unreachable = transport.HTTPKMSTransport(
+            'us-east-1',
+            endpoint_url='http://127.0.0.1:1',
+            aws_creds=CREDS
+        )
+        with self.assertRaises(transport.TransportConnectionError):
+            unreachable.decrypt(CiphertextBlob=_encrypt(b'hello'))
+
+    def test_generator_and_validator(self):
+        generator = kmsauth.KMSTokenGenerator(
+            'alias/authnz-unittest',
+            {'from': 'kmsauth-unittest', 'to': 'test', 'user_type': 'service'},
+            'us-east-1',
+            kms_transport=self.transport
+        )
+        token = generator.get_token()
+        # The fake KMS only resolves aliases with ListAliases.
+        validator = kmsauth.KMSTokenValidator(
+            'alias/mocked',
+            None,
+            'test',
+            'us-east-1',
+            kms_transport=self.transport
+        )
+        ret = validator.decrypt_token(generator.get_username(), token)
+        self.assertIn('not_after', ret['payload'])
+
+
+class SigV4SignerTest(unittest.TestCase):
+    def test_sign_matches_botocore(self):
+        from botocore.auth import SigV4Auth
+        from botocore.awsrequest import AWSRequest
+        from botocore.credentials import Credentials
+
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        body = b'{"KeyId": "alias/test"}'
+        headers = {
+            'Host': 'kms.us-east-1.amazonaws.com',
+            'Content-Type': transport.KMS_CONTENT_TYPE,
+            'X-Amz-Target': 'TrentService.DescribeKey',
+        }
+        transport.SigV4Signer('us-east-1').sign(
+            'POST',
+            '/',
+            headers,
+            body,
+            CREDS,
+            now=now
+        )
+
+        request = AWSRequest(
+            method='POST',
+            url='https://kms.us-east-1.amazonaws.com/',
+            data=body,
+            headers={
+                'Content-Type': transport.KMS_CONTENT_TYPE,
+                'X-Amz-Target': 'TrentService.DescribeKey',
+            }
+        )
+        request.context['timestamp'] = '20200102T030405Z'
+        auth = SigV4Auth(
+            Credentials(
+                CREDS['AccessKeyId'],
+                CREDS['SecretAccessKey'],
+                CREDS['SessionToken']
+            ),
+            'kms',
+            'us-east-1'
+        )
+        auth._modify_request_before_signing(request)
+        canonical_request = auth.canonical_request(request)
+        signature = auth.signature(
+            auth.string_to_sign(request, canonical_request),
+            request
+        )
+        self.assertTrue(
+            headers['Authorization'].endswith('Signature=' + signature)
+        )